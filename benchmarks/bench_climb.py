@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 12:05:41
+# *************************************************************
+
+"""climb 隧道单连接下载吞吐量测试
+
+在本机启动一个数据源服务器以及 LocalClimbServer -> RemoteClimbServer 链路，
+通过 SOCKS5 连接数据源并读取全部数据，对比不同帧格式和读取大小的吞吐量
+
+用法: python benchmarks/bench_climb.py [--size 64] [--compress never]
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import logging
+import threading
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from phankom.climb import LocalClimbServer, RemoteClimbServer  # noqa: E402
+
+
+CASES = [
+    ("small frame, 10KB read", dict()),
+    ("small frame, 64KB read", dict(buffer_size=64 * 1024)),
+    ("large frame, 64KB read", dict(large_frame=True, buffer_size=64 * 1024)),
+    ("large frame, 256KB read", dict(large_frame=True,
+                                     buffer_size=256 * 1024)),
+]
+
+
+def start_source_server(payload, total):
+    """启动数据源服务器，每个连接发送 total 字节后关闭"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+
+    def send(sock):
+        with sock:
+            view = memoryview(payload)
+            sent = 0
+            while sent < total:
+                chunk = view[:total - sent]
+                sock.sendall(chunk)
+                sent += len(chunk)
+
+    def serve():
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=send, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def start_chain(options):
+    remote = RemoteClimbServer("benchmark", "127.0.0.1", 0, **options)
+    threading.Thread(target=remote.start, daemon=True).start()
+    remote_port = remote.sock.getsockname()[1]
+    local = LocalClimbServer("benchmark", "127.0.0.1", 0,
+                             "127.0.0.1", remote_port, **options)
+    threading.Thread(target=local.start, daemon=True).start()
+    return local.sock.getsockname()[1]
+
+
+def download(proxy_port, port):
+    """通过代理连接数据源并读取全部数据，返回 (字节数, 耗时)"""
+    sock = socket.create_connection(("127.0.0.1", proxy_port))
+    with sock:
+        sock.sendall(b"\x05\x01\x00")
+        sock.recv(2)
+        sock.sendall(b"\x05\x01\x00\x01" + socket.inet_aton("127.0.0.1") +
+                     struct.pack(">H", port))
+        sock.recv(10)
+        start = time.perf_counter()
+        received = 0
+        buffer = bytearray(256 * 1024)
+        while True:
+            nbytes = sock.recv_into(buffer)
+            if not nbytes:
+                break
+            received += nbytes
+        return received, time.perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description="climb tunnel throughput benchmark")
+    parser.add_argument("--size", type=int, default=64,
+                        help="Megabytes downloaded per case (default: 64)")
+    parser.add_argument("--compress", default="always",
+                        choices=["always", "never", "adaptive"],
+                        help="Compression policy (default: always)")
+    parser.add_argument("--data", default="text", choices=["text", "random"],
+                        help="Payload content (default: text)")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    total = args.size * 1024 * 1024
+    if args.data == "random":
+        payload = os.urandom(1024 * 1024)
+    else:
+        line = b"GET /index.html HTTP/1.1 200 OK %08d\r\n"
+        payload = b"".join(line % i for i in range(30000))[:1024 * 1024]
+    source_port = start_source_server(payload, total)
+
+    for name, options in CASES:
+        options = dict(options, compress_mode=args.compress)
+        proxy_port = start_chain(options)
+        received, elapsed = download(proxy_port, source_port)
+        assert received == total, "received %s of %s" % (received, total)
+        print("%-26s %8.2f MB/s" % (name, received / elapsed / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
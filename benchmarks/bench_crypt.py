@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 10:48:12
+# *************************************************************
+
+"""加密器吞吐量测试
+
+先对比 MixCipher 异或的新旧实现，再逐个测试已安装的加密器
+
+用法: python benchmarks/bench_crypt.py [--sizes 1024,10240] [--total 16]
+      [--compress never]
+"""
+
+import os
+import sys
+import time
+import itertools
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from phankom.crypt import (MixCipher, create_cipher,  # noqa: E402
+                           available_ciphers)
+
+
+def legacy_xor_data(cipher, data):
+    """逐字节异或的旧实现，作为对照"""
+    data = [(x ^ y).to_bytes(1, "big") for x, y in
+            zip(data, itertools.cycle(cipher.salt))]
+    return b"".join(data)
+
+
+def measure(func, data, total):
+    """重复调用 func 处理 data 直到累计处理 total 字节，返回 MB/s"""
+    rounds = max(1, total // len(data))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(data)
+    elapsed = time.perf_counter() - start
+    return rounds * len(data) / elapsed / 1024 / 1024
+
+
+def main():
+    parser = ArgumentParser(description="Cipher throughput benchmark")
+    parser.add_argument("--sizes", default="64,1024,10240,65536",
+                        help="Comma separated payload sizes in bytes")
+    parser.add_argument("--total", type=int, default=16,
+                        help="Megabytes processed per case (default: 16)")
+    parser.add_argument("--compress", default="always",
+                        choices=["always", "never", "adaptive"],
+                        help="Compression policy of the ciphers "
+                             "(default: always)")
+    args = parser.parse_args()
+
+    cipher = MixCipher("benchmark")
+    total = args.total * 1024 * 1024
+    print("%10s %14s %14s %14s %14s" % ("size", "legacy xor", "xor",
+                                        "encrypt", "decrypt"))
+    for size in map(int, args.sizes.split(",")):
+        data = os.urandom(size)
+        assert cipher._xor_data(data) == legacy_xor_data(cipher, data)
+        encrypted = cipher.encrypt(data)
+        # 旧实现太慢，只处理十分之一的数据量
+        legacy = measure(lambda d: legacy_xor_data(cipher, d), data,
+                         total // 10)
+        xor = measure(cipher._xor_data, data, total)
+        encrypt = measure(cipher.encrypt, data, total)
+        decrypt = measure(cipher.decrypt, encrypted, total)
+        print("%10d %9.2f MB/s %9.2f MB/s %9.2f MB/s %9.2f MB/s" % (
+            size, legacy, xor, encrypt, decrypt))
+
+    print()
+    print("%18s %10s %14s %14s" % ("cipher", "size", "encrypt", "decrypt"))
+    for name in available_ciphers():
+        cipher = create_cipher(name, "benchmark", args.compress)
+        for size in map(int, args.sizes.split(",")):
+            data = os.urandom(size)
+            encrypted = cipher.encrypt(data)
+            encrypt = measure(cipher.encrypt, data, total)
+            decrypt = measure(cipher.decrypt, encrypted, total)
+            print("%18s %10d %9.2f MB/s %9.2f MB/s" % (name, size, encrypt,
+                                                     decrypt))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 16:40:12
+# *************************************************************
+
+"""本机性能测试
+
+在本机启动一个回显服务器，以及 Socks5Server 或 LocalClimbServer -> RemoteClimbServer
+链路，多个客户端并发地通过代理连接回显服务器，每个连接发送 payload_size 字节并读回，
+统计吞吐量、每秒连接数和握手延迟的分位数，以 JSON 格式输出便于前后对比。
+climb 链路依次测试指定的每种加密器，每个结果中注明所用的加密器。
+客户端和服务器运行在同一个进程中，结果只适合用于相对比较
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import logging
+import platform
+import threading
+
+from .crypt import available_ciphers
+
+
+# 客户端每次发送并读回的数据量
+CHUNK_SIZE = 64 * 1024
+
+
+def start_echo_server():
+    """启动回显服务器，返回端口"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1024)
+
+    def echo(sock):
+        with sock:
+            buffer = bytearray(CHUNK_SIZE)
+            view = memoryview(buffer)
+            while True:
+                size = sock.recv_into(buffer)
+                if not size:
+                    break
+                sock.sendall(view[:size])
+
+    def serve():
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=echo, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def start_proxy(target, engine, options):
+    """在后台线程中启动代理，返回 (SOCKS 端口, 服务器列表)"""
+    def run(server):
+        method = server.start_async if engine == "asyncio" else server.start
+        threading.Thread(target=method, daemon=True).start()
+        return server.sock.getsockname()[1]
+
+    if target == "socks":
+        from .socks import Socks5Server
+        server = Socks5Server("127.0.0.1", 0, **options)
+        return run(server), [server]
+
+    from .climb import LocalClimbServer, RemoteClimbServer
+    remote = RemoteClimbServer("benchmark", "127.0.0.1", 0, **options)
+    local = LocalClimbServer("benchmark", "127.0.0.1", 0,
+                             "127.0.0.1", run(remote), **options)
+    return run(local), [local, remote]
+
+
+def _recv_exactly(sock, buffer):
+    view = memoryview(buffer)
+    while view:
+        size = sock.recv_into(view)
+        if not size:
+            raise ConnectionError("Connection closed by proxy")
+        view = view[size:]
+
+
+def request(proxy_port, echo_port, payload):
+    """通过代理连接回显服务器，发送 payload 并读回，返回握手耗时"""
+    start = time.perf_counter()
+    sock = socket.create_connection(("127.0.0.1", proxy_port))
+    with sock:
+        reply = bytearray(10)
+        sock.sendall(b"\x05\x01\x00")
+        _recv_exactly(sock, memoryview(reply)[:2])
+        sock.sendall(b"\x05\x01\x00\x01" + socket.inet_aton("127.0.0.1") +
+                     struct.pack(">H", echo_port))
+        _recv_exactly(sock, reply)
+        if reply[1] != 0:
+            raise ConnectionError("Proxy refused: %r" % bytes(reply))
+        handshake = time.perf_counter() - start
+
+        buffer = bytearray(min(len(payload), CHUNK_SIZE))
+        view = memoryview(payload)
+        for offset in range(0, len(payload), CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            sock.sendall(chunk)
+            _recv_exactly(sock, memoryview(buffer)[:len(chunk)])
+    return handshake
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def run_case(proxy_port, echo_port, payload, clients, connections):
+    """clients 个线程并发完成 connections 个连接，返回统计结果"""
+    remaining = [connections]
+    lock = threading.Lock()
+    handshakes = []
+    errors = []
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            try:
+                handshakes.append(request(proxy_port, echo_port, payload))
+            except OSError as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    completed = len(handshakes)
+    return {
+        "payload_size": len(payload),
+        "connections": completed,
+        "errors": len(errors),
+        "elapsed": round(elapsed, 4),
+        "mb_per_second": round(completed * len(payload) / elapsed / 1024 ** 2,
+                               2),
+        "connections_per_second": round(completed / elapsed, 2),
+        "handshake_p50_ms": round(percentile(handshakes, 0.5) * 1000, 3),
+        "handshake_p99_ms": round(percentile(handshakes, 0.99) * 1000, 3),
+    }
+
+
+def make_payload(size, data):
+    if data == "random":
+        return os.urandom(size)
+    line = b"GET /index.html HTTP/1.1 200 OK %08d\r\n"
+    count = size // len(line % 0) + 1
+    return b"".join(line % i for i in range(count))[:size]
+
+
+def run(args):
+    """执行 bench 命令，args 为命令行参数"""
+    logging.disable(logging.WARNING)
+    options = {}
+    if args.target == "climb":
+        options.update(compress_mode=args.compress,
+                       stream_compress=args.stream_compress,
+                       large_frame=args.large_frame)
+    if args.buffer_size:
+        options["buffer_size"] = args.buffer_size
+    if args.relay_threads:
+        options["relay_threads"] = args.relay_threads
+
+    echo_port = start_echo_server()
+    ciphers = [None]
+    if args.target == "climb":
+        ciphers = available_ciphers() if args.ciphers == ["all"] else \
+            args.ciphers
+    results = []
+    for cipher in ciphers:
+        case_options = dict(options)
+        if cipher:
+            case_options["cipher"] = cipher
+        proxy_port, servers = start_proxy(args.target, args.engine,
+                                          case_options)
+        for size in args.sizes:
+            result = run_case(proxy_port, echo_port,
+                              make_payload(size, args.data), args.clients,
+                              args.connections)
+            if cipher:
+                result["cipher"] = cipher
+            results.append(result)
+        if cipher:
+            ratio = round(servers[0].cipher.compress_ratio, 4)
+            for result in results[-len(args.sizes):]:
+                result["compress_ratio"] = ratio
+    report = {
+        "target": args.target,
+        "engine": args.engine,
+        "clients": args.clients,
+        "data": args.data,
+        "options": options,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    return report
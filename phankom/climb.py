@@ -11,148 +11,891 @@
 """Climb over the GFW(Great Fire Wall)"""
 
 import os
+import time
 import socket
 import struct
 import random
-import select
+import asyncio
+import weakref
+from threading import Thread
 
 from .socks import Socks5Server
-from .crypt import MixCipher
-from .utils import affirm, is_even
+from .crypt import create_cipher
+from .mux import MuxStream, MuxTunnel, MuxPool
+from .pool import ConnectionPool
+from .reactor import Relay
+from .udp import TunnelEnd, DirectEnd, UdpAssociation
+from .profiling import StageProfiler, ProfiledCipher
+from .utils import affirm, is_even, wait_sockets, shutdown_write
+
+
+# 非阻塞读取标志，不支持的平台上不做批量读取
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+class FrameReader(object):
+    """帧读取器，每个隧道套接字一个实例
+
+    接收缓冲区是一个可复用的 bytearray，通过 recv_into 直接写入，
+    一次读取可能包含多个完整的帧，也可能只有帧的一部分(包括帧头)，
+    next_frame 每次取出一个完整的帧，数据不足时返回 None
+    """
+
+    def __init__(self, parse_head, head_size=6, max_size=4 * 1024 * 1024,
+                 size=64 * 1024):
+        self.parse_head = parse_head
+        self.head_size = head_size
+        self.max_size = max_size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # 未解析数据的起始位置
+        self._end = 0    # 已接收数据的结束位置
+
+    @property
+    def pending(self):
+        """缓冲区中尚未取出的字节数"""
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """保证从 _start 开始有 size 字节的空间，必要时前移数据或扩容"""
+        if self._start + size <= len(self._buffer):
+            return
+        pending = self.pending
+        if size > len(self._buffer):
+            buffer = bytearray(max(size, len(self._buffer) * 2))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+    def get_buffer(self):
+        """返回可写入接收数据的内存区域"""
+        if self._end == len(self._buffer):
+            self._reserve(self.pending + 1)
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """通知已向 get_buffer 返回的区域写入了 nbytes 字节"""
+        self._end += nbytes
+
+    def _frame_size(self):
+        """返回缓冲区中第一个帧的总长度，帧头不完整时返回 None"""
+        if self.pending < self.head_size:
+            return None
+        head = self._buffer[self._start:self._start + self.head_size]
+        size = self.parse_head(head)
+        affirm(size <= self.max_size, "Frame too large: %s" % size)
+        return self.head_size + size
+
+    def has_frame(self):
+        """缓冲区中是否有完整的帧"""
+        size = self._frame_size()
+        return size is not None and self.pending >= size
+
+    def next_frame(self):
+        """取出一个完整帧的数据部分，数据不足时返回 None"""
+        size = self._frame_size()
+        if size is None:
+            return None
+        if self.pending < size:
+            self._reserve(size)
+            return None
+        start = self._start + self.head_size
+        self._start += size
+        frame = bytes(self._view[start:self._start])
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frame
+
+
+class Tunnel(object):
+    """隧道状态，每个隧道套接字一个实例"""
+
+    def __init__(self, cipher, reader):
+        self.cipher = cipher
+        self.reader = reader
+        self.large_frame = False
+        # 合并读取时遇到了结束帧，下次读取返回空字节串
+        self.fin = False
 
 
 class BaseClimbServer(Socks5Server):
-    """Climb over GFW(Great Fire Wall) server based on Socks"""
+    """Climb over GFW(Great Fire Wall) server based on Socks
+
+    本地服务器发送的目的地址信息中，首字节的低 4 位为地址类型，
+    高 4 位为请求的扩展特性，远程服务器在响应的第二个字节中返回接受的特性。
+    未请求任何特性时与旧版本的协议完全一致
+
+    数据为空的帧是结束帧，表示发送方的明文端已结束写方向(TCP 半关闭)，
+    旧版本的服务器收到后直接关闭连接
+    """
+
+    FEATURE_MASK = 0xF0
+    # 隧道存续期间使用同一个 zlib 上下文流式压缩
+    FEATURE_STREAM_COMPRESS = 0x80
+    # 第 2 版帧格式，帧头 8 字节，数据长度占 4 字节
+    FEATURE_LARGE_FRAME = 0x40
+    # 多路复用隧道，见 mux 模块，仅用于线程模式
+    FEATURE_MUX = 0x20
+    # UDP 隧道，每帧承载一批数据报，见 udp 模块，仅用于线程模式
+    FEATURE_UDP = 0x10
+
+    # 每帧加密前的数据长度上限，旧版帧格式需保证加密后不超过 2 字节的长度
+    SMALL_FRAME_DATA_SIZE = 60 * 1024
+    LARGE_FRAME_DATA_SIZE = 256 * 1024
+
+    # 数据交换各阶段的名称，plain 为与客户端或目的地址之间，tunnel 为隧道上
+    PROFILE_STAGES = ("select", "recv_plain", "recv_tunnel", "send_tunnel",
+                      "send_plain")
+
+    # 本端是否为隧道的发起方，两端的加密器据此区分帧的方向
+    TUNNEL_INITIATOR = False
+
+    def __init__(self, key, host="0.0.0.0", port=1080,
+                 compress_mode="always", compress_level=-1,
+                 stream_compress=False, large_frame=False,
+                 batch_size=256 * 1024, mux=0, profile_sample=0.0,
+                 cipher="mix", **kwargs):
+        # 加密器按名称从 crypt.CIPHERS 中选取，两端必须一致
+        self.cipher = create_cipher(cipher, key, compress_mode, compress_level)
+        self.features = 0
+        if stream_compress:
+            self.features |= self.FEATURE_STREAM_COMPRESS
+        if large_frame:
+            self.features |= self.FEATURE_LARGE_FRAME
+        if mux:
+            self.features |= self.FEATURE_MUX
+        # 发送前最多合并的已到达数据量
+        self.batch_size = batch_size
+        # 隧道套接字 -> 隧道状态
+        self._tunnels = weakref.WeakKeyDictionary()
+        # 按 profile_sample 的比例采样连接，统计数据交换各阶段的耗时
+        self.profiler = StageProfiler(profile_sample)
+        super().__init__(host, port, **kwargs)
+        if self.udp:
+            self.features |= self.FEATURE_UDP
+
+    def _get_tunnel(self, sock):
+        """返回隧道套接字对应的隧道状态，首次使用时创建"""
+        tunnel = self._tunnels.get(sock)
+        if tunnel is None:
+            reader = FrameReader(self._parse_frame_head)
+            cipher = self.cipher.create_tunnel(self.TUNNEL_INITIATOR)
+            tunnel = self._tunnels[sock] = Tunnel(cipher, reader)
+        return tunnel
+
+    def _setup_tunnel(self, sock, features):
+        """按协商好的扩展特性初始化隧道"""
+        tunnel = self._get_tunnel(sock)
+        if features & self.FEATURE_STREAM_COMPRESS:
+            tunnel.cipher = tunnel.cipher.create_stream()
+        if features & self.FEATURE_LARGE_FRAME:
+            tunnel.large_frame = True
+            tunnel.reader.head_size = 8
+
+    @staticmethod
+    def _parse_frame_head(head):
+        """从帧头中解析出数据长度，6 字节帧头长度占 2 字节，8 字节帧头占 4 字节"""
+        len_size = len(head) - 4
+        return (int.from_bytes(head[3:3 + len_size], byteorder="big")
+                if is_even(head[2]) else
+                int.from_bytes(head[4:4 + len_size], byteorder="big"))
+
+    def _pack_frame(self, data, tunnel=None):
+        """加密数据并加上帧头
+
+        帧头共 6 字节: 2 字节随机数 + 1 字节填充 + 2 字节长度 + 1 字节随机数，
+        填充字节为偶数时数据长度位于 [3:5]，为奇数时位于 [4:6]。
+        第 2 版帧格式的长度占 4 字节，帧头共 8 字节，布局相同
+        """
+        cipher = tunnel.cipher if tunnel else self.cipher
+        len_size = 4 if tunnel and tunnel.large_frame else 2
+        data = cipher.encrypt(data)
+        len_byte = len(data).to_bytes(len_size, "big")
+        len_pad = random.randint(0, 255)
+        len_data = (len_pad.to_bytes(1, "big") + len_byte + os.urandom(1)
+                    if is_even(len_pad) else
+                    len_pad.to_bytes(1, "big") + os.urandom(1) + len_byte)
+        return os.urandom(2) + len_data + data
+
+    def _pack_frames(self, data, tunnel):
+        """按隧道的帧格式将数据切分成若干帧并打包"""
+        size = (self.LARGE_FRAME_DATA_SIZE if tunnel.large_frame else
+                self.SMALL_FRAME_DATA_SIZE)
+        if len(data) <= size:
+            return self._pack_frame(data, tunnel)
+        data = memoryview(data)
+        return b''.join(self._pack_frame(data[i:i + size], tunnel)
+                        for i in range(0, len(data), size))
 
-    def __init__(self, key, host="0.0.0.0", port=1080):
-        self.cipher = MixCipher(key)
-        super().__init__(host, port)
+    def _relay_ops(self, tunnel_sock):
+        """返回数据交换各阶段使用的函数，顺序同 PROFILE_STAGES
+
+        被采样的连接返回记录耗时的版本，其隧道的加密器也替换为记录耗时的代理
+        """
+        ops = (wait_sockets, self.recv_batch_data, self.recv_encrypted_frames,
+               self.send_encrypted_data, self.send_data)
+        if not self.profiler.sample():
+            return ops
+        tunnel = self._get_tunnel(tunnel_sock)
+        tunnel.cipher = ProfiledCipher(tunnel.cipher, self.profiler)
+        return tuple(self.profiler.wrap(stage, op)
+                     for stage, op in zip(self.PROFILE_STAGES, ops))
+
+    def _async_relay_ops(self, tunnel_sock):
+        """_relay_ops 的 asyncio 版本，没有 select 阶段"""
+        ops = (self._async_recv_batch_data, self._async_recv_encrypted_frames,
+               self._async_send_encrypted_data, self._async_send_data)
+        if not self.profiler.sample():
+            return ops
+        tunnel = self._get_tunnel(tunnel_sock)
+        tunnel.cipher = ProfiledCipher(tunnel.cipher, self.profiler)
+        return tuple(self.profiler.wrap_async(stage, op)
+                     for stage, op in zip(self.PROFILE_STAGES[1:], ops))
+
+    def _create_tunnel_relay(self, sock, remote, tunnel_sock):
+        """创建隧道两端的 Relay，tunnel_sock 为 sock 和 remote 中的隧道套接字
+
+        明文端读取后打包成帧，隧道端读取后解密所有完整的帧，
+        握手时已读入的帧直接放入明文端的输出缓冲区。
+        Reactor 中的连接不参与分阶段耗时的采样
+        """
+        plain_key, tunnel_key = (("bytes_down", "bytes_up")
+                                 if tunnel_sock is sock else
+                                 ("bytes_up", "bytes_down"))
+        tunnel = self._get_tunnel(tunnel_sock)
+        reader = tunnel.reader
+        stats = self.stats
+        buffer_size = self.buffer_size
+
+        def decrypt_frames():
+            """返回 (解密的数据, 是否遇到了结束帧)"""
+            chunks = []
+            while reader.has_frame():
+                chunk = tunnel.cipher.decrypt(reader.next_frame())
+                if not chunk:
+                    return b''.join(chunks), True
+                chunks.append(chunk)
+            return b''.join(chunks), False
+
+        def read_plain(sock):
+            data = sock.recv(buffer_size)
+            if not data:
+                return b'', True
+            data = self._recv_pending_data(sock, data)
+            stats[plain_key] += len(data)
+            return self._pack_frames(data, tunnel), False
+
+        def read_tunnel(sock):
+            nbytes = sock.recv_into(reader.get_buffer())
+            if nbytes <= 0:
+                affirm(reader.pending == 0, "Connection closed within a frame")
+                return b'', True
+            reader.buffer_updated(nbytes)
+            data, fin = decrypt_frames()
+            stats[tunnel_key] += len(data)
+            return data, fin
+
+        def send_fin():
+            return self._pack_frame(b'', tunnel)
+
+        pending, fin = decrypt_frames()
+        if tunnel_sock is remote:
+            relay = Relay(sock, remote, read_plain, read_tunnel,
+                          (pending, b''), fins=(None, send_fin))
+        else:
+            relay = Relay(sock, remote, read_tunnel, read_plain,
+                          (b'', pending), fins=(send_fin, None))
+        relay.eof[tunnel_sock] = fin or tunnel.fin
+        return relay
+
+    def _recv_pending_data(self, sock, data):
+        """data 读满了缓冲区时，继续以非阻塞方式读取内核中已到达的数据并合并"""
+        if len(data) < self.buffer_size or not MSG_DONTWAIT:
+            return data
+        chunks = [data]
+        total = len(data)
+        while total < self.batch_size:
+            try:
+                chunk = sock.recv(min(self.buffer_size, self.batch_size - total),
+                                  MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+            if len(chunk) < self.buffer_size:
+                break
+        return b''.join(chunks)
+
+    def recv_batch_data(self, sock=None):
+        """读取待加密的数据，已到达的后续数据一并读出，以减少帧数和系统调用"""
+        sock = sock or self.sock
+        return self._recv_pending_data(sock, self.recv_data(sock))
+
+    async def _async_recv_batch_data(self, sock=None):
+        sock = sock or self.sock
+        data = await self._async_recv_data(sock)
+        return self._recv_pending_data(sock, data)
 
     def recv_encrypted_data(self, sock=None):
+        """接收并解密一个帧，对端关闭时返回空字节串"""
+        sock = sock or self.sock
+        tunnel = self._get_tunnel(sock)
+        reader = tunnel.reader
+        frame = reader.next_frame()
+        while frame is None:
+            nbytes = sock.recv_into(reader.get_buffer())
+            if nbytes <= 0:
+                affirm(reader.pending == 0, "Connection closed within a frame")
+                return b''
+            reader.buffer_updated(nbytes)
+            frame = reader.next_frame()
+        return tunnel.cipher.decrypt(frame)
+
+    def recv_encrypted_frames(self, sock=None):
+        """接收并解密一个帧，以及缓冲区中已完整接收的后续帧，返回合并的数据"""
         sock = sock or self.sock
-        head = self.recv_data(sock, 6)
-        self.log.debug(head)
-        if len(head) <= 0:
-            return head
-        data_len = (int.from_bytes(head[3:5], byteorder="big")
-                    if is_even(head[2]) else
-                    int.from_bytes(head[4:], byteorder="big"))
-        size = data_len
-        data = b''
-        while 1:
-            data += self.recv_data(sock, size)
-            recv_len = len(data)
-            if recv_len < data_len:
-                size = data_len - recv_len
-            elif recv_len == data_len:
+        tunnel = self._get_tunnel(sock)
+        if tunnel.fin:
+            return b''
+        reader = tunnel.reader
+        data = self.recv_encrypted_data(sock)
+        if not data or not reader.has_frame():
+            return data
+        chunks = [data]
+        while reader.has_frame():
+            chunk = self.recv_encrypted_data(sock)
+            if not chunk:
+                tunnel.fin = True
                 break
-            else:
-                raise Exception("received data is too long")
-        data = self.cipher.decrypt(data)
-        return data
+            chunks.append(chunk)
+        return b''.join(chunks)
 
     def send_encrypted_data(self, data, sock=None):
         sock = sock or self.sock
-        data = self.cipher.encrypt(data)
-        len_byte = len(data).to_bytes(2, "big")
-        len_pad = random.randint(0, 255)
-        len_data = (len_pad.to_bytes(1, "big") + len_byte + os.urandom(1)
-                    if is_even(len_pad) else
-                    len_byte + os.urandom(1) + len_pad.to_bytes(1, "big"))
-        data = os.urandom(2) + len_data + data
-        self.send_data(data, sock)
+        self.send_data(self._pack_frames(data, self._get_tunnel(sock)), sock)
+
+    def send_fin(self, sock):
+        """发送结束帧"""
+        self.send_encrypted_data(b'', sock)
+
+    async def _async_recv_encrypted_data(self, sock=None):
+        sock = sock or self.sock
+        loop = asyncio.get_running_loop()
+        tunnel = self._get_tunnel(sock)
+        reader = tunnel.reader
+        frame = reader.next_frame()
+        while frame is None:
+            nbytes = await loop.sock_recv_into(sock, reader.get_buffer())
+            if nbytes <= 0:
+                affirm(reader.pending == 0, "Connection closed within a frame")
+                return b''
+            reader.buffer_updated(nbytes)
+            frame = reader.next_frame()
+        return tunnel.cipher.decrypt(frame)
+
+    async def _async_recv_encrypted_frames(self, sock=None):
+        sock = sock or self.sock
+        tunnel = self._get_tunnel(sock)
+        if tunnel.fin:
+            return b''
+        reader = tunnel.reader
+        data = await self._async_recv_encrypted_data(sock)
+        if not data or not reader.has_frame():
+            return data
+        chunks = [data]
+        while reader.has_frame():
+            chunk = await self._async_recv_encrypted_data(sock)
+            if not chunk:
+                tunnel.fin = True
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    async def _async_send_encrypted_data(self, data, sock=None):
+        sock = sock or self.sock
+        data = self._pack_frames(data, self._get_tunnel(sock))
+        await self._async_send_data(data, sock)
+
+    async def _async_send_fin(self, sock):
+        await self._async_send_encrypted_data(b'', sock)
+
+    def _has_buffered_input(self, tunnel_sock):
+        """隧道的接收缓冲区中是否有尚未处理的完整帧或结束帧"""
+        tunnel = self._get_tunnel(tunnel_sock)
+        return tunnel.fin or tunnel.reader.has_frame()
 
 
 class LocalClimbServer(BaseClimbServer):
-    """穿墙代理本地服务器"""
+    """穿墙代理本地服务器
+
+    mux 大于 0 时，线程模式下的连接作为逻辑流复用最多 mux 个到远程服务器的隧道，
+    远程服务器不支持时退回到每个连接一个隧道
+
+    pool_size 大于 0 时在后台保持这么多个到远程服务器的空闲连接，
+    新的连接直接取用，只需发送目的地址信息，空闲超过 pool_ttl 秒的连接会被替换。
+    远程服务器在 handshake_timeout (默认 30 秒)内没有收到请求时关闭连接，
+    pool_ttl 需明显小于该值，见 pool.ConnectionPool
+
+    router 为 route.Router 时在响应请求之前按其规则决定每个连接直接连接、
+    经由隧道还是拒绝，为空时全部经由隧道。直接连接按 Socks5Server 的方式交换数据，
+    被拒绝的连接收到 CONNECTION_NOT_ALLOWED 响应
+    """
+
+    TUNNEL_INITIATOR = True
 
     def __init__(self, key, host="127.0.0.1", port=1080,
-                 server_host='0.0.0.0', server_port=8324):
-        super().__init__(key, host, port)
+                 server_host='0.0.0.0', server_port=8324, mux=0,
+                 pool_size=0, pool_ttl=10, router=None, **kwargs):
+        super().__init__(key, host, port, mux=mux, **kwargs)
         self.server_host = server_host
         self.server_port = server_port
+        self.router = router
+        # 直接连接目的地址的套接字
+        self._direct = weakref.WeakSet()
+        self.mux_pool = MuxPool(self, mux) if mux else None
+        self.pool = (ConnectionPool((server_host, server_port), pool_size,
+                                    pool_ttl, super()._connet_remote)
+                     if pool_size else None)
 
-    def _connet_remote(self, addr, port, addr_data=None):
+    def start(self):
+        if self.pool:
+            self.pool.start()
+        try:
+            super().start()
+        finally:
+            if self.pool:
+                self.pool.close()
+
+    def start_async(self):
+        if self.pool:
+            self.pool.start()
+        try:
+            super().start_async()
+        finally:
+            if self.pool:
+                self.pool.close()
+
+    def _connect_server(self):
+        """建立到远程服务器的连接，启用了连接池时优先取用池中的空闲连接"""
+        if self.pool is None:
+            return super()._connet_remote(self.server_host, self.server_port)
+        start = time.perf_counter()
+        remote = (self.pool.get() or
+                  super()._connet_remote(self.server_host, self.server_port))
+        self.pool.stats["wait_time"] += time.perf_counter() - start
+        return remote
+
+    async def _async_connect_server(self):
+        if self.pool is None:
+            return await super()._async_connet_remote(self.server_host,
+                                                      self.server_port)
+        start = time.perf_counter()
+        remote = self.pool.get()
+        if remote is None:
+            remote = await super()._async_connet_remote(self.server_host,
+                                                        self.server_port)
+        else:
+            remote.setblocking(False)
+        self.pool.stats["wait_time"] += time.perf_counter() - start
+        return remote
+
+    def _make_request(self, addr_data):
+        """在目的地址信息的首字节中加入请求的扩展特性"""
+        features = self.features & ~(self.FEATURE_MUX | self.FEATURE_UDP)
+        return bytes((addr_data[0] | features,)) + addr_data[1:]
+
+    def _check_reply(self, remote, data):
+        """检查远程服务器的响应，并按其接受的扩展特性初始化隧道"""
+        affirm(data and data[0] == 0, "Remote server connection refused")
+        if self.features:
+            self._setup_tunnel(remote, data[1] & self.features)
+
+    def _open_mux_tunnel(self):
+        """建立一个多路复用隧道，远程服务器不接受时返回 None
+
+        请求中只有扩展特性而没有地址类型，不支持多路复用的远程服务器会按
+        不支持的地址类型拒绝
+        """
         remote = super()._connet_remote(self.server_host, self.server_port)
-        self.send_encrypted_data(data=addr_data, sock=remote)
-        data = self.recv_encrypted_data(sock=remote)
-        affirm(data[0] == 0, "Remote server connection refused")
+        try:
+            request = (bytes((self.features,)) +
+                       os.urandom(random.randint(16, 32)))
+            self.send_encrypted_data(data=request, sock=remote)
+            data = self.recv_encrypted_data(sock=remote)
+            if not (data and data[0] == 0 and data[1] & self.FEATURE_MUX):
+                remote.close()
+                return None
+            self._setup_tunnel(remote, data[1] & self.features)
+        except Exception:
+            remote.close()
+            raise
+        self.log.info("Mux tunnel to %s:%s opened",
+                      self.server_host, self.server_port)
+        return MuxTunnel(self, remote)
+
+    def _open_udp_upstream(self):
+        """建立一个 UDP 隧道，远程服务器不接受时抛出异常
+
+        与多路复用隧道一样，请求中只有扩展特性而没有地址类型
+        """
+        remote = self._connect_server()
+        try:
+            features = self.features & ~self.FEATURE_MUX
+            request = bytes((features,)) + os.urandom(random.randint(16, 32))
+            self.send_encrypted_data(data=request, sock=remote)
+            data = self.recv_encrypted_data(sock=remote)
+            affirm(data and data[0] == 0 and data[1] & self.FEATURE_UDP,
+                   "Remote server refused UDP association")
+            self._setup_tunnel(remote, data[1] & self.features)
+        except Exception:
+            remote.close()
+            raise
+        return TunnelEnd(self, remote, owner=True)
+
+    def _route(self, addr, port):
+        """返回目的地址的处理方式，需要解析域名时使用服务器的解析缓存"""
+        action = self.router.route(addr)
+        if action is None:
+            try:
+                ip = self.resolver.resolve(addr, port)[0][4][0]
+            except (OSError, IndexError):
+                ip = None
+            action = self.router.route_resolved(addr, ip)
+        return action
+
+    async def _async_route(self, addr, port):
+        action = self.router.route(addr)
+        if action is None:
+            try:
+                infos = await self.resolver.async_resolve(addr, port)
+                ip = infos[0][4][0]
+            except (OSError, IndexError):
+                ip = None
+            action = self.router.route_resolved(addr, ip)
+        return action
+
+    def _upstream(self, action, connect_direct, connect_tunnel):
+        """按处理方式返回连接函数，拒绝连接时返回 None"""
+        if action == "block":
+            return None
+        return connect_direct if action == "direct" else connect_tunnel
+
+    def _select_upstream(self, addr, port):
+        if self.router is None:
+            return self._connet_remote
+        return self._upstream(self._route(addr, port), self._connect_direct,
+                              self._connet_remote)
+
+    async def _async_select_upstream(self, addr, port):
+        if self.router is None:
+            return self._async_connet_remote
+        return self._upstream(await self._async_route(addr, port),
+                              self._async_connect_direct,
+                              self._async_connet_remote)
+
+    def _connect_direct(self, addr, port, addr_data=None):
+        """不经过远程服务器，直接连接目的地址"""
+        remote = super()._connet_remote(addr, port)
+        self._direct.add(remote)
+        return remote
+
+    async def _async_connect_direct(self, addr, port, addr_data=None):
+        remote = await super()._async_connet_remote(addr, port)
+        self._direct.add(remote)
+        return remote
+
+    def _connet_remote(self, addr, port, addr_data=None):
+        if self.mux_pool and not self.mux_pool.refused:
+            stream = self.mux_pool.open_stream(addr_data)
+            if stream is not None:
+                return stream
+        remote = self._connect_server()
+        try:
+            self.send_encrypted_data(data=self._make_request(addr_data),
+                                     sock=remote)
+            data = self.recv_encrypted_data(sock=remote)
+            self._check_reply(remote, data)
+        except Exception:
+            remote.close()
+            raise
         return remote
 
     def _transfer_stream(self, sock, remote):
         """客户端和远程目的地址之间的数据流交换"""
+        if remote in self._direct:
+            return Socks5Server._transfer_stream(self, sock, remote)
+        if isinstance(remote, MuxStream):
+            return remote.relay(sock, self.buffer_size, self.stats,
+                                session=self._get_session(sock))
+
         fdset = [sock, remote]
-        while True:
-            readset, writeset, exceptset = select.select(fdset, [], [])
+        stats = self.stats
+        session = self._get_session(sock)
+        (wait, recv_plain, recv_tunnel,
+         send_tunnel, send_plain) = self._relay_ops(remote)
+        while fdset:
+            # 握手时可能已经读入了完整的数据帧，先处理缓冲区中的帧
+            if remote in fdset and self._has_buffered_input(remote):
+                readset = [remote]
+            else:
+                readset = wait(fdset)
 
             if sock in readset:
-                data = self.recv_data(sock)
+                data = recv_plain(sock)
                 if len(data) <= 0:
-                    break
-                self.send_encrypted_data(data, remote)
+                    fdset.remove(sock)
+                    self.send_fin(remote)
+                else:
+                    session.touch()
+                    stats["bytes_up"] += len(data)
+                    send_tunnel(data, remote)
 
             if remote in readset:
-                data = self.recv_encrypted_data(remote)
+                data = recv_tunnel(remote)
                 if len(data) <= 0:
-                    break
-                self.send_data(data, sock)
+                    fdset.remove(remote)
+                    shutdown_write(sock)
+                else:
+                    session.touch()
+                    stats["bytes_down"] += len(data)
+                    send_plain(data, sock)
+
+    def _send_early_data(self, remote, data):
+        if remote in self._direct:
+            return Socks5Server._send_early_data(self, remote, data)
+        self.stats["bytes_up"] += len(data)
+        if isinstance(remote, MuxStream):
+            remote.send(data)
+        else:
+            self.send_encrypted_data(data, remote)
+
+    async def _async_send_early_data(self, remote, data):
+        if remote in self._direct:
+            return await Socks5Server._async_send_early_data(self, remote,
+                                                             data)
+        self.stats["bytes_up"] += len(data)
+        await self._async_send_encrypted_data(data, remote)
+
+    def _create_relay(self, sock, remote):
+        if remote in self._direct:
+            return Socks5Server._create_relay(self, sock, remote)
+        if isinstance(remote, MuxStream):
+            return None
+        return self._create_tunnel_relay(sock, remote, remote)
+
+    async def _async_connet_remote(self, addr, port, addr_data=None):
+        remote = await self._async_connect_server()
+        try:
+            await self._async_send_encrypted_data(
+                data=self._make_request(addr_data), sock=remote)
+            data = await self._async_recv_encrypted_data(sock=remote)
+            self._check_reply(remote, data)
+        except Exception:
+            remote.close()
+            raise
+        return remote
+
+    async def _async_transfer_stream(self, sock, remote):
+        if remote in self._direct:
+            return await Socks5Server._async_transfer_stream(self, sock, remote)
+        session = self._get_session(sock)
+        (recv_plain, recv_tunnel,
+         send_tunnel, send_plain) = self._async_relay_ops(remote)
+        await self._async_relay(
+            self._async_pipe(sock, remote, recv_plain, send_tunnel, "bytes_up",
+                             session, self._async_send_fin),
+            self._async_pipe(remote, sock, recv_tunnel, send_plain,
+                             "bytes_down", session),
+        )
 
 
 class RemoteClimbServer(BaseClimbServer):
     """穿墙代理远程服务器"""
 
-    def __init__(self, key, host="0.0.0.0", port=8324):
-        super().__init__(key, host, port)
+    def __init__(self, key, host="0.0.0.0", port=8324, **kwargs):
+        super().__init__(key, host, port, **kwargs)
 
     def _check_auth(self, sock):
         pass
 
-    def _handle_request(self, sock, addr):
-        data = self.recv_encrypted_data(sock=sock)
-        addr_type = data[0]
+    @staticmethod
+    def _unpack_addr_data(data):
+        """解析本地服务器发来的目的地址信息，返回 (地址, 端口)
+
+        地址类型不支持时返回 None
+        """
+        addr_type = data[0] & 0x0F
         if addr_type == 1:
             # IPv4 地址，目的地址为 4 字节长度
             remote_addr = socket.inet_ntoa(data[1:5])
         elif addr_type == 3:
             # 域名，第一个字节为域名长度，剩余的内容为域名
             addr_len = data[1]
-            remote_addr = data[2:addr_len+2]
+            remote_addr = data[2:addr_len+2].decode("utf-8")
         elif addr_type == 4:
             # IPv6 地址，目的地址为 16 个字节长度
             remote_addr = socket.inet_ntop(socket.AF_INET6, data[1:17])
         else:
-            # 不支持的地址类型
-            reply = b'\x01' + os.urandom(random.randint(16, 32))
-            self.send_encrypted_data(data=reply, sock=sock)
-            raise Exception("Address type not supported: '%#x'" % addr_type)
-        remote_addr = remote_addr.decode("utf-8")
+            return None
 
         # 获取目的地址端口号，2 字节长度
         remote_port = struct.unpack('>H', data[-2:])[0]
+        return remote_addr, remote_port
+
+    def _make_reply(self, features):
+        """生成成功响应，本地服务器请求了扩展特性时第二个字节为接受的特性"""
+        if not features:
+            return b'\x00' + os.urandom(random.randint(16, 32))
+        return (b'\x00' + bytes((features & self.features,)) +
+                os.urandom(random.randint(15, 31)))
+
+    def _open_mux_stream(self, stream, addr_data):
+        """在新线程中连接多路复用流的目的地址并交换数据"""
+        Thread(target=self._serve_mux_stream, args=(stream, addr_data),
+               daemon=True).start()
+
+    def _serve_mux_stream(self, stream, addr_data):
+        """连接流的目的地址并交换数据
+
+        每个流登记为一个会话，空闲和存续时间超时按流回收，
+        隧道上其他流的数据不会使空闲的流一直存留
+        """
+        remote = None
+        session = self.sweeper.register(stream)
+        try:
+            addr = self._unpack_addr_data(addr_data)
+            affirm(addr, "Address type not supported: '%#x'" % addr_data[0])
+            self.log.info("Connecting %s:%s in mux stream %s",
+                          addr[0], addr[1], stream.id)
+            remote = self._connet_remote(*addr)
+            session.add(remote)
+            session.handshaking = False
+            session.touch()
+            stream.relay(remote, self.buffer_size, self.stats,
+                         ("bytes_down", "bytes_up"), session)
+        except Exception as e:
+            if not session.reclaimed:
+                self.log.warning(e)
+        finally:
+            self.sweeper.unregister(stream)
+            stream.close()
+            if remote:
+                remote.close()
+
+    def _handle_request(self, sock, addr, handshake=None):
+        data = self.recv_encrypted_data(sock=sock)
+        affirm(data, "No request information")
+        features = data[0] & self.FEATURE_MASK
+        if features & self.features & self.FEATURE_MUX:
+            # 多路复用隧道，目的地址在各个流的 OPEN 帧中
+            self.send_encrypted_data(data=self._make_reply(features), sock=sock)
+            self._setup_tunnel(sock, features & self.features)
+            self.log.info("Mux tunnel from %s:%s", *addr[:2])
+            return MuxTunnel(self, sock, on_open=self._open_mux_stream)
+        if features & self.features & self.FEATURE_UDP:
+            # UDP 隧道，目的地址在每个数据报中
+            self.send_encrypted_data(data=self._make_reply(features), sock=sock)
+            self._setup_tunnel(sock, features & self.features)
+            self.stats["udp_associations"] += 1
+            self.log.info("UDP tunnel from %s:%s", *addr[:2])
+            return UdpAssociation(TunnelEnd(self, sock),
+                                  DirectEnd(self.resolver, self.stats,
+                                            self.udp_timeout),
+                                  self.stats)
+
+        remote = self._unpack_addr_data(data)
+        if remote is None:
+            # 不支持的地址类型
+            reply = b'\x01' + os.urandom(random.randint(16, 32))
+            self.send_encrypted_data(data=reply, sock=sock)
+            raise Exception("Address type not supported: '%#x'" % data[0])
+        remote_addr, remote_port = remote
 
         # 响应客户端的请求 SUCCESS
-        reply = b'\x00' + os.urandom(random.randint(16, 32))
-        self.send_encrypted_data(data=reply, sock=sock)
+        self.send_encrypted_data(data=self._make_reply(features), sock=sock)
+        self._setup_tunnel(sock, features & self.features)
 
         # 尝试连接远程服务器，准备传输数据
         self.log.info("Connecting %s:%s from %s:%s",
                       remote_addr, remote_port, *addr)
         return self._connet_remote(remote_addr, remote_port)
 
+    async def _async_check_auth(self, sock):
+        pass
+
+    async def _async_handle_request(self, sock, addr, handshake=None):
+        data = await self._async_recv_encrypted_data(sock=sock)
+        affirm(data, "No request information")
+        remote = self._unpack_addr_data(data)
+        if remote is None:
+            reply = b'\x01' + os.urandom(random.randint(16, 32))
+            await self._async_send_encrypted_data(data=reply, sock=sock)
+            raise Exception("Address type not supported: '%#x'" % data[0])
+        remote_addr, remote_port = remote
+
+        features = data[0] & self.FEATURE_MASK
+        await self._async_send_encrypted_data(data=self._make_reply(features),
+                                              sock=sock)
+        self._setup_tunnel(sock, features & self.features)
+
+        self.log.info("Connecting %s:%s from %s:%s",
+                      remote_addr, remote_port, *addr[:2])
+        return await self._async_connet_remote(remote_addr, remote_port)
+
     def _transfer_stream(self, sock, remote):
         """客户端和远程目的地址之间的数据流交换"""
+        if isinstance(remote, MuxTunnel):
+            remote.session = self._get_session(sock)
+            return remote.run()
+
         fdset = [sock, remote]
-        while True:
-            readset, writeset, exceptset = select.select(fdset, [], [])
+        stats = self.stats
+        session = self._get_session(sock)
+        (wait, recv_plain, recv_tunnel,
+         send_tunnel, send_plain) = self._relay_ops(sock)
+        while fdset:
+            if sock in fdset and self._has_buffered_input(sock):
+                readset = [sock]
+            else:
+                readset = wait(fdset)
 
             if sock in readset:
-                data = self.recv_encrypted_data(sock)
+                data = recv_tunnel(sock)
                 if len(data) <= 0:
-                    break
-                self.send_data(data, remote)
+                    fdset.remove(sock)
+                    shutdown_write(remote)
+                else:
+                    session.touch()
+                    stats["bytes_up"] += len(data)
+                    send_plain(data, remote)
 
             if remote in readset:
-                data = self.recv_data(remote)
+                data = recv_plain(remote)
                 if len(data) <= 0:
-                    break
-                self.send_encrypted_data(data, sock)
+                    fdset.remove(remote)
+                    self.send_fin(sock)
+                else:
+                    session.touch()
+                    stats["bytes_down"] += len(data)
+                    send_tunnel(data, sock)
+
+    def _create_relay(self, sock, remote):
+        if isinstance(remote, MuxTunnel):
+            return None
+        return self._create_tunnel_relay(sock, remote, sock)
+
+    async def _async_transfer_stream(self, sock, remote):
+        session = self._get_session(sock)
+        (recv_plain, recv_tunnel,
+         send_tunnel, send_plain) = self._async_relay_ops(sock)
+        await self._async_relay(
+            self._async_pipe(sock, remote, recv_tunnel, send_plain, "bytes_up",
+                             session),
+            self._async_pipe(remote, sock, recv_plain, send_tunnel,
+                             "bytes_down", session, self._async_send_fin),
+        )
@@ -15,12 +15,171 @@ from argparse import ArgumentParser
 
 from .__init__ import __version__ as version
 from .log import setup_logging
+from .sockopt import SocketOptions
+from .crypt import CIPHERS
 
 
 def create_argument(parser, *args, **kwargs):
     parser.add_argument(*args, **kwargs)
 
 
+def create_server_arguments(parser):
+    """socks 和 climb 命令共用的服务器参数"""
+    group = parser.add_argument_group('server arguments')
+    create_argument(group, "--engine", default="thread",
+                    choices=["thread", "asyncio"],
+                    help="Serving engine, one thread per connection or "
+                         "a single asyncio event loop (default: thread)")
+    create_argument(group, "--buffer-size", default=10 * 1024, type=int,
+                    help="Bytes read from a socket at a time (default: 10240)")
+    create_argument(group, "--backlog", default=128, type=int,
+                    help="Listen backlog of the server socket (default: 128)")
+    create_argument(group, "--max-sessions", default=0, type=int,
+                    help="Max concurrent sessions, handled by a thread pool "
+                         "of this size in thread engine (default: 0, no limit)")
+    create_argument(group, "--overflow", default="queue",
+                    choices=["queue", "reject", "block"],
+                    help="What to do with new connections when max sessions "
+                         "is reached (default: queue)")
+    create_argument(group, "--queue-size", default=128, type=int,
+                    help="Max connections waiting for a free session in "
+                         "queue overflow mode (default: 128)")
+    create_argument(group, "--workers", default=0, type=int,
+                    help="Number of worker processes, 0 serves in the main "
+                         "process (default: 0)")
+    create_argument(group, "--reuse-port", action="store_true",
+                    help="Let each worker listen on the port with SO_REUSEPORT "
+                         "instead of sharing one listening socket")
+    create_argument(group, "--dns-cache-size", default=1024, type=int,
+                    help="Max resolved hostnames kept in cache, 0 disables "
+                         "the cache (default: 1024)")
+    create_argument(group, "--dns-ttl", default=60, type=float,
+                    help="Seconds a resolved hostname is cached (default: 60)")
+    create_argument(group, "--dns-negative-ttl", default=5, type=float,
+                    help="Seconds a failed lookup is cached (default: 5)")
+    create_argument(group, "--connect-timeout", default=10, type=float,
+                    help="Seconds to wait for an upstream connection "
+                         "(default: 10)")
+    create_argument(group, "--happy-eyeballs-delay", default=0.25, type=float,
+                    help="Seconds before trying the next address of a host "
+                         "in parallel (default: 0.25)")
+    create_argument(group, "--idle-timeout", default=300, type=float,
+                    help="Seconds without data before a session is closed, "
+                         "0 for no limit (default: 300)")
+    create_argument(group, "--handshake-timeout", default=30, type=float,
+                    help="Seconds allowed to finish the handshake, "
+                         "0 for no limit (default: 30)")
+    create_argument(group, "--session-lifetime", default=0, type=float,
+                    help="Seconds after which any session is closed "
+                         "(default: 0, no limit)")
+    create_argument(group, "--relay-threads", default=0, type=int,
+                    help="Threads relaying established connections with "
+                         "epoll in thread engine, 0 relays each connection in "
+                         "its own thread (default: 0)")
+    create_argument(group, "--relay-buffer-size", default=256 * 1024, type=int,
+                    help="Bytes buffered per direction before the reactor "
+                         "stops reading the sending side (default: 262144)")
+    create_argument(group, "--relay-memory-limit", default=64 * 1024 * 1024,
+                    type=int,
+                    help="Bytes buffered across all reactor connections "
+                         "before busy ones are paused, 0 for no limit "
+                         "(default: 67108864)")
+    create_argument(group, "--udp", action="store_true",
+                    help="Support UDP ASSOCIATE in thread engine, a climb "
+                         "server also accepts UDP tunnels")
+    create_argument(group, "--udp-timeout", default=60, type=float,
+                    help="Seconds an UDP destination may reply after the "
+                         "last datagram sent to it (default: 60)")
+    create_argument(group, "--no-nodelay", dest="nodelay",
+                    action="store_false",
+                    help="Keep Nagle's algorithm on client and upstream "
+                         "connections")
+    create_argument(group, "--sndbuf", default=0, type=int,
+                    help="Socket send buffer bytes, 0 for the system default "
+                         "(default: 0)")
+    create_argument(group, "--rcvbuf", default=0, type=int,
+                    help="Socket receive buffer bytes, 0 for the system "
+                         "default (default: 0)")
+    create_argument(group, "--keepalive", default=0, type=float,
+                    help="Seconds a connection is idle before TCP keepalive "
+                         "probes are sent, 0 disables keepalive (default: 0)")
+    create_argument(group, "--keepalive-interval", default=10, type=float,
+                    help="Seconds between keepalive probes (default: 10)")
+    create_argument(group, "--keepalive-count", default=3, type=int,
+                    help="Unanswered keepalive probes before the connection "
+                         "is dropped (default: 3)")
+    create_argument(group, "--fastopen", default=0, type=int,
+                    help="Enable TCP Fast Open with this listen queue length, "
+                         "also used on upstream connections (default: 0)")
+    create_argument(group, "--notsent-lowat", default=0, type=int,
+                    help="TCP_NOTSENT_LOWAT bytes, 0 for the system default "
+                         "(default: 0)")
+    create_argument(group, "--autotune-rate", default=0, type=int,
+                    help="Size buffers of each connection to this many "
+                         "bytes per second times the measured RTT, "
+                         "0 disables (default: 0)")
+    create_argument(group, "--autotune-max", default=16 * 1024 * 1024,
+                    type=int,
+                    help="Max buffer bytes set by autotuning "
+                         "(default: 16777216)")
+    create_argument(group, "--log-format", default="text",
+                    choices=["text", "json"],
+                    help="Log line format, json writes one object per line "
+                         "(default: text)")
+    create_argument(group, "--log-queue", default=0, type=int,
+                    help="Hand log records to a background writer through a "
+                         "queue of this size, records are dropped when it is "
+                         "full (default: 0, write synchronously)")
+    create_argument(group, "--log-rate-limit", default=0, type=float,
+                    help="Max info and debug records per second for each "
+                         "message, 0 for no limit (default: 0)")
+    create_argument(group, "--metrics-port", default=0, type=int,
+                    help="Serve metrics in Prometheus text format on this "
+                         "port, worker N uses port + N (default: 0, disabled)")
+    create_argument(group, "--metrics-host", default="127.0.0.1",
+                    help="Hostname the metrics are served on "
+                         "(default: 127.0.0.1)")
+    create_argument(group, "--profile-dir",
+                    help="On SIGUSR1 sample all thread stacks and write a "
+                         "flamegraph folded profile here")
+    create_argument(group, "--profile-duration", default=10, type=float,
+                    help="Seconds sampled after SIGUSR1 (default: 10)")
+
+
+def server_options(args):
+    """由命令行参数生成 Socks5Server 的参数"""
+    return dict(buffer_size=args.buffer_size,
+                backlog=args.backlog,
+                max_sessions=args.max_sessions or None,
+                overflow=args.overflow,
+                queue_size=args.queue_size,
+                reuse_port=args.reuse_port,
+                dns_cache_size=args.dns_cache_size,
+                dns_ttl=args.dns_ttl,
+                dns_negative_ttl=args.dns_negative_ttl,
+                connect_timeout=args.connect_timeout,
+                happy_eyeballs_delay=args.happy_eyeballs_delay,
+                relay_threads=args.relay_threads,
+                relay_buffer_size=args.relay_buffer_size,
+                relay_memory_limit=args.relay_memory_limit,
+                idle_timeout=args.idle_timeout,
+                handshake_timeout=args.handshake_timeout,
+                session_lifetime=args.session_lifetime,
+                udp=args.udp,
+                udp_timeout=args.udp_timeout,
+                socket_options=SocketOptions(
+                    nodelay=args.nodelay,
+                    sndbuf=args.sndbuf,
+                    rcvbuf=args.rcvbuf,
+                    keepalive=args.keepalive,
+                    keepalive_interval=args.keepalive_interval,
+                    keepalive_count=args.keepalive_count,
+                    fastopen=args.fastopen,
+                    notsent_lowat=args.notsent_lowat,
+                    autotune_rate=args.autotune_rate,
+                    autotune_max=args.autotune_max))
+
+
 def parse_arguments():
     parser = ArgumentParser(description="Phankom is a proxy tool",
                             epilog="Use 'phankom COMMAND --help' for more "
@@ -34,8 +193,9 @@ def parse_arguments():
                     help="Log level (default: info)")
     create_argument(parser_socks, "-H", "--host", default="0.0.0.0",
                     help="hostname to listen on (default: 0.0.0.0)")
-    create_argument(parser_socks, "-p", "--port", default=1080,
+    create_argument(parser_socks, "-p", "--port", default=1080, type=int,
                     help="port of the server (default: 1080)")
+    create_server_arguments(parser_socks)
 
     parser_climb = subparsers.add_parser("climb", help="Climb over the GFW")
     create_argument(parser_climb, "--loglevel", default="info",
@@ -50,15 +210,121 @@ def parse_arguments():
     create_argument(parser_climb, "-H", "--host",
                     help="Hostname to listen on"
                          "(clinet default: 127.0.0.1, server default: 0.0.0.0)")
-    create_argument(parser_climb, "-p", "--port",
+    create_argument(parser_climb, "-p", "--port", type=int,
                     help="Port of the server"
                          "(clinet default: 1080, server default: 8324)")
+    create_server_arguments(parser_climb)
+
+    create_argument(parser_climb, "--cipher", default="mix",
+                    choices=list(CIPHERS),
+                    help="Tunnel cipher, must match on client and server, "
+                         "the AEAD ciphers require the cryptography package "
+                         "(default: mix)")
+    create_argument(parser_climb, "--compress", default="always",
+                    choices=["always", "never", "adaptive"],
+                    help="Compression policy, 'never' and 'adaptive' require "
+                         "the peer to support stored frames (default: always)")
+    create_argument(parser_climb, "--compress-level", default=-1, type=int,
+                    choices=range(-1, 10), metavar="{-1..9}",
+                    help="zlib compression level (default: -1)")
+    create_argument(parser_climb, "--stream-compress", action="store_true",
+                    help="Keep one zlib stream per tunnel, used only when "
+                         "enabled on both client and server")
+    create_argument(parser_climb, "--large-frame", action="store_true",
+                    help="Use frames with 4 bytes length, used only when "
+                         "enabled on both client and server")
+    create_argument(parser_climb, "--batch-size", default=256 * 1024, type=int,
+                    help="Max bytes of already arrived data gathered into "
+                         "one send (default: 262144)")
+    create_argument(parser_climb, "--profile-sample", default=0.0, type=float,
+                    help="Fraction of connections whose relay stages are "
+                         "timed, written with --profile-dir (default: 0)")
+    create_argument(parser_climb, "--mux", default=0, type=int,
+                    help="Carry connections as streams over this many "
+                         "persistent tunnels (client), or accept such tunnels "
+                         "when greater than 0 (server); thread engine only "
+                         "(default: 0)")
 
     parser_climb_client_group = parser_climb.add_argument_group('client arguments')
     create_argument(parser_climb_client_group, "--server-host", default="127.0.0.1",
                     help="Remote server hostname (default: 127.0.0.1)")
     create_argument(parser_climb_client_group, "--server-port", default=8324,
+                    type=int,
                     help="Remote server port (default: 8324)")
+    create_argument(parser_climb_client_group, "--pool-size", default=0,
+                    type=int,
+                    help="Idle connections to the remote server kept open "
+                         "in advance (default: 0, disabled)")
+    create_argument(parser_climb_client_group, "--pool-ttl", default=10,
+                    type=float,
+                    help="Seconds an idle pooled connection is kept, must be "
+                         "well below the remote server's --handshake-timeout "
+                         "(default: 10)")
+    for action, help_ in (("direct", "connected directly"),
+                          ("tunnel", "sent through the remote server"),
+                          ("block", "refused")):
+        create_argument(parser_climb_client_group, "--%s-rules" % action,
+                        action="append", default=[], metavar="FILE",
+                        help="File of domains and CIDRs, one per line, whose "
+                             "connections are %s; may be repeated, reloaded "
+                             "on SIGHUP" % help_)
+    create_argument(parser_climb_client_group, "--direct-private",
+                    action="store_true",
+                    help="Connect directly to localhost and private networks")
+    create_argument(parser_climb_client_group, "--route-default",
+                    default="tunnel", choices=["direct", "tunnel", "block"],
+                    help="Action of destinations matching no rule "
+                         "(default: tunnel)")
+    create_argument(parser_climb_client_group, "--route-resolve",
+                    action="store_true",
+                    help="Resolve domains matching no domain rule locally "
+                         "and route them by the CIDR rules")
+    create_argument(parser_climb_client_group, "--route-cache-size",
+                    default=4096, type=int,
+                    help="Route decisions cached (default: 4096)")
+
+    parser_bench = subparsers.add_parser(
+        "bench", help="Benchmark a proxy on loopback",
+        description="Run a proxy and an echo server on loopback, drive "
+                    "concurrent clients through it and print the results "
+                    "as JSON")
+    create_argument(parser_bench, "--target", default="socks",
+                    choices=["socks", "climb"],
+                    help="Proxy to benchmark, climb runs a local and a remote "
+                         "server chain (default: socks)")
+    create_argument(parser_bench, "--engine", default="thread",
+                    choices=["thread", "asyncio"],
+                    help="Serving engine of the proxy (default: thread)")
+    create_argument(parser_bench, "--clients", default=8, type=int,
+                    help="Concurrent clients (default: 8)")
+    create_argument(parser_bench, "--connections", default=200, type=int,
+                    help="Connections made for each payload size "
+                         "(default: 200)")
+    create_argument(parser_bench, "--sizes", default=[1024, 1024 * 1024],
+                    type=lambda value: [int(size) for size in value.split(",")],
+                    help="Comma separated bytes echoed per connection "
+                         "(default: 1024,1048576)")
+    create_argument(parser_bench, "--data", default="text",
+                    choices=["text", "random"],
+                    help="Payload content (default: text)")
+    create_argument(parser_bench, "--buffer-size", default=0, type=int,
+                    help="Buffer size of the proxy (default: server default)")
+    create_argument(parser_bench, "--relay-threads", default=0, type=int,
+                    help="Reactor relay threads of the proxy in thread engine "
+                         "(default: 0, disabled)")
+    create_argument(parser_bench, "--ciphers", default=["mix"],
+                    type=lambda value: value.split(","),
+                    help="Comma separated climb ciphers, each benchmarked in "
+                         "turn, 'all' for every installed one (default: mix)")
+    create_argument(parser_bench, "--compress", default="always",
+                    choices=["always", "never", "adaptive"],
+                    help="Compression policy of climb (default: always)")
+    create_argument(parser_bench, "--stream-compress", action="store_true",
+                    help="Enable stream compression of climb")
+    create_argument(parser_bench, "--large-frame", action="store_true",
+                    help="Enable large frames of climb")
+    create_argument(parser_bench, "-o", "--output",
+                    help="Write the JSON report to this file instead of stdout")
 
     parser_http = subparsers.add_parser("http", help="Climb over the GFW")
     create_argument(parser_http, "--loglevel", default="info",
@@ -68,28 +334,87 @@ def parse_arguments():
     return parser.parse_args()
 
 
+def create_router(args):
+    """由命令行参数生成分流路由，未指定任何规则时返回 None"""
+    files = [(action, path) for action in ("tunnel", "direct", "block")
+             for path in getattr(args, action + "_rules")]
+    if not (files or args.direct_private or args.route_default != "tunnel"):
+        return None
+    from .route import Router
+    return Router(files=files, default=args.route_default,
+                  resolve=args.route_resolve,
+                  cache_size=args.route_cache_size,
+                  direct_private=args.direct_private)
+
+
+def start_server(server, args):
+    def run(server):
+        router = getattr(server, "router", None)
+        if router is not None and router.files:
+            from .route import install_reload_handler
+            install_reload_handler(router)
+        if args.profile_dir:
+            from .profiling import install_signal_handler
+            install_signal_handler(server, args.profile_dir,
+                                   args.profile_duration)
+        if args.metrics_port:
+            from .metrics import MetricsServer
+            MetricsServer(server, args.metrics_host,
+                          args.metrics_port + server.worker_id).start()
+        if args.engine == "asyncio":
+            server.start_async()
+        else:
+            server.start()
+
+    if args.workers > 0:
+        from .supervisor import Supervisor
+        Supervisor(server, run, args.workers).start()
+    else:
+        run(server)
+
+
 def main():
     args = parse_arguments()
 
-    setup_logging()
+    if args.subparser == "bench":
+        from .bench import run
+        run(args)
+        return
+
+    # http 命令没有日志相关的参数
+    setup_logging(queue_size=getattr(args, "log_queue", 0),
+                  json_format=getattr(args, "log_format", "text") == "json",
+                  rate_limit=getattr(args, "log_rate_limit", 0))
     logging.getLogger().setLevel(getattr(logging, args.loglevel.upper()))
 
     if args.subparser == "socks":
         from .socks import Socks5Server
-        ss = Socks5Server(args.host, args.port)
-        ss.start()
+        ss = Socks5Server(args.host, args.port, **server_options(args))
+        start_server(ss, args)
     elif args.subparser == "climb":
         from .climb import LocalClimbServer, RemoteClimbServer
+        options = server_options(args)
+        options.update(compress_mode=args.compress,
+                       compress_level=args.compress_level,
+                       stream_compress=args.stream_compress,
+                       large_frame=args.large_frame,
+                       batch_size=args.batch_size,
+                       mux=args.mux,
+                       profile_sample=args.profile_sample,
+                       cipher=args.cipher)
         if args.server:
             args.host = args.host or "0.0.0.0"
             args.port = args.port or 8324
-            rcs = RemoteClimbServer(args.key, args.host, args.port)
-            rcs.start()
+            rcs = RemoteClimbServer(args.key, args.host, args.port, **options)
+            start_server(rcs, args)
         else:
             args.host = args.host or "127.0.0.1"
             args.port = args.port or 1080
             lcs = LocalClimbServer(args.key, args.host, args.port,
-                                   args.server_host, args.server_port)
-            lcs.start()
+                                   args.server_host, args.server_port,
+                                   pool_size=args.pool_size,
+                                   pool_ttl=args.pool_ttl,
+                                   router=create_router(args), **options)
+            start_server(lcs, args)
     else:
         print("Invalid command, see 'jqarena --help'")
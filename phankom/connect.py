@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 15:17:45
+# *************************************************************
+
+"""多地址竞速连接(Happy Eyeballs, RFC 8305)"""
+
+import os
+import time
+import errno
+import socket
+import asyncio
+from threading import Lock
+from collections import Counter, OrderedDict
+
+from .utils import wait_sockets
+
+
+class Connector(object):
+    """多地址竞速连接
+
+    目的地址解析出多个地址时，按地址族交替排列后依次发起连接，
+    前一个连接 delay 秒内未完成或已失败时发起下一个，最先建立的连接胜出，
+    其余的连接被关闭，整个过程超过 timeout 秒时抛出 socket.timeout。
+
+    每个目的地址最近一次胜出的地址及其平滑后的连接耗时会被记住，
+    下次连接时优先尝试该地址，最多记住 max_destinations 个目的地址
+
+    stats 中记录了连接次数 connects、失败次数 failures、超时次数 timeouts、
+    同时发起了多个连接的次数 races 以及首选地址未胜出的次数 fallbacks
+
+    options 为 sockopt.SocketOptions，连接前后分别设置，连接耗时作为 RTT 的参考
+    """
+
+    # 连接耗时的平滑系数
+    SMOOTHING = 0.3
+
+    def __init__(self, delay=0.25, timeout=10, max_destinations=1024,
+                 options=None):
+        self.delay = delay
+        self.timeout = timeout
+        self.max_destinations = max_destinations
+        self.options = options
+        self.stats = Counter()
+        # (地址, 端口) -> (胜出的 sockaddr, 平滑后的连接耗时)
+        self._history = OrderedDict()
+        # 各会话线程共用 _history，读写时持有
+        self._lock = Lock()
+
+    def latency(self, host, port):
+        """返回目的地址最近胜出的 (sockaddr, 连接耗时)，没有记录时返回 None"""
+        with self._lock:
+            return self._history.get((host, port))
+
+    def _order(self, key, infos):
+        """按地址族交替排列候选地址，上次胜出的地址排在最前"""
+        families = OrderedDict()
+        for info in infos:
+            families.setdefault(info[0], []).append(info)
+        groups = list(families.values())
+        ordered = []
+        for i in range(max(len(group) for group in groups) if groups else 0):
+            ordered.extend(group[i] for group in groups if i < len(group))
+
+        with self._lock:
+            history = self._history.get(key)
+        if history:
+            for i, info in enumerate(ordered):
+                if info[4] == history[0]:
+                    ordered.insert(0, ordered.pop(i))
+                    break
+        return ordered
+
+    def _record(self, key, info, elapsed, first):
+        with self._lock:
+            history = self._history.get(key)
+            if history and history[0] == info[4]:
+                elapsed = history[1] + self.SMOOTHING * (elapsed - history[1])
+            self._history[key] = (info[4], elapsed)
+            self._history.move_to_end(key)
+            while len(self._history) > self.max_destinations:
+                self._history.popitem(last=False)
+        if info is not first:
+            self.stats["fallbacks"] += 1
+
+    def _fail(self, key, error):
+        self.stats["failures"] += 1
+        with self._lock:
+            self._history.pop(key, None)
+        if isinstance(error, socket.timeout):
+            self.stats["timeouts"] += 1
+        return error
+
+    def connect(self, host, port, infos):
+        """连接 infos 中最先响应的地址，infos 为 getaddrinfo 格式的地址列表"""
+        key = (host, port)
+        infos = self._order(key, infos)
+        self.stats["connects"] += 1
+        deadline = time.monotonic() + self.timeout
+        pending = {}  # 套接字 -> (地址信息, 发起时间)
+        next_start = 0
+        error = None
+        index = 0
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise self._fail(key, socket.timeout(
+                        "Connect to %s:%s timed out" % key))
+                if index < len(infos) and now >= next_start:
+                    info = infos[index]
+                    index += 1
+                    if index == 2:
+                        self.stats["races"] += 1
+                    sock = socket.socket(*info[:3])
+                    sock.setblocking(False)
+                    if self.options:
+                        self.options.prepare(sock)
+                    code = sock.connect_ex(info[4])
+                    if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        sock.close()
+                        error = OSError(code, os.strerror(code))
+                        continue
+                    pending[sock] = (info, now)
+                    next_start = now + self.delay
+                if not pending:
+                    raise self._fail(key, error or OSError(
+                        "getaddrinfo returns an empty list"))
+
+                wait = deadline - now
+                if index < len(infos):
+                    wait = min(wait, next_start - now)
+                writable = wait_sockets(list(pending), write=True,
+                                        timeout=max(wait, 0))
+                for sock in writable:
+                    info, started = pending.pop(sock)
+                    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if code:
+                        sock.close()
+                        error = OSError(code, os.strerror(code))
+                        # 失败后立即尝试下一个地址
+                        next_start = 0
+                        continue
+                    sock.setblocking(True)
+                    elapsed = time.monotonic() - started
+                    if self.options:
+                        self.options.apply(sock, elapsed)
+                    self._record(key, info, elapsed, infos[0])
+                    return sock
+        finally:
+            for sock in pending:
+                sock.close()
+
+    async def async_connect(self, host, port, infos):
+        """connect 的 asyncio 版本，返回的套接字为非阻塞模式"""
+        loop = asyncio.get_running_loop()
+        key = (host, port)
+        infos = self._order(key, infos)
+        self.stats["connects"] += 1
+        deadline = time.monotonic() + self.timeout
+
+        async def attempt(info):
+            sock = socket.socket(*info[:3])
+            sock.setblocking(False)
+            if self.options:
+                self.options.prepare(sock)
+            started = time.monotonic()
+            try:
+                await loop.sock_connect(sock, info[4])
+            except BaseException:
+                sock.close()
+                raise
+            return sock, info, time.monotonic() - started
+
+        tasks = set()
+        error = None
+        index = 0
+        try:
+            while True:
+                if index < len(infos):
+                    tasks.add(loop.create_task(attempt(infos[index])))
+                    index += 1
+                    if index == 2:
+                        self.stats["races"] += 1
+                elif not tasks:
+                    raise self._fail(key, error or OSError(
+                        "getaddrinfo returns an empty list"))
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._fail(key, socket.timeout(
+                        "Connect to %s:%s timed out" % key))
+                wait = (min(self.delay, remaining) if index < len(infos) else
+                        remaining)
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result()[0].close()
+                if winner is not None:
+                    sock, info, elapsed = winner
+                    if self.options:
+                        self.options.apply(sock, elapsed)
+                    self._record(key, info, elapsed, infos[0])
+                    return sock
+        finally:
+            for task in tasks:
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, tuple):
+                    result[0].close()
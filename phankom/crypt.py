@@ -8,13 +8,35 @@
 #  CreateTime: 2017-10-28 16:56:59
 # *************************************************************
 
-"""加密混淆"""
+"""加密混淆
+
+加密器按名称注册在 CIPHERS 中，隧道两端必须使用同一种加密器:
+    mix: 与盐值异或后压缩，与旧版本兼容，不提供完整性保护
+    aes-128-gcm, aes-256-gcm, chacha20-poly1305: 带认证的加密(AEAD)，
+        需要安装 cryptography，其 OpenSSL 后端在支持的 CPU 上使用 AES-NI
+"""
 
 import os
+import copy
+import time
 import zlib
 import random
 import hashlib
-import itertools
+from collections import Counter, OrderedDict
+
+from .utils import affirm
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import (
+        AESGCM, ChaCha20Poly1305)
+except ImportError:
+    InvalidTag = AESGCM = ChaCha20Poly1305 = None
 
 
 def md5(data):
@@ -27,21 +49,411 @@ def sha1(data):
     return hashlib.sha1(data.encode("utf-8")).hexdigest()
 
 
-class MixCipher(object):
-    """混淆加密"""
+class CompressionPolicy(object):
+    """压缩策略
 
-    def __init__(self, key):
-        self.salt = md5(key).encode("utf-8")
+    mode:
+        always: 总是压缩，与旧版本的数据格式完全兼容
+        never: 从不压缩
+        adaptive: 统计最近若干帧的压缩率，压缩率较差时停止压缩，
+            之后每隔 probe_interval 帧重新尝试压缩并采样
+    """
 
-    def _xor_data(self, data):
-        data = [(x ^ y).to_bytes(1, "big") for x, y in
-                zip(data, itertools.cycle(self.salt))]
-        return b"".join(data)
+    MODES = ("always", "never", "adaptive")
+
+    def __init__(self, mode="always", level=-1, min_size=64, threshold=0.9,
+                 window=16, probe_interval=256):
+        affirm(mode in self.MODES, "Unsupported compression mode: '%s'" % mode)
+        affirm(-1 <= level <= 9, "Invalid compression level: '%s'" % level)
+        self.mode = mode
+        self.level = level
+        self.min_size = min_size
+        self.threshold = threshold
+        self.window = window
+        self.probe_interval = probe_interval
+
+        self._compressing = True
+        self._skipped = 0
+        self._window_frames = 0
+        self._window_in = 0
+        self._window_out = 0
+
+    def copy(self):
+        """以相同的参数创建一个新的策略，统计状态不共享"""
+        return self.__class__(self.mode, self.level, self.min_size,
+                              self.threshold, self.window, self.probe_interval)
+
+    def should_compress(self, size):
+        """判断长度为 size 的帧是否需要压缩"""
+        if self.mode == "always":
+            return True
+        if self.mode == "never" or size < self.min_size:
+            return False
+        if self._compressing:
+            return True
+        self._skipped += 1
+        if self._skipped >= self.probe_interval:
+            # 重新采样
+            self._skipped = 0
+            self._compressing = True
+            return True
+        return False
+
+    def record(self, size, compressed_size):
+        """记录一帧的压缩结果"""
+        if self.mode != "adaptive":
+            return
+        self._window_frames += 1
+        self._window_in += size
+        self._window_out += compressed_size
+        if self._window_frames >= self.window:
+            ratio = self._window_out / self._window_in
+            self._compressing = ratio < self.threshold
+            self._window_frames = self._window_in = self._window_out = 0
+
+
+class BaseCipher(object):
+    """加密器接口
+
+    子类实现 _encrypt、_decrypt 和 create_stream，encrypt 和 decrypt
+    在 stats 中累计耗费的 CPU 时间。create_tunnel 和 create_stream 返回的实例
+    带有单个隧道的状态，各隧道的压缩策略互不影响，stats 仍与原实例共用
+
+    _compress 和 _decompress 是各加密器共用的压缩处理: 按 self.policy 决定
+    是否压缩，未压缩的帧以 STORED_FLAG 开头，压缩的帧以 COMPRESSED_PREFIX 开头，
+    stats 中记录了压缩前后的字节数、帧数以及压缩解压耗费的 CPU 时间
+    """
+
+    STORED_FLAG = 0x00
+    COMPRESSED_FLAG = 0x01
+    # 压缩帧的前缀，为空时压缩帧是完整的 zlib 数据，其首字节总是 0x78
+    COMPRESSED_PREFIX = bytes((COMPRESSED_FLAG,))
+    # 流式压缩时压缩上下文已包含了数据，压缩结果总是发送
+    streaming = False
+
+    # 注册在 CIPHERS 中的名称
+    name = None
+    # 依赖的库是否已安装
+    available = True
+
+    @property
+    def compress_ratio(self):
+        """压缩后与压缩前的字节数之比"""
+        bytes_in = self.stats["bytes_in"]
+        return self.stats["bytes_out"] / bytes_in if bytes_in else 1.0
 
     def encrypt(self, data):
-        data = self._xor_data(data)
-        return zlib.compress(data)
+        start = time.thread_time()
+        try:
+            return self._encrypt(data)
+        finally:
+            self.stats["encrypt_time"] += time.thread_time() - start
 
     def decrypt(self, data):
-        data = zlib.decompress(data)
-        return self._xor_data(data)
+        start = time.thread_time()
+        try:
+            return self._decrypt(data)
+        finally:
+            self.stats["decrypt_time"] += time.thread_time() - start
+
+    def _deflate(self, data):
+        return zlib.compress(data, self.policy.level)
+
+    def _inflate(self, data):
+        return zlib.decompress(data)
+
+    def _compress(self, data):
+        """按压缩策略处理数据，返回带标记的帧内容"""
+        size = len(data)
+        policy = self.policy
+        stats = self.stats
+        stats["bytes_in"] += size
+        if policy.should_compress(size):
+            start = time.thread_time()
+            compressed = self._deflate(data)
+            stats["compress_time"] += time.thread_time() - start
+            policy.record(size, len(compressed))
+            if (self.streaming or policy.mode == "always" or
+                    len(compressed) <= size):
+                compressed = self.COMPRESSED_PREFIX + compressed
+                stats["frames_compressed"] += 1
+                stats["bytes_out"] += len(compressed)
+                return compressed
+        stats["frames_stored"] += 1
+        stats["bytes_out"] += size + 1
+        return bytes((self.STORED_FLAG,)) + data
+
+    def _decompress(self, data):
+        """_compress 的逆过程，未压缩的帧返回 memoryview"""
+        flag = data[0]
+        data = memoryview(data)
+        if flag == self.STORED_FLAG:
+            return data[1:]
+        if self.COMPRESSED_PREFIX:
+            affirm(flag == self.COMPRESSED_FLAG,
+                   "Invalid frame flag: '%#x'" % flag)
+            data = data[1:]
+        start = time.thread_time()
+        data = self._inflate(data)
+        self.stats["decompress_time"] += time.thread_time() - start
+        return data
+
+    def _encrypt(self, data):
+        raise NotImplementedError
+
+    def _decrypt(self, data):
+        raise NotImplementedError
+
+    def create_tunnel(self, initiator):
+        """返回单个隧道使用的实例，initiator 为真时表示隧道由本端发起"""
+        cipher = copy.copy(self)
+        cipher.policy = self.policy.copy()
+        return cipher
+
+
+class StreamCompression(object):
+    """流式压缩，与加密器类组合使用，每个隧道一个实例
+
+    隧道存续期间共用一对 zlib 压缩和解压上下文，每帧以 Z_SYNC_FLUSH 结束，
+    后续帧可以引用之前帧的内容，重复性高的数据压缩效果更好。
+    每帧首字节为标记字节，标明数据是否经过压缩
+    """
+
+    COMPRESSED_PREFIX = bytes((BaseCipher.COMPRESSED_FLAG,))
+    streaming = True
+
+    def _init_stream(self):
+        self._compressor = zlib.compressobj(self.policy.level)
+        self._decompressor = zlib.decompressobj()
+
+    def _deflate(self, data):
+        return (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def _inflate(self, data):
+        return self._decompressor.decompress(data)
+
+    def create_stream(self):
+        """创建一个使用流式压缩的加密器，供单个隧道使用"""
+        raise NotImplementedError
+
+
+class MixCipher(BaseCipher):
+    """混淆加密
+
+    数据与循环重复的盐值按字节异或后压缩，异或时整块处理：
+    预先生成足够长的密钥流，安装了 NumPy 时使用 NumPy 向量运算，
+    否则将数据和密钥流转换为大整数后一次异或
+
+    压缩由 CompressionPolicy 控制，未压缩的帧以 STORED_FLAG 开头，
+    为与旧版本兼容，压缩帧不加前缀，是完整的 zlib 数据，接收端据此区分两者
+    """
+
+    name = "mix"
+    COMPRESSED_PREFIX = b""
+
+    # 数据长度达到该值时才使用 NumPy，较短的数据大整数运算更快
+    NUMPY_THRESHOLD = 4096
+
+    def __init__(self, key, compress_mode="always", compress_level=-1):
+        self.salt = md5(key).encode("utf-8")
+        self._keystream = self.salt
+        # 数据长度 -> 该长度密钥流对应的整数，帧长度通常只有少数几种
+        self._keystream_ints = {}
+        self.policy = CompressionPolicy(compress_mode, compress_level)
+        self.stats = Counter()
+
+    def _get_keystream(self, size):
+        """返回长度不小于 size 的密钥流"""
+        keystream = self._keystream
+        if len(keystream) < size:
+            keystream = self.salt * (size // len(self.salt) + 1)
+            self._keystream = keystream
+        return keystream
+
+    def _get_keystream_int(self, size):
+        """返回长度为 size 的密钥流转换成的整数"""
+        value = self._keystream_ints.get(size)
+        if value is None:
+            if len(self._keystream_ints) >= 64:
+                self._keystream_ints.clear()
+            keystream = memoryview(self._get_keystream(size))[:size]
+            value = self._keystream_ints[size] = int.from_bytes(keystream,
+                                                                "little")
+        return value
+
+    def _xor_data(self, data):
+        size = len(data)
+        if size == 0:
+            return b""
+        if numpy is not None and size >= self.NUMPY_THRESHOLD:
+            keystream = memoryview(self._get_keystream(size))[:size]
+            data = numpy.frombuffer(data, dtype=numpy.uint8)
+            keystream = numpy.frombuffer(keystream, dtype=numpy.uint8)
+            return numpy.bitwise_xor(data, keystream).tobytes()
+        data = int.from_bytes(data, "little") ^ self._get_keystream_int(size)
+        return data.to_bytes(size, "little")
+
+    def _encrypt(self, data):
+        return self._compress(self._xor_data(data))
+
+    def _decrypt(self, data):
+        return self._xor_data(self._decompress(data))
+
+    def create_stream(self):
+        """创建一个使用流式压缩的加密器，供单个隧道使用"""
+        return MixStreamCipher(self)
+
+
+class MixStreamCipher(StreamCompression, MixCipher):
+    """流式压缩的混淆加密，每个隧道一个实例"""
+
+    def __init__(self, cipher):
+        self.salt = cipher.salt
+        self._keystream = cipher._keystream
+        self._keystream_ints = cipher._keystream_ints
+        self.policy = cipher.policy.copy()
+        self.stats = cipher.stats
+        self._init_stream()
+
+
+class FrameSequence(object):
+    """隧道上的帧序号，作为 AEAD 的附加认证数据
+
+    附加数据为 1 字节方向 + 8 字节序号，两个方向各自从 0 开始计数，
+    发起隧道的一端发送的方向为 0，另一端为 1。帧被重放、调换顺序、丢弃
+    或反射回发送方时，接收方期望的附加数据与加密时不同，认证失败
+    """
+
+    def __init__(self, initiator):
+        self._send_direction = b"\x00" if initiator else b"\x01"
+        self._recv_direction = b"\x01" if initiator else b"\x00"
+        self._sent = 0
+        self._received = 0
+
+    def next_send(self):
+        aad = self._send_direction + self._sent.to_bytes(8, "big")
+        self._sent += 1
+        return aad
+
+    def expected_recv(self):
+        return self._recv_direction + self._received.to_bytes(8, "big")
+
+    def received(self):
+        self._received += 1
+
+
+class AeadCipher(BaseCipher):
+    """带认证的加密
+
+    数据先按 CompressionPolicy 压缩并加上标记字节，再用随机的 12 字节 nonce 加密，
+    帧的内容为 nonce + 密文 + 16 字节认证标签，被篡改的帧解密时抛出异常。
+    AEAD 对象在创建加密器时生成一次，之后每帧复用，不再重复密钥扩展。
+    密钥由 key 经 PBKDF2 派生
+
+    create_tunnel 返回的实例以 FrameSequence 认证帧序号，隧道内的帧不能被
+    重放、调换顺序或丢弃。密钥在各隧道间相同，整个隧道被重放到新连接上的情况
+    不在防护范围内。create_cipher 返回的实例不带序号
+    """
+
+    NONCE_SIZE = 12
+
+    # cryptography 中的 AEAD 类及其密钥长度
+    algorithm = None
+    key_size = 32
+
+    # 派生密钥的盐值和迭代次数
+    KDF_SALT = b"phankom"
+    KDF_ITERATIONS = 10000
+
+    def __init__(self, key, compress_mode="always", compress_level=-1):
+        affirm(self.available,
+               "%s requires the cryptography package" % self.__class__.__name__)
+        secret = hashlib.pbkdf2_hmac("sha256", key.encode("utf-8"),
+                                     self.KDF_SALT, self.KDF_ITERATIONS,
+                                     self.key_size)
+        self._aead = self.algorithm(secret)
+        self.policy = CompressionPolicy(compress_mode, compress_level)
+        self.stats = Counter()
+        self._sequence = None
+
+    def _encrypt(self, data):
+        nonce = os.urandom(self.NONCE_SIZE)
+        aad = self._sequence.next_send() if self._sequence else None
+        return nonce + self._aead.encrypt(nonce, self._compress(data), aad)
+
+    def _decrypt(self, data):
+        data = memoryview(data)
+        sequence = self._sequence
+        try:
+            data = self._aead.decrypt(
+                data[:self.NONCE_SIZE], data[self.NONCE_SIZE:],
+                sequence.expected_recv() if sequence else None)
+        except InvalidTag:
+            raise Exception("Frame authentication failed")
+        if sequence:
+            sequence.received()
+        return bytes(self._decompress(data))
+
+    def create_tunnel(self, initiator):
+        cipher = super().create_tunnel(initiator)
+        cipher._sequence = FrameSequence(initiator)
+        return cipher
+
+    def create_stream(self):
+        return AeadStreamCipher(self)
+
+
+class AeadStreamCipher(StreamCompression, AeadCipher):
+    """流式压缩的带认证加密，每个隧道一个实例"""
+
+    def __init__(self, cipher):
+        self._aead = cipher._aead
+        self.policy = cipher.policy.copy()
+        self.stats = cipher.stats
+        # 沿用握手时的帧序号
+        self._sequence = cipher._sequence
+        self._init_stream()
+
+
+class Aes128GcmCipher(AeadCipher):
+    name = "aes-128-gcm"
+    algorithm = AESGCM
+    key_size = 16
+    available = AESGCM is not None
+
+
+class Aes256GcmCipher(AeadCipher):
+    name = "aes-256-gcm"
+    algorithm = AESGCM
+    key_size = 32
+    available = AESGCM is not None
+
+
+class ChaCha20Cipher(AeadCipher):
+    """ChaCha20-Poly1305，在没有 AES 指令的 CPU 上比 AES-GCM 快"""
+
+    name = "chacha20-poly1305"
+    algorithm = ChaCha20Poly1305
+    key_size = 32
+    available = ChaCha20Poly1305 is not None
+
+
+# 名称 -> 加密器类
+CIPHERS = OrderedDict([
+    ("mix", MixCipher),
+    ("aes-128-gcm", Aes128GcmCipher),
+    ("aes-256-gcm", Aes256GcmCipher),
+    ("chacha20-poly1305", ChaCha20Cipher),
+])
+
+
+def available_ciphers():
+    """返回依赖已安装的加密器名称"""
+    return [name for name, cls in CIPHERS.items() if cls.available]
+
+
+def create_cipher(name, key, compress_mode="always", compress_level=-1):
+    """按名称创建加密器"""
+    affirm(name in CIPHERS, "Unsupported cipher: '%s'" % name)
+    return CIPHERS[name](key, compress_mode, compress_level)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 14:52:06
+# *************************************************************
+
+"""域名解析缓存"""
+
+import time
+import socket
+import asyncio
+from threading import Lock, Event
+from collections import Counter, OrderedDict
+
+
+class _Lookup(object):
+    """进行中的解析，同一地址的并发请求等待同一个解析结果"""
+
+    def __init__(self):
+        self.done = Event()
+        self.entry = None
+
+
+class Resolver(object):
+    """带缓存的域名解析器
+
+    解析结果按最近最少使用淘汰，最多缓存 max_size 条，max_size 为 0 时不缓存。
+    系统解析接口不提供记录的 TTL，成功的结果缓存 ttl 秒，
+    解析失败的结果缓存 negative_ttl 秒，同一地址的并发解析合并为一次
+
+    stats 中记录了命中次数 hits、其中命中失败结果的次数 negative_hits、
+    实际解析次数 misses、合并的解析次数 merged 和因容量淘汰的条数 evicted
+    """
+
+    def __init__(self, max_size=1024, ttl=60, negative_ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = Counter()
+
+        self._cache = OrderedDict()  # (地址, 端口) -> (过期时间, 结果或异常)
+        self._pending = {}           # (地址, 端口) -> _Lookup
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    @staticmethod
+    def _result(entry):
+        result = entry[1]
+        if isinstance(result, Exception):
+            raise type(result)(*result.args)
+        return result
+
+    def _cached(self, key):
+        """返回未过期的缓存条目并计数，需在持有锁时调用"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        self.stats["hits"] += 1
+        if isinstance(entry[1], Exception):
+            self.stats["negative_hits"] += 1
+        return entry
+
+    def _store(self, key, entry):
+        if self.max_size <= 0:
+            return
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def cached(self, host, port):
+        """返回缓存中的解析结果，未缓存时返回 None，不会发起解析"""
+        with self._lock:
+            entry = self._cached((host, port))
+        return None if entry is None else self._result(entry)
+
+    def resolve(self, host, port):
+        """解析地址，返回 getaddrinfo 格式的 TCP 地址列表"""
+        key = (host, port)
+        while True:
+            with self._lock:
+                entry = self._cached(key)
+                if entry is not None:
+                    return self._result(entry)
+                lookup = self._pending.get(key)
+                if lookup is None:
+                    lookup = self._pending[key] = _Lookup()
+                    break
+                self.stats["merged"] += 1
+            lookup.done.wait()
+            if lookup.entry is not None:
+                return self._result(lookup.entry)
+
+        self.stats["misses"] += 1
+        try:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            lookup.entry = (time.monotonic() + self.ttl, infos)
+        except socket.gaierror as e:
+            lookup.entry = (time.monotonic() + self.negative_ttl, e)
+        finally:
+            with self._lock:
+                if lookup.entry is not None:
+                    self._store(key, lookup.entry)
+                del self._pending[key]
+            lookup.done.set()
+        return self._result(lookup.entry)
+
+    async def async_resolve(self, host, port):
+        """resolve 的 asyncio 版本，未命中缓存时在线程池中解析，不阻塞事件循环"""
+        infos = self.cached(host, port)
+        if infos is not None:
+            return infos
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.resolve, host, port)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
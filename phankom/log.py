@@ -7,10 +7,26 @@
 #  CreateTime: 2017-06-19 09:43:16 Monday
 # *************************************************************
 
-"""日志模块"""
+"""日志模块
 
+队列模式下记录只在调用线程中放入有界队列，由后台线程批量格式化并写出，
+队列已满时记录被丢弃而不阻塞调用方。同一消息模板的 INFO 及以下级别的记录
+可以按速率限制，突发的每连接日志被丢弃，恢复后在下一条记录中注明丢弃的条数。
+stats 中按原因 queue_full 和 rate_limited 记录了丢弃的记录数
+"""
+
+import os
 import sys
+import json
+import time
+import queue
 import logging
+import weakref
+from threading import Thread, Lock
+from collections import Counter
+
+
+stats = Counter()
 
 
 class ColoredStreamHandler(logging.StreamHandler):
@@ -49,30 +65,182 @@ class ColoredStreamHandler(logging.StreamHandler):
         isatty = getattr(self.stream, 'isatty', None)
         return isatty and isatty()
 
+    # 为假时不输出颜色，例如 JSON 格式
+    colored = True
+
+    def _render(self, record):
+        message = self.format(record)
+        if self.colored and self.is_tty:
+            message = self._colors[record.levelno] + message + self.C_RESET
+        return message + getattr(self, 'terminator', '\n')
+
     def emit(self, record):
         try:
-            message = self.format(record)
-            stream = self.stream
-            if not self.is_tty:
-                stream.write(message)
-            else:
-                message = self._colors[record.levelno] + message + self.C_RESET
-                stream.write(message)
-            stream.write(getattr(self, 'terminator', '\n'))
+            self.stream.write(self._render(record))
             self.flush()
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception:
             self.handleError(record)
 
+    def emit_batch(self, records):
+        """格式化多条记录后一次写入并刷新"""
+        messages = []
+        for record in records:
+            if record.levelno < self.level or not self.filter(record):
+                continue
+            try:
+                messages.append(self._render(record))
+            except Exception:
+                self.handleError(record)
+        if not messages:
+            return
+        with self.lock:
+            try:
+                self.stream.write("".join(messages))
+                self.stream.flush()
+            except Exception:
+                self.handleError(records[-1])
+
     def setLevelColor(self, logging_level, escaped_ansi_code):
         self._colors[logging_level] = escaped_ansi_code
 
 
+class JsonFormatter(logging.Formatter):
+    """每条记录输出为一行 JSON，便于日志收集"""
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """按消息模板限制低于 level 级别的记录，每个模板每秒最多 rate 条，可突发 burst 条"""
+
+    # 记录的消息模板数上限，超过时清空，以免直接记录异常等消息时无限增长
+    MAX_TEMPLATES = 1024
+
+    def __init__(self, rate, burst=None, level=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or rate
+        self.level = level
+        self._buckets = {}  # 消息模板 -> [令牌数, 更新时间, 丢弃的条数]
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.msg)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_TEMPLATES:
+                    self._buckets.clear()
+                bucket = self._buckets[record.msg] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                stats["rate_limited"] += 1
+                return False
+            bucket[0] = tokens - 1
+            dropped, bucket[2] = bucket[2], 0
+        if dropped:
+            record.msg = "%s (%d similar messages dropped)" % (record.msg,
+                                                              dropped)
+        return True
+
+
+class QueueLogHandler(logging.Handler):
+    """将记录放入有界队列，由后台线程每次取出最多 batch 条交给 handler
+
+    handler 有 emit_batch 方法时一次写入整批记录。
+    fork 出的子进程中重新创建队列和后台线程
+    """
+
+    def __init__(self, handler, size=10000, batch=256):
+        super().__init__()
+        self.handler = handler
+        self.size = size
+        self.batch = batch
+        self._start()
+        if hasattr(os, "register_at_fork"):
+            ref = weakref.ref(self)
+            os.register_at_fork(after_in_child=lambda: _restart(ref))
+
+    def _start(self):
+        self.queue = queue.Queue(self.size)
+        self._thread = Thread(target=self._run, args=(self.queue,),
+                              name="logging", daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats["queue_full"] += 1
+
+    def _run(self, records_queue):
+        emit_batch = getattr(self.handler, "emit_batch", None)
+        while True:
+            records = [records_queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(records_queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = records[-1] is None
+            records = [record for record in records if record is not None]
+            if emit_batch is not None:
+                emit_batch(records)
+            else:
+                for record in records:
+                    self.handler.handle(record)
+            if stop:
+                return
+
+    def close(self):
+        """写出队列中剩余的记录后关闭"""
+        if self._thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+            except queue.Full:
+                pass
+            self._thread.join(5)
+        self.handler.close()
+        super().close()
+
+
+def _restart(ref):
+    handler = ref()
+    if handler is not None:
+        handler._start()
+
+
 DEFAULT_LOG_FORMAT = "[%(levelname)1.1s %(asctime)s] %(message)s"
 
 
-def setup_logging(reset=False):
+def setup_logging(reset=False, queue_size=0, json_format=False,
+                  rate_limit=0):
+    """设置根日志记录器，输出到标准输出
+
+    参数:
+        queue_size: 大于 0 时使用队列模式，队列最多容纳这么多条记录
+        json_format: 每条记录输出为一行 JSON
+        rate_limit: 大于 0 时同一消息模板的 INFO 及以下级别的记录
+            每秒最多输出这么多条
+    """
     logger = logging.getLogger()
 
     if len(logger.handlers) > 0 and not reset:
@@ -87,5 +255,14 @@ def setup_logging(reset=False):
     # add stream log handler for info
     stream_handler = ColoredStreamHandler(sys.stdout)
     stream_handler.setLevel(logging.DEBUG)
-    stream_handler.setFormatter(logging.Formatter(DEFAULT_LOG_FORMAT))
-    logger.addHandler(stream_handler)
+    if json_format:
+        stream_handler.colored = False
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(DEFAULT_LOG_FORMAT))
+    handler = stream_handler
+    if queue_size:
+        handler = QueueLogHandler(stream_handler, queue_size)
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(rate_limit))
+    logger.addHandler(handler)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 15:58:23
+# *************************************************************
+
+"""运行指标
+
+各组件在自己的 stats 计数器中累加，计数时不加锁，只有导出时才汇总，
+MetricsServer 在本地 HTTP 端口上按 Prometheus 文本格式输出
+"""
+
+import logging
+from bisect import bisect_left
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .log import stats as log_stats
+
+
+class Histogram(object):
+    """耗时分布，buckets 为各个桶的上界(秒)"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsWriter(object):
+    """按 Prometheus 文本格式输出指标"""
+
+    PREFIX = "phankom_"
+
+    def __init__(self):
+        self.lines = []
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{%s}" % ",".join(
+            '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in labels)
+
+    def add(self, name, type_, help_, samples):
+        """添加一个指标，samples 为 [(标签, 值)]，标签为 ((名称, 值), ...)"""
+        name = self.PREFIX + name
+        self.lines.append("# HELP %s %s" % (name, help_))
+        self.lines.append("# TYPE %s %s" % (name, type_))
+        for labels, value in samples:
+            self.lines.append("%s%s %s" % (name, self._labels(labels), value))
+
+    def gauge(self, name, help_, value):
+        self.add(name, "gauge", help_, [((), value)])
+
+    def counter(self, name, help_, stats, label, keys=None):
+        """将 stats 计数器中的 keys 输出为一个带 label 标签的计数器
+
+        keys 为 {标签值: stats 中的键}，为空时输出 stats 中所有的键。
+        stats 可能正被其他线程加入新的键，先复制一份再遍历
+        """
+        stats = dict(stats)
+        if keys is None:
+            keys = {key: key for key in sorted(stats)}
+        self.add(name, "counter", help_,
+                 [(((label, value),), stats.get(key, 0))
+                  for value, key in keys.items()])
+
+    def histogram(self, name, help_, histogram):
+        name = self.PREFIX + name
+        self.lines.append("# HELP %s %s" % (name, help_))
+        self.lines.append("# TYPE %s histogram" % name)
+        total = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            total += count
+            self.lines.append('%s_bucket{le="%s"} %s' % (name, bound, total))
+        self.lines.append('%s_bucket{le="+Inf"} %s' % (name, histogram.count))
+        self.lines.append("%s_sum %s" % (name, histogram.sum))
+        self.lines.append("%s_count %s" % (name, histogram.count))
+
+    def getvalue(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def render(server):
+    """输出服务器的全部指标，server 为 Socks5Server 或其子类的实例"""
+    writer = MetricsWriter()
+    limiter = server.limiter
+    stats = server.stats
+    writer.gauge("sessions_active", "Sessions being handled", limiter.active)
+    writer.gauge("sessions_queued", "Sessions waiting for a free slot",
+                 limiter.queued)
+    writer.gauge("sessions_peak", "Peak number of active sessions",
+                 limiter.peak)
+    writer.add("sessions_total", "counter", "Sessions handled",
+               [((), stats["sessions"])])
+    writer.add("sessions_rejected_total", "counter",
+               "Connections rejected by admission control",
+               [((), limiter.rejected)])
+    writer.counter("sessions_reclaimed_total", "Sessions closed on a timeout",
+                   server.sweeper.stats, "reason",
+                   {key: key for key in ("handshake", "idle", "lifetime")})
+    writer.counter("relay_bytes_total", "Bytes relayed, up is from the client",
+                   stats, "direction", {"up": "bytes_up", "down": "bytes_down"})
+    writer.counter("relays_total", "Finished relays by data path", stats, "path",
+                   {"splice": "relay_splice", "copy": "relay_copy",
+                    "reactor": "relay_reactor"})
+    if server.udp:
+        writer.add("udp_associations_total", "counter", "UDP associations",
+                   [((), stats["udp_associations"])])
+        writer.counter("udp_datagrams_total",
+                       "Datagrams relayed, up is from the client", stats,
+                       "direction", {"up": "udp_datagrams_up",
+                                     "down": "udp_datagrams_down"})
+        writer.add("udp_dropped_total", "counter",
+                   "Datagrams dropped as invalid, unsolicited or unsendable",
+                   [((), stats["udp_dropped"])])
+        writer.add("udp_nat_expired_total", "counter",
+                   "UDP destinations removed from the NAT table when idle",
+                   [((), stats["udp_nat_expired"])])
+    reactor = server.reactor
+    if reactor is not None:
+        writer.gauge("reactor_relays", "Connections relayed by the reactor",
+                     reactor.relays)
+        writer.gauge("reactor_buffered_bytes",
+                     "Bytes waiting in reactor output buffers",
+                     reactor.buffered)
+        writer.gauge("reactor_buffered_peak_bytes",
+                     "Peak bytes waiting in reactor output buffers",
+                     reactor.peak)
+        writer.counter("reactor_pauses_total",
+                       "Times a connection stopped reading for backpressure",
+                       reactor.stats, "reason",
+                       {"watermark": "pauses_watermark",
+                        "budget": "pauses_budget"})
+    writer.counter("errors_total", "Failed sessions by exception type",
+                   server.errors, "cause")
+    writer.histogram("handshake_seconds",
+                     "Time from accept until the upstream is connected",
+                     server.handshake_latency)
+    writer.histogram("connect_seconds", "Time spent connecting upstream",
+                     server.connect_latency)
+    writer.counter("dns_events_total", "DNS resolver cache events",
+                   server.resolver.stats, "event")
+    writer.counter("log_dropped_total", "Log records dropped", log_stats,
+                   "reason", {key: key for key in ("queue_full",
+                                                   "rate_limited")})
+    writer.counter("connect_events_total", "Upstream connect events",
+                   server.connector.stats, "event")
+    socket_options = server.socket_options
+    writer.counter("socket_option_errors_total",
+                   "Socket options the system refused", socket_options.stats,
+                   "option", {key: key for key in ("nodelay", "sndbuf",
+                                                   "rcvbuf", "keepalive",
+                                                   "fastopen", "notsent_lowat",
+                                                   "autotune")})
+    writer.add("socket_autotuned_total", "counter",
+               "Connections whose buffers were sized from the RTT",
+               [((), socket_options.stats["autotuned"])])
+
+    cipher = getattr(server, "cipher", None)
+    if cipher is not None:
+        writer.counter("cipher_bytes_total",
+                       "Bytes before and after compression", cipher.stats,
+                       "stage", {"plain": "bytes_in", "encoded": "bytes_out"})
+        writer.counter("cipher_frames_total", "Encrypted frames", cipher.stats,
+                       "kind", {"compressed": "frames_compressed",
+                                "stored": "frames_stored"})
+        writer.counter("cipher_seconds_total", "CPU time spent in the cipher",
+                       cipher.stats, "op",
+                       {"encrypt": "encrypt_time", "decrypt": "decrypt_time",
+                        "compress": "compress_time",
+                        "decompress": "decompress_time"})
+
+    pool = getattr(server, "pool", None)
+    if pool is not None:
+        writer.gauge("pool_idle", "Idle pooled connections", pool.idle)
+        writer.counter("pool_events_total", "Connection pool events",
+                       pool.stats, "event",
+                       {key: key for key in ("hits", "misses", "expired",
+                                             "broken", "connect_errors")})
+        writer.add("pool_wait_seconds_total", "counter",
+                   "Time spent getting a connection to the remote server",
+                   [((), pool.stats["wait_time"])])
+
+    router = getattr(server, "router", None)
+    if router is not None:
+        writer.counter("route_decisions_total", "Connections by route action",
+                       router.stats, "action",
+                       {key: key for key in ("direct", "tunnel", "block")})
+        writer.counter("route_cache_total", "Route decision cache lookups",
+                       router.stats, "result",
+                       {"hit": "cache_hits", "miss": "cache_misses"})
+
+    mux_pool = getattr(server, "mux_pool", None)
+    if mux_pool is not None:
+        tunnels = list(mux_pool.tunnels)
+        writer.gauge("mux_tunnels", "Open multiplexed tunnels", len(tunnels))
+        writer.gauge("mux_streams", "Open multiplexed streams",
+                     sum(len(tunnel.streams) for tunnel in tunnels))
+    return writer.getvalue()
+
+
+class MetricsServer(object):
+    """在 HTTP 端口上输出指标，GET /metrics 返回 Prometheus 文本格式"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, server, host="127.0.0.1", port=9108):
+        self.server = server
+        self.log = logging.getLogger()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.address = self.httpd.server_address
+
+    def _make_handler(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render(metrics.server).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", metrics.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                metrics.log.debug("Metrics request: " + format, *args)
+
+        return Handler
+
+    def start(self):
+        """在后台线程中提供服务"""
+        self.log.info("Serving metrics at %s:%s", *self.address[:2])
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 13:41:09
+# *************************************************************
+
+"""多路复用隧道
+
+一个到远程服务器的连接(隧道)上承载多个逻辑流，每个逻辑流对应一个 SOCKS 连接。
+隧道中的每个加密帧解密后为 1 字节类型 + 4 字节流 ID + 数据:
+    OPEN: 本地服务器打开新的流，数据为目的地址信息，发送后无需等待响应即可发送 DATA
+    DATA: 流数据
+    CLOSE: 发送方已关闭该流
+    WINDOW: 接收方已消费的字节数，发送方据此扩大发送窗口
+    FIN: 发送方的目的端已结束写方向，不再发送 DATA，接收方写完已收到的数据后
+        结束其目的端的写方向(TCP 半关闭)，另一个方向继续交换数据
+
+每个流的发送量不超过对端的接收窗口，读取隧道的线程因此不会被单个慢速的流阻塞
+"""
+
+import struct
+import socket
+import logging
+from threading import Thread, Lock, Condition
+from collections import deque
+
+from .utils import affirm
+
+
+OPEN = 0x01
+DATA = 0x02
+CLOSE = 0x03
+WINDOW = 0x04
+FIN = 0x05
+
+HEAD = struct.Struct(">BI")
+WINDOW_SIZE = struct.Struct(">I")
+
+# 每个流的初始发送窗口
+INITIAL_WINDOW = 256 * 1024
+
+
+class MuxStream(object):
+    """隧道中的一个逻辑流"""
+
+    def __init__(self, tunnel, stream_id):
+        self.tunnel = tunnel
+        self.id = stream_id
+        self.closed = False       # 本端已关闭
+        self.peer_closed = False  # 对端已关闭
+        self.fin_sent = False     # 本端已发送 FIN
+        self.peer_fin = False     # 对端已发送 FIN
+        self.aborted = False      # 会话已被回收，不再等待另一个方向结束
+
+        self._send_window = INITIAL_WINDOW
+        self._received = deque()
+        self._consumed = 0
+        self._cond = Condition()
+
+    def _on_data(self, data):
+        with self._cond:
+            self._received.append(data)
+            self._cond.notify_all()
+
+    def _on_window(self, size):
+        with self._cond:
+            self._send_window += size
+            self._cond.notify_all()
+
+    def _on_close(self):
+        with self._cond:
+            self.peer_closed = True
+            self._cond.notify_all()
+
+    def _on_fin(self):
+        with self._cond:
+            self.peer_fin = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """会话被回收时由 Sweeper 调用，唤醒阻塞在流上的读写，relay 随即关闭流"""
+        with self._cond:
+            self.aborted = True
+            self._cond.notify_all()
+
+    def send(self, data):
+        """发送数据，发送窗口用尽时阻塞等待，流已关闭时返回 False"""
+        view = memoryview(data)
+        while view:
+            with self._cond:
+                self._cond.wait_for(lambda: (self._send_window > 0 or
+                                             self.closed or self.peer_closed or
+                                             self.aborted))
+                if self.closed or self.peer_closed or self.aborted:
+                    return False
+                size = min(len(view), self._send_window)
+                self._send_window -= size
+            self.tunnel.send_frame(DATA, self.id, view[:size])
+            view = view[size:]
+        return True
+
+    def recv(self):
+        """读取对端发来的数据，流关闭或对端发送了 FIN 且数据已读完时返回空字节串"""
+        with self._cond:
+            self._cond.wait_for(lambda: (self._received or self.closed or
+                                         self.peer_closed or self.peer_fin or
+                                         self.aborted))
+            if not self._received or self.aborted:
+                return b''
+            data = b''.join(self._received)
+            self._received.clear()
+        return data
+
+    def consume(self, size):
+        """已将 size 字节交给目的端，累计达到初始窗口的一半时通知对端"""
+        self._consumed += size
+        if self._consumed >= INITIAL_WINDOW // 2 and not self.closed:
+            self.tunnel.send_frame(WINDOW, self.id,
+                                   WINDOW_SIZE.pack(self._consumed))
+            self._consumed = 0
+
+    def shutdown(self):
+        """发送 FIN，之后不再发送数据，返回是否已发送"""
+        with self._cond:
+            if self.closed or self.peer_closed or self.fin_sent:
+                return False
+            self.fin_sent = True
+        try:
+            self.tunnel.send_frame(FIN, self.id)
+        except OSError:
+            return False
+        return True
+
+    def close(self):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        self.tunnel.close_stream(self)
+
+    def pipe_to(self, sock, stats=None, key=None, session=None):
+        """将对端发来的数据写入 sock
+
+        对端发送了 FIN 时结束 sock 的写方向，流关闭时关闭 sock 以唤醒读取 sock 的线程
+        """
+        how = socket.SHUT_RDWR
+        try:
+            while True:
+                data = self.recv()
+                if not data:
+                    break
+                if session is not None:
+                    session.touch()
+                if stats is not None:
+                    stats[key] += len(data)
+                sock.sendall(data)
+                self.consume(len(data))
+            with self._cond:
+                if not (self.closed or self.peer_closed or self.aborted):
+                    how = socket.SHUT_WR
+        except OSError:
+            pass
+        finally:
+            try:
+                sock.shutdown(how)
+            except OSError:
+                pass
+
+    def relay(self, sock, buffer_size, stats=None,
+              keys=("bytes_up", "bytes_down"), session=None):
+        """在 sock 和流之间交换数据
+
+        当前线程读取 sock 并发送到流，另起一个线程将流中的数据写入 sock，
+        给出了 stats 时将读取和写入 sock 的字节数分别累加到 keys 中的两个键，
+        给出了 session 时每次读写都更新其活动时间。
+        sock 结束写方向时发送 FIN，等待另一个方向结束后再关闭流，
+        session 被回收时(见 abort)不再等待，直接关闭流
+        """
+        writer = Thread(target=self.pipe_to,
+                        args=(sock, stats, keys[1], session), daemon=True)
+        writer.start()
+        eof = False
+        try:
+            while True:
+                data = sock.recv(buffer_size)
+                if not data:
+                    eof = True
+                    break
+                if session is not None:
+                    session.touch()
+                if stats is not None:
+                    stats[keys[0]] += len(data)
+                if not self.send(data):
+                    break
+        finally:
+            if eof and not self.aborted and self.shutdown():
+                writer.join()
+            self.close()
+            writer.join()
+
+
+class MuxTunnel(object):
+    """多路复用隧道
+
+    参数:
+        server: 隧道所属的 BaseClimbServer，用于收发加密帧
+        sock: 已完成握手的隧道套接字
+        on_open: 收到 OPEN 时的回调，参数为新建的流和目的地址信息，
+            为空时拒绝对端打开流
+
+    session 为隧道套接字所属的会话时，每收发一帧都更新其活动时间，
+    有流在交换数据的隧道不会因空闲超时被回收
+    """
+
+    def __init__(self, server, sock, on_open=None):
+        self.server = server
+        self.sock = sock
+        self.on_open = on_open
+        self.streams = {}
+        self.closed = False
+        self.session = None
+
+        self._lock = Lock()
+        self._send_lock = Lock()
+        self._next_id = 1
+
+    def send_frame(self, type_, stream_id, payload=b''):
+        data = HEAD.pack(type_, stream_id) + payload
+        with self._send_lock:
+            self.server.send_encrypted_data(data, self.sock)
+        if self.session is not None:
+            self.session.touch()
+
+    def open_stream(self, addr_data):
+        """打开一个到 addr_data 所指目的地址的流，不等待对端响应"""
+        with self._lock:
+            affirm(not self.closed, "Mux tunnel closed")
+            stream_id = self._next_id
+            self._next_id += 1
+            stream = self.streams[stream_id] = MuxStream(self, stream_id)
+        self.send_frame(OPEN, stream_id, addr_data)
+        return stream
+
+    def close_stream(self, stream):
+        with self._lock:
+            self.streams.pop(stream.id, None)
+        if not self.closed:
+            try:
+                self.send_frame(CLOSE, stream.id)
+            except OSError:
+                pass
+
+    def _accept_stream(self, stream_id, addr_data):
+        with self._lock:
+            stream = self.streams[stream_id] = MuxStream(self, stream_id)
+        if self.on_open is None:
+            stream.close()
+        else:
+            self.on_open(stream, addr_data)
+
+    def run(self):
+        """读取并分发隧道中的帧，隧道断开后关闭所有的流"""
+        try:
+            while True:
+                data = self.server.recv_encrypted_data(self.sock)
+                if not data:
+                    break
+                if self.session is not None:
+                    self.session.touch()
+                type_, stream_id = HEAD.unpack_from(data)
+                payload = data[HEAD.size:]
+                if type_ == OPEN:
+                    self._accept_stream(stream_id, payload)
+                    continue
+                stream = self.streams.get(stream_id)
+                if stream is None:
+                    continue
+                if type_ == DATA:
+                    stream._on_data(payload)
+                elif type_ == WINDOW:
+                    stream._on_window(WINDOW_SIZE.unpack(payload)[0])
+                elif type_ == FIN:
+                    stream._on_fin()
+                elif type_ == CLOSE:
+                    stream._on_close()
+        except Exception as e:
+            if not self.closed:
+                logging.getLogger().warning("Mux tunnel broken: %s", e)
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            streams = list(self.streams.values())
+        for stream in streams:
+            stream._on_close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class MuxPool(object):
+    """本地服务器到远程服务器的多路复用隧道池
+
+    最多保持 size 个隧道，新的流放在承载流最少的隧道上。
+    没有可用的隧道时同步建立一个，隧道数不足 size 时在后台补充，
+    远程服务器不支持多路复用时 refused 为真，由调用方退回到每个连接一个隧道
+    """
+
+    def __init__(self, server, size):
+        self.server = server
+        self.size = size
+        self.tunnels = []
+        self.refused = False
+
+        self._lock = Lock()
+        self._connect_lock = Lock()
+        self._connecting = False
+        self.log = logging.getLogger()
+
+    def _add_tunnel(self):
+        try:
+            tunnel = self.server._open_mux_tunnel()
+            if tunnel is None:
+                self.refused = True
+                self.log.warning("Remote server refused multiplexing, "
+                                 "using one connection per stream")
+                return
+            with self._lock:
+                self.tunnels.append(tunnel)
+            Thread(target=tunnel.run, daemon=True).start()
+        except Exception as e:
+            self.log.warning("Failed to open mux tunnel: %s", e)
+        finally:
+            self._connecting = False
+
+    def _pick(self):
+        """返回承载流最少的隧道，隧道数不足时在后台补充"""
+        self.tunnels = [tunnel for tunnel in self.tunnels if not tunnel.closed]
+        if not self.tunnels:
+            return None
+        if len(self.tunnels) < self.size and not self._connecting:
+            self._connecting = True
+            Thread(target=self._add_tunnel, daemon=True).start()
+        return min(self.tunnels, key=lambda tunnel: len(tunnel.streams))
+
+    def get_tunnel(self):
+        with self._lock:
+            tunnel = self._pick()
+        if tunnel is not None or self.refused:
+            return tunnel
+        with self._connect_lock:
+            with self._lock:
+                tunnel = self._pick()
+            if tunnel is None and not self.refused:
+                self._connecting = True
+                self._add_tunnel()
+                with self._lock:
+                    tunnel = self._pick()
+        return tunnel
+
+    def open_stream(self, addr_data):
+        """打开一个流，没有可用的隧道时返回 None"""
+        tunnel = self.get_tunnel()
+        if tunnel is None:
+            return None
+        try:
+            return tunnel.open_stream(addr_data)
+        except (OSError, AssertionError):
+            return None
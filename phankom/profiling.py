@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 17:20:48
+# *************************************************************
+
+"""性能分析
+
+StageProfiler 对按比例采样的连接统计数据交换各阶段的耗时，
+未被采样的连接使用原始的函数，不增加任何开销。
+StackSampler 定时采集所有线程的调用栈，输出 flamegraph.pl 可以直接使用的折叠格式，
+install_signal_handler 使服务器在收到 SIGUSR1 时采集一段时间并写入文件，无需重启
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import logging
+import functools
+from threading import Thread, Lock, get_ident
+from collections import Counter
+
+
+class ProfiledCipher(object):
+    """记录 encrypt 和 decrypt 耗时的加密器代理，用于被采样的隧道"""
+
+    def __init__(self, cipher, profiler):
+        self._cipher = cipher
+        self.encrypt = profiler.wrap("encrypt", cipher.encrypt)
+        self.decrypt = profiler.wrap("decrypt", cipher.decrypt)
+
+    def __getattr__(self, name):
+        return getattr(self._cipher, name)
+
+
+class StageProfiler(object):
+    """按阶段统计耗时的采样分析器
+
+    每个连接以 sample_rate 的概率被采样，被采样的连接通过 wrap 包装各阶段的函数，
+    stats 中记录每个阶段的调用次数、总耗时和最大耗时(秒)。
+    阶段可以嵌套，例如 recv_tunnel 包含了其中的 decrypt
+    """
+
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.stats = {}  # 阶段 -> [次数, 总耗时, 最大耗时]
+        self.sampled = 0
+        self._lock = Lock()
+
+    def sample(self):
+        """决定一个新连接是否被采样"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return False
+        self.sampled += 1
+        return True
+
+    def record(self, stage, elapsed):
+        with self._lock:
+            stats = self.stats.get(stage)
+            if stats is None:
+                stats = self.stats[stage] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+
+    def wrap(self, stage, func):
+        """返回记录 func 耗时的函数"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return wrapper
+
+    def wrap_async(self, stage, func):
+        """wrap 的协程版本"""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return wrapper
+
+    def report(self):
+        """返回 {阶段: {count, total, mean, max}}，时间单位为秒"""
+        with self._lock:
+            stats = {stage: list(values) for stage, values in self.stats.items()}
+        return {stage: {"count": count, "total": round(total, 6),
+                        "mean": round(total / count, 9) if count else 0,
+                        "max": round(maximum, 6)}
+                for stage, (count, total, maximum) in sorted(stats.items())}
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+
+
+class StackSampler(object):
+    """定时采集所有线程的调用栈
+
+    folded 返回折叠格式的结果，每行为以分号连接的调用栈和采样次数，
+    可以直接交给 flamegraph.pl 或 speedscope 生成火焰图
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    @staticmethod
+    def _format(frame):
+        code = frame.f_code
+        return "%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+    def sample(self):
+        current = get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == current:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._format(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, duration):
+        """采集 duration 秒"""
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+
+    def folded(self):
+        return "".join("%s %s\n" % (stack, count)
+                       for stack, count in self.stacks.most_common())
+
+
+def dump_profile(server, directory, duration):
+    """采集 duration 秒的调用栈，与阶段耗时一起写入 directory，返回文件路径前缀"""
+    log = logging.getLogger()
+    prefix = os.path.join(directory, "phankom-%s-%s" % (
+        os.getpid(), time.strftime("%Y%m%d%H%M%S")))
+    log.info("Profiling for %s seconds into %s.*", duration, prefix)
+    sampler = StackSampler()
+    sampler.run(duration)
+    with open(prefix + ".folded", "w") as f:
+        f.write(sampler.folded())
+
+    report = {"duration": duration, "stack_samples": sampler.samples}
+    profiler = getattr(server, "profiler", None)
+    if profiler is not None:
+        report["sampled_connections"] = profiler.sampled
+        report["stages"] = profiler.report()
+    cipher = getattr(server, "cipher", None)
+    if cipher is not None:
+        # 加密解密总耗时中 zlib 以外的部分为 cipher，即 report["cipher"]
+        # 所指加密器本身的耗时，mix 为异或，其他为 AEAD 加密和认证
+        stats = cipher.stats
+        report["cipher"] = cipher.name
+        report["cipher_cpu_seconds"] = {
+            "zlib": stats["compress_time"] + stats["decompress_time"],
+            "cipher": (stats["encrypt_time"] + stats["decrypt_time"] -
+                       stats["compress_time"] - stats["decompress_time"]),
+        }
+    with open(prefix + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+    log.info("Profile written to %s.*", prefix)
+    return prefix
+
+
+def install_signal_handler(server, directory, duration=10):
+    """收到 SIGUSR1 时在后台线程中执行 dump_profile，需在主线程中调用"""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    running = Lock()
+
+    def dump():
+        try:
+            dump_profile(server, directory, duration)
+        except Exception as e:
+            logging.getLogger().error("Profile failed: %s", e)
+        finally:
+            running.release()
+
+    def handle(signum, frame):
+        if running.acquire(blocking=False):
+            Thread(target=dump, daemon=True).start()
+
+    os.makedirs(directory, exist_ok=True)
+    signal.signal(signal.SIGUSR1, handle)
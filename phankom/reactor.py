@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 18:05:29
+# *************************************************************
+
+"""基于 selectors 的数据交换
+
+握手完成的连接交给 Reactor，由固定数量的线程各自用一个 selector(Linux 上为 epoll)
+同时处理许多连接的数据交换。套接字均为非阻塞模式，写不完的数据留在输出缓冲区中，
+等到可写时再发送，一个慢速的客户端不会阻塞线程中的其他连接。
+
+输出缓冲区有上下水位: 超过上水位时暂停读取另一端，降到下水位以下才恢复；
+所有连接的缓冲总量超过内存预算时，缓冲区不为空的连接都暂停读取，
+直到各自的缓冲区发送完毕，以保证每个连接仍能逐步推进
+"""
+
+import socket
+import logging
+import selectors
+from threading import Thread, Lock
+from collections import Counter, deque
+
+from .utils import shutdown_write
+
+
+class Relay(object):
+    """一对套接字之间的非阻塞数据交换
+
+    参数:
+        a, b: 两端的套接字
+        read_a, read_b: 读取函数，参数为对应的套接字，返回 (要发给另一端的数据,
+            是否已读到结束)，暂时没有数据时返回空字节串
+        initial: (发给 a 的数据, 发给 b 的数据)，例如握手时多读入的数据
+        on_close: 结束时的回调，参数为本实例，负责关闭套接字
+        fins: (结束 a 的写方向的函数, 结束 b 的)，另一端读到结束时调用，
+            返回追加到输出缓冲区的数据，例如隧道上的结束帧，
+            为 None 时在缓冲区发送完毕后 shutdown(SHUT_WR)
+        high_water, low_water: 输出缓冲区的上下水位，由 Reactor 设置
+
+    每个方向的缓冲量不超过 high_water 加上一次读取的数据量。
+    两个方向分别结束，都读到结束且已缓冲的数据发送完毕后整个交换才结束
+    """
+
+    high_water = 256 * 1024
+    low_water = 64 * 1024
+
+    def __init__(self, a, b, read_a, read_b, initial=(b'', b''),
+                 on_close=None, fins=(None, None)):
+        self.socks = (a, b)
+        self.peers = {a: b, b: a}
+        self.readers = {a: read_a, b: read_b}
+        self.fins = {a: fins[0], b: fins[1]}
+        self.output = {a: bytearray(initial[0]), b: bytearray(initial[1])}
+        self.on_close = on_close
+        self.session = None  # 见 sweeper 模块，收到数据时更新活动时间
+        self.eof = {a: False, b: False}  # 套接字 -> 是否已读到结束
+        self.shut = {a: False, b: False}  # 套接字 -> 写方向是否已结束
+        self.closed = False
+        self.registered = {a: 0, b: 0}  # 套接字 -> 已注册的事件
+        self.paused = {a: None, b: None}  # 套接字 -> 暂停读取的原因
+        self.accounted = 0  # 已计入 ReactorLoop.buffered 的字节数
+
+    @property
+    def finished(self):
+        return all(self.eof.values()) and not any(self.output.values())
+
+    @property
+    def buffered(self):
+        """两个方向上缓冲的字节数"""
+        return sum(len(buffer) for buffer in self.output.values())
+
+    def check_pause(self, sock, over_budget):
+        """按另一端的缓冲量更新 sock 的暂停状态，新进入暂停时返回原因"""
+        pending = len(self.output[self.peers[sock]])
+        paused = self.paused[sock]
+        reason = None
+        if not pending:
+            pass
+        elif (pending >= self.high_water or
+                (paused == "watermark" and pending > self.low_water)):
+            reason = "watermark"
+        elif over_budget:
+            reason = "budget"
+        self.paused[sock] = reason
+        return reason if reason != paused else None
+
+    def interest(self, sock):
+        """返回 sock 当前需要关注的事件"""
+        events = 0
+        if not self.eof[sock] and not self.paused[sock]:
+            events |= selectors.EVENT_READ
+        if self.output[sock]:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def flush(self, sock):
+        """尽可能多地发送 sock 的输出缓冲区，另一端已结束时随后结束写方向"""
+        buffer = self.output[sock]
+        while buffer:
+            try:
+                size = sock.send(buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            del buffer[:size]
+        if self.eof[self.peers[sock]] and not self.shut[sock]:
+            self.shut[sock] = True
+            shutdown_write(sock)
+
+    def flush_all(self):
+        for sock in self.socks:
+            self.flush(sock)
+
+    def read(self, sock):
+        try:
+            data, eof = self.readers[sock](sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        peer = self.peers[sock]
+        if data:
+            self.output[peer] += data
+            if self.session is not None:
+                self.session.touch()
+        if eof:
+            self.eof[sock] = True
+            fin = self.fins[peer]
+            if fin is not None:
+                self.output[peer] += fin()
+                self.shut[peer] = True
+        self.flush(peer)
+
+
+class ReactorLoop(object):
+    """在一个线程中用一个 selector 处理多个 Relay"""
+
+    def __init__(self, name, reactor):
+        self.name = name
+        self.reactor = reactor
+        self.selector = selectors.DefaultSelector()
+        self.relays = set()
+        self.buffered = 0  # 本线程中所有 Relay 缓冲的字节数
+        self.log = logging.getLogger()
+
+        self._incoming = deque()
+        self._waker, self._wakeup = socket.socketpair()
+        self._waker.setblocking(False)
+        self._wakeup.setblocking(False)
+        self.selector.register(self._waker, selectors.EVENT_READ, None)
+        self._thread = None
+
+    def add(self, relay):
+        """添加 Relay，可以在其他线程中调用"""
+        self._incoming.append(relay)
+        try:
+            self._wakeup.send(b"\x00")
+        except BlockingIOError:
+            pass
+
+    def _accept_incoming(self):
+        try:
+            while self._waker.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._incoming:
+            relay = self._incoming.popleft()
+            for sock in relay.socks:
+                sock.setblocking(False)
+            self.relays.add(relay)
+            self._process(relay, relay.flush_all)
+
+    def _update(self, relay):
+        over_budget = self.reactor.over_budget
+        for sock in relay.socks:
+            reason = relay.check_pause(sock, over_budget)
+            if reason:
+                self.reactor.stats["pauses_" + reason] += 1
+            events = relay.interest(sock)
+            registered = relay.registered[sock]
+            if events == registered:
+                continue
+            if not registered:
+                self.selector.register(sock, events, relay)
+            elif not events:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, events, relay)
+            relay.registered[sock] = events
+
+    def _account(self, relay):
+        """将 Relay 缓冲量的变化计入本线程"""
+        size = relay.buffered
+        self.buffered += size - relay.accounted
+        relay.accounted = size
+        self.reactor.update_peak()
+
+    def _close(self, relay):
+        relay.closed = True
+        self.relays.discard(relay)
+        self.buffered -= relay.accounted
+        relay.accounted = 0
+        for sock in relay.socks:
+            if relay.registered[sock]:
+                self.selector.unregister(sock)
+                relay.registered[sock] = 0
+        if relay.on_close:
+            relay.on_close(relay)
+
+    def _process(self, relay, action, *args):
+        """执行 action 后更新 Relay 的状态，出错或结束时关闭"""
+        try:
+            action(*args)
+            self._account(relay)
+            if relay.finished:
+                self._close(relay)
+            else:
+                self._update(relay)
+        except Exception as e:
+            self.log.debug("Relay closed: %s", e)
+            self._close(relay)
+
+    def _handle(self, relay, sock, events):
+        if events & selectors.EVENT_WRITE:
+            relay.flush(sock)
+        if events & selectors.EVENT_READ:
+            relay.read(sock)
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select():
+                relay = key.data
+                if relay is None:
+                    self._accept_incoming()
+                elif not relay.closed:
+                    self._process(relay, self._handle, relay, key.fileobj,
+                                  events)
+
+    def start(self):
+        self._thread = Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+
+
+class Reactor(object):
+    """固定数量的线程处理所有连接的数据交换，新的 Relay 交给连接最少的线程
+
+    参数:
+        threads: 线程数
+        buffer_size: 每个方向输出缓冲区的上水位，下水位为其 1/4
+        memory_limit: 所有连接的缓冲总量上限，为 0 时不限制
+
+    必须在服务器进程中调用 start，以免 fork 后子进程中没有对应的线程。
+    stats 中记录了因上水位和内存预算暂停读取的次数 pauses_watermark
+    和 pauses_budget
+    """
+
+    def __init__(self, threads=1, buffer_size=256 * 1024,
+                 memory_limit=64 * 1024 * 1024):
+        self.threads = threads
+        self.high_water = buffer_size
+        self.low_water = buffer_size // 4
+        self.memory_limit = memory_limit
+        self.stats = Counter()
+        self.peak = 0  # 缓冲总量的峰值
+        self.loops = []
+        self._lock = Lock()
+
+    @property
+    def buffered(self):
+        """所有连接缓冲的字节数"""
+        return sum(loop.buffered for loop in self.loops)
+
+    @property
+    def over_budget(self):
+        return bool(self.memory_limit) and self.buffered > self.memory_limit
+
+    def update_peak(self):
+        buffered = self.buffered
+        if buffered > self.peak:
+            self.peak = buffered
+
+    @property
+    def relays(self):
+        """正在交换数据的连接数"""
+        return sum(len(loop.relays) + len(loop._incoming)
+                   for loop in self.loops)
+
+    def start(self):
+        with self._lock:
+            if self.loops:
+                return
+            for index in range(self.threads):
+                loop = ReactorLoop("relay-%s" % index, self)
+                loop.start()
+                self.loops.append(loop)
+
+    def add(self, relay):
+        relay.high_water = self.high_water
+        relay.low_water = self.low_water
+        with self._lock:
+            loop = min(self.loops, key=lambda loop: (len(loop.relays) +
+                                                     len(loop._incoming)))
+        loop.add(relay)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 23:12:40
+# *************************************************************
+
+"""分流规则
+
+本地服务器按目的地址决定每个连接的处理方式:
+    direct: 直接连接目的地址，不经过远程服务器
+    tunnel: 经由隧道连接
+    block: 拒绝连接
+
+规则由域名和 IP 网段组成，域名规则匹配该域名及其所有子域名，
+网段规则匹配其中的 IP 地址，都以最长匹配为准。
+规则集在启动和重新加载时编译一次:
+    DomainTrie: 按标签逆序(从顶级域名开始)组织的字典树，查找次数等于标签数
+    CidrTable: 网段展开成互不重叠的区间，按起始地址排序，查找为一次二分
+
+规则文件每行一条规则，# 之后为注释，整个文件的规则使用同一种处理方式
+"""
+
+import signal
+import socket
+import logging
+import ipaddress
+from bisect import bisect_right
+from threading import Lock, Thread
+from collections import Counter, OrderedDict
+
+from .utils import affirm
+
+
+ACTIONS = ("direct", "tunnel", "block")
+
+# 本机和局域网地址，可通过 direct_private 直接连接
+PRIVATE_NETWORKS = ("localhost", "127.0.0.0/8", "10.0.0.0/8", "172.16.0.0/12",
+                    "192.168.0.0/16", "169.254.0.0/16", "100.64.0.0/10",
+                    "::1/128", "fc00::/7", "fe80::/10")
+
+
+def parse_ip(host):
+    """返回 IP 地址的二进制形式，host 不是 IP 地址时返回 None"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, host)
+        except OSError:
+            pass
+    return None
+
+
+def read_rules(path):
+    """读取规则文件，返回其中的规则列表"""
+    rules = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            rule = line.split("#", 1)[0].strip()
+            if rule:
+                rules.append(rule)
+    return rules
+
+
+class DomainTrie(object):
+    """域名字典树，每个节点是一个以标签为键的字典，None 键上为该域名的处理方式"""
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, domain, action):
+        """添加规则，同一域名的规则后添加的生效，'*.example.com' 与 'example.com' 相同"""
+        node = self.root
+        domain = domain.lower().strip(".")
+        if domain.startswith("*."):
+            domain = domain[2:]
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        if None not in node:
+            self.size += 1
+        node[None] = action
+
+    def lookup(self, host):
+        """返回匹配 host 的最长域名规则的处理方式，没有匹配的规则时返回 None"""
+        node = self.root
+        action = None
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            action = node.get(None, action)
+        return action
+
+
+class CidrTable(object):
+    """IP 网段表
+
+    add 收集网段，compile 将每个地址族的网段展开成互不重叠的区间:
+    starts 为各区间的起始地址(整数)，actions 为对应的处理方式，None 为不匹配。
+    网段之间只有包含和不相交两种关系，按起始地址排序后用栈即可展开，
+    被包含的网段覆盖其外层网段，与最长前缀匹配的结果相同
+    """
+
+    def __init__(self):
+        self._networks = {4: [], 16: []}  # 地址字节数 -> [(起始, 结束, 处理方式)]
+        self._tables = {}                 # 地址字节数 -> (starts, actions)
+
+    def __len__(self):
+        return sum(len(networks) for networks in self._networks.values())
+
+    def add(self, network, action):
+        """添加规则，network 为 '10.0.0.0/8' 格式的网段或单个地址"""
+        network = ipaddress.ip_network(network, strict=False)
+        start = int(network.network_address)
+        self._networks[4 if network.version == 4 else 16].append(
+            (start, start + network.num_addresses, action))
+
+    @staticmethod
+    def _flatten(networks):
+        starts, actions = [], []
+
+        def mark(point, action):
+            if starts and starts[-1] == point:
+                actions[-1] = action
+            else:
+                starts.append(point)
+                actions.append(action)
+
+        # 同一起始地址的网段大的在前，相同的网段按添加顺序，后添加的生效
+        networks = sorted(enumerate(networks),
+                          key=lambda item: (item[1][0], -item[1][1], item[0]))
+        stack = []  # 包含当前位置的网段 (结束, 处理方式)，内层在后
+        for _, (start, end, action) in networks:
+            while stack and stack[-1][0] <= start:
+                stack_end = stack.pop()[0]
+                mark(stack_end, stack[-1][1] if stack else None)
+            mark(start, action)
+            stack.append((end, action))
+        while stack:
+            stack_end = stack.pop()[0]
+            mark(stack_end, stack[-1][1] if stack else None)
+        return starts, actions
+
+    def compile(self):
+        self._tables = {size: self._flatten(networks)
+                        for size, networks in self._networks.items()
+                        if networks}
+
+    def lookup(self, packed):
+        """返回匹配二进制形式的 IP 地址的处理方式，没有匹配的网段时返回 None"""
+        table = self._tables.get(len(packed))
+        if table is None:
+            return None
+        starts, actions = table
+        index = bisect_right(starts, int.from_bytes(packed, "big")) - 1
+        return actions[index] if index >= 0 else None
+
+
+class Router(object):
+    """分流路由
+
+    参数:
+        rules: (处理方式, 域名或网段) 列表
+        files: (处理方式, 规则文件路径) 列表，reload 时重新读取
+        default: 没有匹配的规则时的处理方式
+        resolve: 为真时未匹配域名规则的域名解析后按网段规则匹配，
+            否则直接使用 default
+        cache_size: 缓存的决策数，按最近最少使用淘汰，0 为不缓存
+        direct_private: 本机和局域网地址直接连接，优先级低于其他规则
+
+    同一域名或网段有多条规则时后出现的生效，files 中的规则在 rules 之后。
+    域名解析后得到的决策与域名一起缓存，直到被淘汰或重新加载。
+    stats 中按处理方式记录了决策数，并在 cache_hits 和 cache_misses 中
+    记录了缓存的命中情况
+    """
+
+    def __init__(self, rules=(), files=(), default="tunnel", resolve=False,
+                 cache_size=4096, direct_private=False):
+        affirm(default in ACTIONS, "Unsupported route action: '%s'" % default)
+        self.rules = list(rules)
+        self.files = list(files)
+        self.default = default
+        self.resolve = resolve
+        self.cache_size = cache_size
+        self.direct_private = direct_private
+        self.stats = Counter()
+        self.log = logging.getLogger()
+
+        self._lock = Lock()
+        self._cache = OrderedDict()  # 目的地址 -> 处理方式
+        self.reload()
+
+    def __len__(self):
+        return len(self._domains) + len(self._networks)
+
+    def _compile(self):
+        """读取规则文件并编译规则，返回 (域名树, 网段表)"""
+        rules = []
+        if self.direct_private:
+            rules.extend(("direct", rule) for rule in PRIVATE_NETWORKS)
+        rules.extend(self.rules)
+        for action, path in self.files:
+            rules.extend((action, rule) for rule in read_rules(path))
+
+        domains, networks = DomainTrie(), CidrTable()
+        for action, rule in rules:
+            affirm(action in ACTIONS, "Unsupported route action: '%s'" % action)
+            try:
+                networks.add(rule, action)
+            except ValueError:
+                domains.add(rule, action)
+        networks.compile()
+        return domains, networks
+
+    def reload(self):
+        """重新读取规则文件并编译，编译完成后替换原有规则并清空缓存
+
+        编译失败时抛出异常，原有规则不受影响
+        """
+        domains, networks = self._compile()
+        with self._lock:
+            self._domains, self._networks = domains, networks
+            self._cache = OrderedDict()
+        self.log.info("Loaded %s domain and %s network route rules",
+                      len(domains), len(networks))
+
+    def _cached(self, host):
+        with self._lock:
+            action = self._cache.get(host)
+            if action is None:
+                self.stats["cache_misses"] += 1
+                return None
+            self._cache.move_to_end(host)
+        self.stats["cache_hits"] += 1
+        self.stats[action] += 1
+        return action
+
+    def _store(self, host, action):
+        self.stats[action] += 1
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[host] = action
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def route(self, host):
+        """返回目的地址 host 的处理方式
+
+        启用了 resolve 且 host 为未匹配任何规则的域名时返回 None，
+        此时需解析后调用 route_resolved
+        """
+        action = self._cached(host)
+        if action is not None:
+            return action
+        packed = parse_ip(host)
+        if packed is not None:
+            action = self._networks.lookup(packed)
+        else:
+            action = self._domains.lookup(host.lower().rstrip("."))
+            if action is None and self.resolve:
+                return None
+        action = action or self.default
+        self._store(host, action)
+        return action
+
+    def route_resolved(self, host, ip):
+        """按域名 host 解析得到的地址 ip 决定处理方式，解析失败时 ip 为 None"""
+        if ip is None:
+            self.stats[self.default] += 1
+            return self.default
+        packed = parse_ip(ip)
+        action = (packed and self._networks.lookup(packed)) or self.default
+        self._store(host, action)
+        return action
+
+
+def install_reload_handler(router):
+    """收到 SIGHUP 时在后台线程中重新加载规则，需在主线程中调用"""
+    if not hasattr(signal, "SIGHUP"):
+        return
+    log = logging.getLogger()
+
+    def reload():
+        try:
+            router.reload()
+        except Exception as e:
+            log.error("Route rules reload failed: %s", e)
+
+    def handle(signum, frame):
+        Thread(target=reload, daemon=True).start()
+
+    signal.signal(signal.SIGHUP, handle)
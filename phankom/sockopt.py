@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 21:03:44
+# *************************************************************
+
+"""TCP 套接字选项
+
+监听套接字、接受的客户端连接和到上游的连接使用同一组选项。
+接收缓冲区的大小决定了握手时协商的窗口扩大因子，所以缓冲区大小在监听和连接之前设置，
+接受的连接从监听套接字继承
+"""
+
+import sys
+import struct
+import socket
+from collections import Counter
+
+
+# 客户端的 TCP Fast Open，Linux 4.11 起支持，Python 中没有对应的常量
+TCP_FASTOPEN_CONNECT = getattr(
+    socket, "TCP_FASTOPEN_CONNECT",
+    30 if sys.platform.startswith("linux") else None)
+# 保活探测前的空闲时间，macOS 上名为 TCP_KEEPALIVE
+TCP_KEEPIDLE = getattr(socket, "TCP_KEEPIDLE",
+                       getattr(socket, "TCP_KEEPALIVE", None))
+# Linux 的 struct tcp_info 中 tcpi_rtt(微秒)的偏移
+TCP_INFO_RTT = struct.Struct("=I")
+TCP_INFO_RTT_OFFSET = 68
+
+
+class SocketOptions(object):
+    """一组 TCP 套接字选项
+
+    参数:
+        nodelay: 关闭 Nagle 算法，小块的交互数据立即发送
+        sndbuf, rcvbuf: 发送和接收缓冲区的字节数，0 为系统默认
+        keepalive: 连接空闲这么多秒后开始保活探测，0 为不启用
+        keepalive_interval, keepalive_count: 保活探测的间隔秒数和次数
+        fastopen: 大于 0 时启用 TCP Fast Open，监听套接字上为等待队列的长度
+        notsent_lowat: 内核中尚未发出的数据少于这么多字节时套接字才可写，
+            避免大量数据积压在发送缓冲区中，0 为系统默认
+        autotune_rate: 大于 0 时连接建立后按测得的 RTT 将两个缓冲区设为
+            带宽时延积，此为目标带宽(字节/秒)，RTT 未知时不调整
+        autotune_max: 自动调整后的缓冲区上限
+
+    上游连接启用 Fast Open 后 SYN 推迟到首次发送时发出，连接耗时和多地址竞速
+    都不再反映真实的握手，连接失败在首次读写时才暴露。
+    系统不支持的选项被跳过，stats 中按选项名记录了设置失败的次数，
+    并在 autotuned 中记录了自动调整过缓冲区的连接数
+    """
+
+    # 自动调整的缓冲区下限，不小于多数系统的默认值
+    AUTOTUNE_MIN = 64 * 1024
+
+    def __init__(self, nodelay=True, sndbuf=0, rcvbuf=0, keepalive=0,
+                 keepalive_interval=10, keepalive_count=3, fastopen=0,
+                 notsent_lowat=0, autotune_rate=0,
+                 autotune_max=16 * 1024 * 1024):
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.keepalive = keepalive
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.fastopen = fastopen
+        self.notsent_lowat = notsent_lowat
+        self.autotune_rate = autotune_rate
+        self.autotune_max = autotune_max
+        self.stats = Counter()
+
+    def _set(self, sock, level, option, value, name):
+        """设置一个选项，系统不支持时记录失败并返回 False"""
+        if option is None:
+            self.stats[name] += 1
+            return False
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError:
+            self.stats[name] += 1
+            return False
+        return True
+
+    def _set_buffers(self, sock):
+        if self.sndbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf,
+                      "sndbuf")
+        if self.rcvbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf,
+                      "rcvbuf")
+
+    def apply_listener(self, sock):
+        """设置监听套接字，需在 listen 之前调用"""
+        self._set_buffers(sock)
+        if self.fastopen:
+            self._set(sock, socket.IPPROTO_TCP,
+                      getattr(socket, "TCP_FASTOPEN", None), self.fastopen,
+                      "fastopen")
+
+    def prepare(self, sock):
+        """设置将要发起连接的套接字，需在 connect 之前调用"""
+        self._set_buffers(sock)
+        if self.fastopen:
+            self._set(sock, socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1,
+                      "fastopen")
+
+    def apply(self, sock, rtt=None):
+        """设置已建立的连接，rtt 为已知的往返时间(秒)，用于系统无法提供时"""
+        if sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        if self.nodelay:
+            self._set(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1,
+                      "nodelay")
+        if self.keepalive:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1,
+                      "keepalive")
+            self._set(sock, socket.IPPROTO_TCP, TCP_KEEPIDLE,
+                      int(self.keepalive), "keepalive")
+            self._set(sock, socket.IPPROTO_TCP,
+                      getattr(socket, "TCP_KEEPINTVL", None),
+                      int(self.keepalive_interval), "keepalive")
+            self._set(sock, socket.IPPROTO_TCP,
+                      getattr(socket, "TCP_KEEPCNT", None),
+                      self.keepalive_count, "keepalive")
+        if self.notsent_lowat:
+            self._set(sock, socket.IPPROTO_TCP,
+                      getattr(socket, "TCP_NOTSENT_LOWAT", None),
+                      self.notsent_lowat, "notsent_lowat")
+        if self.autotune_rate:
+            self.autotune(sock, self.measure_rtt(sock) or rtt)
+
+    @staticmethod
+    def measure_rtt(sock):
+        """返回内核测得的平滑 RTT(秒)，系统不支持或尚无测量值时返回 None"""
+        if not hasattr(socket, "TCP_INFO"):
+            return None
+        try:
+            info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO,
+                                   TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size)
+        except OSError:
+            return None
+        if len(info) < TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size:
+            return None
+        rtt = TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)[0]
+        return rtt / 1e6 if rtt else None
+
+    def buffer_size(self, rtt):
+        """目标带宽下 rtt 秒的带宽时延积，限制在上下限之间"""
+        size = int(self.autotune_rate * rtt)
+        return max(self.AUTOTUNE_MIN, min(size, self.autotune_max))
+
+    def autotune(self, sock, rtt):
+        """按 rtt 扩大连接的缓冲区，rtt 未知或缓冲区已经足够时不调整
+
+        设置了缓冲区大小后系统不再自动调整，所以只在需要扩大时设置
+        """
+        if not rtt:
+            return
+        size = self.buffer_size(rtt)
+        tuned = False
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                current = sock.getsockopt(socket.SOL_SOCKET, option)
+            except OSError:
+                current = 0
+            if size > current:
+                tuned |= self._set(sock, socket.SOL_SOCKET, option, size,
+                                   "autotune")
+        if tuned:
+            self.stats["autotuned"] += 1
@@ -9,21 +9,168 @@
 
 """Socks5 protocol frame"""
 
+import os
 import re
+import time
+import errno
 import socket
 import struct
-import select
+import asyncio
 import logging
 import traceback
-from threading import Thread
+from threading import Thread, Condition
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-from .utils import affirm
+from .dns import Resolver
+from .connect import Connector
+from .metrics import Histogram
+from .reactor import Reactor, Relay
+from .sweeper import Session, Sweeper
+from .sockopt import SocketOptions
+from .udp import ClientEnd, DirectEnd, UdpAssociation
+from .utils import affirm, wait_sockets, shutdown_write
+
+
+class RequestRefused(Exception):
+    """目的地址被拒绝，客户端已收到 CONNECTION_NOT_ALLOWED 响应"""
+
+    def __init__(self, host, port):
+        super().__init__("Connection to %s:%s not allowed" % (host, port))
+        self.host = host
+        self.port = port
+
+
+class SessionLimiter(object):
+    """会话准入控制
+
+    参数:
+        max_sessions: 同时处理的最大会话数，为空时不限制
+        overflow: 会话数达到上限后新连接的处理方式
+            queue: 接受连接并排队等待空闲，排队数超过 queue_size 时拒绝
+            reject: 直接关闭新连接
+            block: 暂停接受新连接，新连接留在内核的连接队列中
+        queue_size: 排队等待的最大连接数
+    """
+
+    OVERFLOW_POLICIES = ("queue", "reject", "block")
+
+    def __init__(self, max_sessions=None, overflow="queue", queue_size=128):
+        affirm(overflow in self.OVERFLOW_POLICIES,
+               "Unsupported overflow policy: '%s'" % overflow)
+        self.max_sessions = max_sessions
+        self.overflow = overflow
+        self.queue_size = queue_size if overflow == "queue" else 0
+
+        self.active = 0    # 正在处理的会话数
+        self.queued = 0    # 已接受但尚未开始处理的会话数
+        self.peak = 0      # 同时处理的会话数峰值
+        self.rejected = 0  # 被拒绝的连接数
+        self._cond = Condition()
+
+    def has_slot(self):
+        """是否还能开始处理新的会话"""
+        return (not self.max_sessions or
+                self.active + self.queued < self.max_sessions)
+
+    def wait_slot(self):
+        """overflow 为 block 时，阻塞直到有空闲的会话名额"""
+        if self.overflow != "block":
+            return
+        with self._cond:
+            self._cond.wait_for(self.has_slot)
+
+    def admit(self):
+        """判断是否接受新连接，接受的连接计入排队数"""
+        with self._cond:
+            if (self.max_sessions and
+                    self.active + self.queued >= self.max_sessions +
+                    self.queue_size and self.overflow != "block"):
+                self.rejected += 1
+                return False
+            self.queued += 1
+            return True
+
+    def enter(self):
+        """会话开始处理"""
+        with self._cond:
+            self.queued -= 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def leave(self):
+        """会话处理结束"""
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class HandshakeBuffer(object):
+    """SOCKS5 握手数据的增量解析
+
+    每次读取到的数据都追加到同一个缓冲区中，数据不足时解析函数返回 None，
+    客户端连续发送的认证协商和请求可以从一次读取的数据中依次解析出来。
+    解析完请求后缓冲区中剩余的数据是客户端提前发送的数据，需要转发给目的地址
+    """
+
+    # 各地址类型的地址长度，域名为变长
+    ADDR_SIZES = {0x01: 4, 0x04: 16}
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.replies = []  # 待与请求的响应一起发送的数据
+
+    def feed(self, data):
+        self.buffer += data
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def parse_greeting(self):
+        """解析认证协商，返回 (版本, 认证方法列表)"""
+        buffer = self.buffer
+        if len(buffer) < 2 or len(buffer) < 2 + buffer[1]:
+            return None
+        data = self._take(2 + buffer[1])
+        return data[0], list(data[2:])
+
+    def parse_request(self):
+        """解析请求，返回 (版本, 命令, 地址类型, 地址数据, 端口数据)
+
+        地址类型不支持时地址数据和端口数据为 None
+        """
+        buffer = self.buffer
+        if len(buffer) < 4:
+            return None
+        addr_type = buffer[3]
+        if addr_type == 0x03:
+            if len(buffer) < 5:
+                return None
+            addr_size = 1 + buffer[4]
+        elif addr_type in self.ADDR_SIZES:
+            addr_size = self.ADDR_SIZES[addr_type]
+        else:
+            head = self._take(4)
+            return head[0], head[1], addr_type, None, None
+        if len(buffer) < 4 + addr_size + 2:
+            return None
+        head = self._take(4)
+        return (head[0], head[1], addr_type, self._take(addr_size),
+                self._take(2))
+
+    def take_rest(self):
+        """取出缓冲区中剩余的数据"""
+        return self._take(len(self.buffer))
 
 
 class BaseSocks(object):
     """基础 Socks 协议"""
 
     BUFFER_SIZE = 10 * 1024
+    # 默认的管道容量
+    PIPE_SIZE = 64 * 1024
 
     AUTH_TYPES = {
         0x00: "NO_AUTH",
@@ -58,11 +205,16 @@ class BaseSocks(object):
 
     def __init__(self):
         self.log = logging.getLogger()
+        self.buffer_size = self.BUFFER_SIZE
+        self.sock = self._create_socket()
 
+    @staticmethod
+    def _create_socket():
         # 创建套接字
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # 允许地址重用
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return sock
 
     @staticmethod
     def _check_protocol_version(version):
@@ -70,12 +222,22 @@ class BaseSocks(object):
 
     def recv_data(self, sock=None, size=None):
         sock = sock or self.sock
-        return sock.recv(size or self.BUFFER_SIZE)
+        return sock.recv(size or self.buffer_size)
 
     def send_data(self, data, sock=None):
         sock = sock or self.sock
         sock.sendall(data)
 
+    async def _async_recv_data(self, sock=None, size=None):
+        sock = sock or self.sock
+        loop = asyncio.get_running_loop()
+        return await loop.sock_recv(sock, size or self.buffer_size)
+
+    async def _async_send_data(self, data, sock=None):
+        sock = sock or self.sock
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(sock, data)
+
     @staticmethod
     def _get_addr_type(addr):
         if re.match(r'(\d{1,3}\.){3}\d{1,3}$', addr):
@@ -92,48 +254,131 @@ class Socks5Server(BaseSocks):
     特性:
         认证方式仅支持无需认证和用户名密码认证两种方式
         使用 IO 多路复用处理数据交换
-        不支持 UDP 协议
+        支持每连接一个线程(start)和单事件循环(start_async)两种运行方式
+        线程模式下 relay_threads 大于 0 时，握手完成的连接交给这么多个线程的
+        Reactor 交换数据，处理握手的线程随即释放。每个方向最多缓冲约
+        relay_buffer_size 字节，所有连接的缓冲总量以 relay_memory_limit 为限
+        一端结束写方向后另一个方向继续交换，直到两个方向都结束
+        握手、空闲和存续时间超时的会话由后台线程回收，见 sweeper 模块
+        udp 为真时线程模式下支持 UDP ASSOCIATE，见 udp 模块，
+        超过 udp_timeout 秒没有发送过数据的目的地址不再转发其回复
+        socket_options 为 sockopt.SocketOptions，用于监听套接字、接受的连接
+        和到上游的连接，默认只关闭 Nagle 算法
     """
 
-    def __init__(self, host='0.0.0.0', port=1080):
+    def __init__(self, host='0.0.0.0', port=1080, buffer_size=None,
+                 backlog=128, max_sessions=None, overflow="queue",
+                 queue_size=128, reuse_port=False, dns_cache_size=1024,
+                 dns_ttl=60, dns_negative_ttl=5, connect_timeout=10,
+                 happy_eyeballs_delay=0.25, relay_threads=0,
+                 relay_buffer_size=256 * 1024,
+                 relay_memory_limit=64 * 1024 * 1024, idle_timeout=300,
+                 handshake_timeout=30, session_lifetime=0, udp=False,
+                 udp_timeout=60, socket_options=None):
         self.host = host
         self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port
 
         super().__init__()
-
-        self.sock.bind((self.host, self.port))
-        self.sock.listen(5)
+        if buffer_size:
+            self.buffer_size = buffer_size
+        # 会话数、转发字节数等计数，导出方式见 metrics 模块
+        self.stats = Counter()
+        # 异常类名 -> 因此失败的会话数
+        self.errors = Counter()
+        self.handshake_latency = Histogram()
+        self.connect_latency = Histogram()
+        # 多进程服务时子进程的序号
+        self.worker_id = 0
+        self.limiter = SessionLimiter(max_sessions, overflow, queue_size)
+        self.resolver = Resolver(dns_cache_size, dns_ttl, dns_negative_ttl)
+        self.socket_options = socket_options or SocketOptions()
+        self.connector = Connector(happy_eyeballs_delay, connect_timeout,
+                                   options=self.socket_options)
+        self.reactor = (Reactor(relay_threads, relay_buffer_size,
+                                relay_memory_limit)
+                        if relay_threads else None)
+        timeouts = [timeout for timeout in (idle_timeout, handshake_timeout,
+                                            session_lifetime) if timeout]
+        self.sweeper = Sweeper(idle_timeout, handshake_timeout,
+                               session_lifetime,
+                               min([1] + [timeout / 4 for timeout in timeouts]))
+        self.udp = udp
+        self.udp_timeout = udp_timeout
+        # 监听套接字与其他进程共享，由 Supervisor 在子进程中设置
+        self.shared_listener = False
+        self._stopping = False
+        self._serving = None  # asyncio 模式下的 (事件循环, 接受连接的任务)
+
+        self._listen((self.host, self.port))
+
+    def _listen(self, address):
+        if self.reuse_port:
+            affirm(hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT not supported")
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket_options.apply_listener(self.sock)
+        self.sock.bind(address)
+        self.sock.listen(self.backlog)
+        # 实际监听的地址，端口为 0 时由系统分配
+        self.address = self.sock.getsockname()
+
+    def reopen(self):
+        """关闭监听套接字并在同一地址上重新监听
+
+        用于 reuse_port 模式下的多进程服务，每个进程拥有独立的连接队列
+        """
+        self.sock.close()
+        self.sock = self._create_socket()
+        self._listen(self.address)
 
     def __user_auth(self, user, passwd):
         """用户名密码认证"""
         pass
 
-    def _check_auth(self, sock):
-        """校验认证方式"""
-        data = sock.recv(256)
-        affirm(data, "No auth information")
-
-        version = data[0]
+    def _auth_reply(self, greeting):
+        """按客户端的认证协商选择认证方法，返回 (认证方法, 响应)"""
+        version, methods = greeting
         self._check_protocol_version(version)
+        affirm(methods, "No auth information")
+        method = methods[0]
+        if method not in (0x00, 0x02):
+            # 其他认证方式均不支持
+            method = 0xFF
+        return method, b"\x05" + bytes((method,))
+
+    def _recv_handshake(self, sock, handshake, parse):
+        """读取数据直到 parse 能从握手缓冲区中解析出结果"""
+        result = parse()
+        while result is None:
+            data = sock.recv(self.buffer_size)
+            affirm(data, "Connection closed during handshake")
+            handshake.feed(data)
+            result = parse()
+        return result
 
-        methods_len = data[1]
-        methods = [method for method in data[2:]]
-        affirm(methods_len == len(methods),
-               "NMETHODS Error: '%s != %s'" % (methods_len, len(methods)))
+    def _check_auth(self, sock):
+        """校验认证方式，返回握手缓冲区
 
-        method = methods[0]
-        if method == 0x00:
+        客户端已连续发送了请求时，认证的响应与请求的响应一起发送
+        """
+        handshake = HandshakeBuffer()
+        greeting = self._recv_handshake(sock, handshake,
+                                        handshake.parse_greeting)
+        method, reply = self._auth_reply(greeting)
+        if method == 0x00 and handshake.buffer:
+            handshake.replies.append(reply)
+        elif method == 0x00:
             # 无需进一步认证
-            sock.sendall(b"\x05\x00")
+            sock.sendall(reply)
         elif method == 0x02:
             # 用户名密码认证方式
-            sock.sendall(b"\x05\x02")
+            sock.sendall(reply)
             self.__user_auth(sock)
         else:
-            # 其他认证方式均不支持
-            method = 0xFF
-            sock.sendall(b"\x05\xFF")
+            sock.sendall(reply)
             raise Exception(self.AUTH_TYPES[method])
+        return handshake
 
     def _connet_remote(self, addr, port, addr_data=None):
         """连接远程服务器
@@ -146,106 +391,574 @@ class Socks5Server(BaseSocks):
 
         返回远程服务器连接套接字
         """
-        return socket.create_connection((addr, port))
+        start = time.perf_counter()
+        infos = self.resolver.resolve(addr, port)
+        remote = self.connector.connect(addr, port, infos)
+        self.connect_latency.observe(time.perf_counter() - start)
+        return remote
 
-    def _handle_request(self, sock, addr):
-        """处理请求信息"""
-        data = sock.recv(4)
-        affirm(data, "No request information")
+    def _select_upstream(self, addr, port):
+        """在响应请求之前选择连接目的地址的方式
 
-        # 检查协议版本
-        version = data[0]
-        self._check_protocol_version(version)
+        返回连接函数，参数和返回值同 _connet_remote，拒绝连接时返回 None
+        """
+        return self._connet_remote
 
-        # 检查请求命令，只处理 CONNECT 请求
-        cmd = data[1]
-        affirm(cmd == 0x01, "Unsupported Request Command: '{}'".format(
-                self.REQUEST_COMMANDS[cmd]))
+    def _request_reply(self, status, bind=None):
+        """生成请求的响应
+
+        bind 为 (绑定地址, 端口)，默认为服务器的地址和一个固定的端口
+        """
+        host, port = bind or (self.host, 8888)
+        return (b"\x05" + bytes((status,)) + b"\x00\x01" +
+                socket.inet_aton(host) + struct.pack(">H", port))
 
-        # 转换主机绑定的地址和端口为字节，响应客户端用
-        host_addr = socket.inet_aton(self.host)
-        host_port = struct.pack(">H", 8888)
+    def _parse_request(self, request):
+        """检查请求的版本，返回 (目的地址, 端口, 目的地址信息)，地址类型不支持时返回 None
 
-        # 判断地址类型并获取目的地址
-        addr_type = data[3]
+        目的地址信息包括地址类型、地址内容和端口，用于发给下一级中转服务器
+        """
+        version, cmd, addr_type, addr_data, port_data = request
+        self._check_protocol_version(version)
+        if addr_data is None:
+            return None
         if addr_type == 1:
-            # IPv4 地址，目的地址为 4 字节长度
-            remote_addr_data = sock.recv(4)
-            remote_addr = socket.inet_ntoa(remote_addr_data)
+            remote_addr = socket.inet_ntoa(addr_data)
         elif addr_type == 3:
             # 域名，第一个字节为域名长度，剩余的内容为域名
-            addr_len_data = sock.recv(1)
-            addr_len = int.from_bytes(addr_len_data, byteorder='big')
-            remote_addr = sock.recv(addr_len)
-            remote_addr_data = addr_len_data + remote_addr
-        elif addr_type == 4:
-            # IPv6 地址，目的地址为 16 个字节长度
-            remote_addr_data = sock.recv(16)
-            remote_addr = socket.inet_ntop(socket.AF_INET6, remote_addr_data)
+            remote_addr = addr_data[1:].decode("utf-8")
         else:
+            remote_addr = socket.inet_ntop(socket.AF_INET6, addr_data)
+        remote_port = struct.unpack('>H', port_data)[0]
+        return (remote_addr, remote_port,
+                bytes((addr_type,)) + addr_data + port_data)
+
+    def _unsupported_command(self, request, commands):
+        """请求的命令不在 commands 中时返回异常，否则返回 None"""
+        cmd = request[1]
+        if cmd in commands:
+            return None
+        return Exception("Unsupported Request Command: '{}'".format(
+            self.REQUEST_COMMANDS.get(cmd, cmd)))
+
+    def _send_early_data(self, remote, data):
+        """转发客户端在收到请求的响应之前就发送了的数据"""
+        self.stats["bytes_up"] += len(data)
+        remote.sendall(data)
+
+    def _handle_request(self, sock, addr, handshake=None):
+        """处理请求信息，handshake 为 _check_auth 返回的握手缓冲区"""
+        handshake = handshake or HandshakeBuffer()
+        request = self._recv_handshake(sock, handshake,
+                                       handshake.parse_request)
+        target = self._parse_request(request)
+        # 只处理 CONNECT 请求，启用了 UDP 时还处理 UDP ASSOCIATE
+        error = self._unsupported_command(request,
+                                          (0x01, 0x03) if self.udp else (0x01,))
+        if error is not None:
+            sock.sendall(b"".join(handshake.replies) +
+                         self._request_reply(0x07))
+            raise error
+        if target is None:
             # 不支持的地址类型
-            reply = b"\x05\x08\x00\x00" + host_addr + host_port
-            sock.send(reply)
-            raise Exception("Address type not supported: '%#x'" % addr_type)
-        remote_addr = remote_addr.decode("utf-8")
-
-        # 获取目的地址端口号，2 字节长度
-        remote_port_data = sock.recv(2)
-        remote_port = struct.unpack('>H', remote_port_data)[0]
-
-        # 响应客户端的请求 SUCCESS
-        reply = b"\x05\x00\x00\x01" + host_addr + host_port
-        sock.send(reply)
+            sock.sendall(b"".join(handshake.replies) +
+                         self._request_reply(0x08))
+            raise Exception("Address type not supported: '%#x'" % request[2])
+        if request[1] == 0x03:
+            return self._associate_udp(sock, addr, handshake)
+        remote_addr, remote_port, remote_addr_data = target
+        connect = self._select_upstream(remote_addr, remote_port)
+        if connect is None:
+            sock.sendall(b"".join(handshake.replies) +
+                         self._request_reply(0x02))
+            raise RequestRefused(remote_addr, remote_port)
+
+        # 响应客户端的请求 SUCCESS，与尚未发送的认证响应合并为一次发送
+        sock.sendall(b"".join(handshake.replies) + self._request_reply(0x00))
 
         # 尝试连接远程服务器，准备传输数据
         self.log.info("Connecting %s:%s from %s:%s",
-                      remote_addr, remote_port, *addr)
-        remote_addr_data = (struct.pack(">B", addr_type) +
-                            remote_addr_data +
-                            remote_port_data)
-        return self._connet_remote(remote_addr, remote_port, remote_addr_data)
+                      remote_addr, remote_port, *addr[:2])
+        remote = connect(remote_addr, remote_port, remote_addr_data)
+        early_data = handshake.take_rest()
+        if early_data:
+            try:
+                self._send_early_data(remote, early_data)
+            except Exception:
+                remote.close()
+                raise
+        return remote
+
+    def _open_udp_upstream(self):
+        """返回 UDP 关联中目的地址一侧的一端，子类可以改为经由隧道转发"""
+        return DirectEnd(self.resolver, self.stats, self.udp_timeout)
+
+    def _associate_udp(self, sock, addr, handshake):
+        """处理 UDP ASSOCIATE 请求，返回 UdpAssociation
+
+        在接受控制连接的地址上绑定 UDP 端口并在响应中告知客户端，
+        客户端声明的发送地址通常为全零，不作检查
+        """
+        udp_sock = None
+        try:
+            udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_sock.setblocking(False)
+            udp_sock.bind((sock.getsockname()[0], 0))
+            upstream = self._open_udp_upstream()
+        except Exception:
+            if udp_sock is not None:
+                udp_sock.close()
+            sock.sendall(b"".join(handshake.replies) +
+                         self._request_reply(0x01))
+            raise
+        sock.sendall(b"".join(handshake.replies) +
+                     self._request_reply(0x00, udp_sock.getsockname()))
+        self.stats["udp_associations"] += 1
+        self.log.info("UDP association at %s:%s from %s:%s",
+                      *(udp_sock.getsockname() + addr[:2]))
+        return UdpAssociation(ClientEnd(udp_sock, addr[0], self.stats),
+                              upstream, self.stats, control=sock)
 
     def _transfer_stream(self, sock, remote):
-        """客户端和远程目的地址之间的数据流交换"""
+        """客户端和远程目的地址之间的数据流交换
+
+        数据无需变换，优先使用 splice 经由管道在内核中直接搬运，
+        系统不支持时退回到在预分配的缓冲区上 recv_into，避免每次读取都创建新对象
+        """
+        path = "splice"
+        if not (hasattr(os, "splice") and self._splice_stream(sock, remote)):
+            path = "copy"
+            self._copy_stream(sock, remote)
+        self.stats["relay_" + path] += 1
+        self.log.debug("Relay finished via %s", path)
+
+    def _splice_stream(self, sock, remote):
+        """使用 splice 交换数据，系统不支持时在搬运任何数据之前返回 False"""
+        pipes = {}
+        try:
+            for src in (sock, remote):
+                pipes[src] = os.pipe()
+            peers = {sock: remote, remote: sock}
+            keys = {sock: "bytes_up", remote: "bytes_down"}
+            stats = self.stats
+            session = self._get_session(sock)
+            fdset = [sock, remote]
+            moved = False
+            while fdset:
+                readset = wait_sockets(fdset)
+                for src in readset:
+                    pipe_read, pipe_write = pipes[src]
+                    try:
+                        size = os.splice(src.fileno(), pipe_write,
+                                         self.PIPE_SIZE, flags=os.SPLICE_F_MOVE)
+                    except OSError as e:
+                        if moved or e.errno not in (errno.EINVAL, errno.ENOSYS):
+                            raise
+                        return False
+                    if size <= 0:
+                        fdset.remove(src)
+                        shutdown_write(peers[src])
+                        continue
+                    moved = True
+                    session.touch()
+                    stats[keys[src]] += size
+                    dst = peers[src].fileno()
+                    while size > 0:
+                        size -= os.splice(pipe_read, dst, size,
+                                          flags=os.SPLICE_F_MOVE)
+            return True
+        finally:
+            for pipe in pipes.values():
+                os.close(pipe[0])
+                os.close(pipe[1])
+
+    def _copy_stream(self, sock, remote):
+        """使用每个连接一个的预分配缓冲区交换数据"""
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        peers = {sock: remote, remote: sock}
+        keys = {sock: "bytes_up", remote: "bytes_down"}
+        stats = self.stats
+        session = self._get_session(sock)
         fdset = [sock, remote]
-        while True:
-            readset, writeset, exceptset = select.select(fdset, [], [])
-
-            if sock in readset:
-                data = self.recv_data(sock)
-                if len(data) <= 0:
-                    break
-                self.send_data(data, remote)
-
-            if remote in readset:
-                data = self.recv_data(remote)
-                if len(data) <= 0:
-                    break
-                self.send_data(data, sock)
-
-    def handle_connect(self, sock, addr):
-        """处理连接请求"""
+        while fdset:
+            readset = wait_sockets(fdset)
+            for src in readset:
+                size = src.recv_into(buffer)
+                if size <= 0:
+                    fdset.remove(src)
+                    shutdown_write(peers[src])
+                    continue
+                session.touch()
+                stats[keys[src]] += size
+                peers[src].sendall(view[:size])
+
+    def _get_session(self, sock):
+        """返回客户端套接字所属的会话，未登记时返回一个不受回收的会话"""
+        return self.sweeper.sessions.get(sock) or Session(sock)
+
+    def _create_relay(self, sock, remote):
+        """创建交给 Reactor 的 Relay，返回 None 时仍在当前线程中交换数据"""
+        stats = self.stats
+        buffer_size = self.buffer_size
+
+        def reader(key):
+            def read(src):
+                data = src.recv(buffer_size)
+                stats[key] += len(data)
+                return data, not data
+            return read
+
+        return Relay(sock, remote, reader("bytes_up"), reader("bytes_down"))
+
+    def _detach(self, sock, remote, on_close=None):
+        """将连接交给 Reactor，成功时返回 True，连接结束后关闭套接字并调用 on_close"""
+        relay = self._create_relay(sock, remote)
+        if relay is None:
+            return False
+
+        def close(relay):
+            self.sweeper.unregister(sock)
+            remote.close()
+            sock.close()
+            self.stats["relay_reactor"] += 1
+            if on_close:
+                on_close()
+
+        relay.on_close = close
+        relay.session = self._get_session(sock)
+        self.reactor.add(relay)
+        return True
+
+    def _start_relay(self, session, remote, start):
+        """握手完成，之后按空闲时间回收会话"""
+        self.handshake_latency.observe(time.perf_counter() - start)
+        session.add(remote)
+        session.handshaking = False
+        session.touch()
+
+    def _handle_error(self, session, error):
+        if session.reclaimed:
+            self.log.info("Session reclaimed after %s timeout",
+                          session.reclaimed)
+            return
+        if isinstance(error, RequestRefused):
+            # 按规则拒绝的连接不是故障，使用固定的消息模板以便按模板限流
+            self.log.info("Connection to %s:%s refused by route rule",
+                          error.host, error.port)
+            return
+        self.errors[type(error).__name__] += 1
+        self.log.warning(error)
+        self.log.debug(traceback.format_exc().strip())
+
+    def handle_connect(self, sock, addr, on_close=None):
+        """处理连接请求
+
+        连接交给了 Reactor 时返回 True，此时套接字由 Reactor 关闭，
+        数据交换结束后调用 on_close
+        """
         remote = None  # 目的地址连接套接字
+        detached = False
+        self.stats["sessions"] += 1
+        session = self.sweeper.register(sock)
         try:
-            self._check_auth(sock)
-            remote = self._handle_request(sock, addr)
-            self._transfer_stream(sock, remote)
+            start = time.perf_counter()
+            self.socket_options.apply(sock)
+            handshake = self._check_auth(sock)
+            remote = self._handle_request(sock, addr, handshake)
+            self._start_relay(session, remote, start)
+            if isinstance(remote, UdpAssociation):
+                remote.run(session)
+            else:
+                if self.reactor is not None:
+                    detached = self._detach(sock, remote, on_close)
+                if not detached:
+                    self._transfer_stream(sock, remote)
         except Exception as e:
-            self.log.warning(e)
-            self.log.debug(traceback.format_exc().strip())
+            self._handle_error(session, e)
         finally:
-            if remote:
-                remote.close()
-            sock.close()
+            if not detached:
+                self.sweeper.unregister(sock)
+                if remote:
+                    remote.close()
+                sock.close()
+        return detached
+
+    def _run_session(self, sock, addr):
+        """在工作线程中处理已接受的连接，交给 Reactor 的连接结束时才释放会话名额"""
+        self.limiter.enter()
+        detached = False
+        try:
+            detached = self.handle_connect(sock, addr,
+                                           on_close=self.limiter.leave)
+        finally:
+            if not detached:
+                self.limiter.leave()
+
+    def _reject(self, sock, addr):
+        """会话数已达上限，拒绝连接"""
+        self.log.debug("Rejected %s:%s, too many sessions", *addr[:2])
+        sock.close()
+
+    def stop(self):
+        """停止接受新连接，start 和 start_async 随后返回，可以在信号处理函数中调用
+
+        已接受的连接不受影响，start_async 会等待它们处理完毕后再返回。
+        asyncio 模式下取消接受连接的任务；线程模式下 shutdown 监听套接字以唤醒 accept，
+        但与其他进程共享的监听套接字被 shutdown 后所有进程的 accept 都会失败，
+        此时只关闭本进程的文件描述符，需在调用 start 的线程的信号处理函数中调用
+        """
+        self._stopping = True
+        if self._serving is not None:
+            loop, task = self._serving
+            loop.call_soon_threadsafe(task.cancel)
+        elif self.shared_listener:
+            self.sock.close()
+        else:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _is_stopped(self, error):
+        """accept 出错是否因为服务器已停止"""
+        return self._stopping
 
     def start(self):
-        """启动服务器并等待连接，用线程处理每一个连接"""
+        """启动服务器并等待连接
+
+        未限制会话数时用线程处理每一个连接，否则由大小为 max_sessions 的线程池处理
+        """
         self.log.info("Starting at %s:%s", self.host, self.port)
+        self.sweeper.start()
+        if self.reactor is not None:
+            self.reactor.start()
+        limiter = self.limiter
+        executor = None
+        if limiter.max_sessions:
+            executor = ThreadPoolExecutor(limiter.max_sessions,
+                                          thread_name_prefix="session")
         try:
             while True:
+                limiter.wait_slot()
                 sock, addr = self.sock.accept()
-                thread = Thread(target=self.handle_connect, args=(sock, addr))
-                thread.start()
+                if not limiter.admit():
+                    self._reject(sock, addr)
+                elif executor:
+                    executor.submit(self._run_session, sock, addr)
+                else:
+                    thread = Thread(target=self._run_session, args=(sock, addr))
+                    thread.start()
+        except Exception as e:
+            if not self._is_stopped(e):
+                self.log.error(e)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    async def _async_recv_handshake(self, sock, handshake, parse):
+        """_recv_handshake 的 asyncio 版本"""
+        result = parse()
+        while result is None:
+            data = await self._async_recv_data(sock)
+            affirm(data, "Connection closed during handshake")
+            handshake.feed(data)
+            result = parse()
+        return result
+
+    async def _async_check_auth(self, sock):
+        """校验认证方式，asyncio 版本"""
+        handshake = HandshakeBuffer()
+        greeting = await self._async_recv_handshake(sock, handshake,
+                                                    handshake.parse_greeting)
+        method, reply = self._auth_reply(greeting)
+        if method == 0x00 and handshake.buffer:
+            handshake.replies.append(reply)
+        elif method == 0x00:
+            await self._async_send_data(reply, sock)
+        elif method == 0x02:
+            await self._async_send_data(reply, sock)
+            self.__user_auth(sock)
+        else:
+            await self._async_send_data(reply, sock)
+            raise Exception(self.AUTH_TYPES[method])
+        return handshake
+
+    async def _async_connet_remote(self, addr, port, addr_data=None):
+        """连接远程服务器，asyncio 版本，参数和返回值同 _connet_remote"""
+        start = time.perf_counter()
+        infos = await self.resolver.async_resolve(addr, port)
+        remote = await self.connector.async_connect(addr, port, infos)
+        self.connect_latency.observe(time.perf_counter() - start)
+        return remote
+
+    async def _async_select_upstream(self, addr, port):
+        """_select_upstream 的 asyncio 版本，返回的连接函数为协程函数"""
+        return self._async_connet_remote
+
+    async def _async_send_early_data(self, remote, data):
+        self.stats["bytes_up"] += len(data)
+        await self._async_send_data(data, remote)
+
+    async def _async_handle_request(self, sock, addr, handshake=None):
+        """处理请求信息，asyncio 版本"""
+        handshake = handshake or HandshakeBuffer()
+        request = await self._async_recv_handshake(sock, handshake,
+                                                   handshake.parse_request)
+        target = self._parse_request(request)
+        # UDP ASSOCIATE 仅用于线程模式
+        error = self._unsupported_command(request, (0x01,))
+        if error is not None:
+            await self._async_send_data(b"".join(handshake.replies) +
+                                        self._request_reply(0x07), sock)
+            raise error
+        if target is None:
+            await self._async_send_data(b"".join(handshake.replies) +
+                                        self._request_reply(0x08), sock)
+            raise Exception("Address type not supported: '%#x'" % request[2])
+        remote_addr, remote_port, remote_addr_data = target
+        connect = await self._async_select_upstream(remote_addr, remote_port)
+        if connect is None:
+            await self._async_send_data(b"".join(handshake.replies) +
+                                        self._request_reply(0x02), sock)
+            raise RequestRefused(remote_addr, remote_port)
+
+        await self._async_send_data(b"".join(handshake.replies) +
+                                    self._request_reply(0x00), sock)
+
+        self.log.info("Connecting %s:%s from %s:%s",
+                      remote_addr, remote_port, *addr[:2])
+        remote = await connect(remote_addr, remote_port, remote_addr_data)
+        early_data = handshake.take_rest()
+        if early_data:
+            try:
+                await self._async_send_early_data(remote, early_data)
+            except Exception:
+                remote.close()
+                raise
+        return remote
+
+    async def _async_pipe(self, src, dst, recv, send, key, session,
+                          finish=None):
+        """从 src 读取数据并写入 dst，字节数累加到 stats[key]
+
+        src 结束后结束 dst 的写方向，finish 为空时 shutdown(SHUT_WR)，
+        否则调用 await finish(dst)
+        """
+        stats = self.stats
+        while True:
+            data = await recv(src)
+            if len(data) <= 0:
+                break
+            session.touch()
+            stats[key] += len(data)
+            await send(data, dst)
+        if finish is None:
+            shutdown_write(dst)
+        else:
+            await finish(dst)
+
+    @staticmethod
+    async def _async_relay(*pipes):
+        """同时运行多个数据管道，全部结束或任意一个出错时返回
+
+        返回前等待被取消的管道真正结束，使其从事件循环中注销套接字，
+        否则套接字关闭后文件描述符被复用时，事件循环中会残留失效的注册
+        """
+        tasks = [asyncio.ensure_future(pipe) for pipe in pipes]
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            task.result()
+
+    async def _async_transfer_stream(self, sock, remote):
+        """客户端和远程目的地址之间的数据流交换，asyncio 版本"""
+        session = self._get_session(sock)
+        await self._async_relay(
+            self._async_pipe(sock, remote, self._async_recv_data,
+                             self._async_send_data, "bytes_up", session),
+            self._async_pipe(remote, sock, self._async_recv_data,
+                             self._async_send_data, "bytes_down", session),
+        )
+
+    async def _async_handle_connect(self, sock, addr):
+        """处理连接请求，asyncio 版本"""
+        remote = None
+        self.stats["sessions"] += 1
+        session = self.sweeper.register(sock)
+        try:
+            start = time.perf_counter()
+            self.socket_options.apply(sock)
+            handshake = await self._async_check_auth(sock)
+            remote = await self._async_handle_request(sock, addr, handshake)
+            self._start_relay(session, remote, start)
+            await self._async_transfer_stream(sock, remote)
+        except Exception as e:
+            self._handle_error(session, e)
+        finally:
+            self.sweeper.unregister(sock)
+            if remote:
+                remote.close()
+            sock.close()
+
+    async def _async_run_session(self, sock, addr, slots, slot_freed):
+        if slots:
+            await slots.acquire()
+        self.limiter.enter()
+        try:
+            await self._async_handle_connect(sock, addr)
+        finally:
+            self.limiter.leave()
+            if slots:
+                slots.release()
+            slot_freed.set()
+
+    async def _async_serve(self):
+        loop = asyncio.get_running_loop()
+        self.sock.setblocking(False)
+        limiter = self.limiter
+        slots = None
+        if limiter.max_sessions:
+            slots = asyncio.Semaphore(limiter.max_sessions)
+        slot_freed = asyncio.Event()
+        tasks = set()
+        self._serving = (loop, asyncio.current_task())
+        try:
+            while not self._stopping:
+                while limiter.overflow == "block" and not limiter.has_slot():
+                    slot_freed.clear()
+                    await slot_freed.wait()
+                sock, addr = await loop.sock_accept(self.sock)
+                if not limiter.admit():
+                    self._reject(sock, addr)
+                    continue
+                sock.setblocking(False)
+                coro = self._async_run_session(sock, addr, slots, slot_freed)
+                task = loop.create_task(coro)
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except asyncio.CancelledError as e:
+            if not self._is_stopped(e):
+                raise
+        except OSError as e:
+            if not self._is_stopped(e):
+                raise
+        finally:
+            self._serving = None
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def start_async(self):
+        """启动服务器并等待连接，所有连接在同一个 asyncio 事件循环中处理"""
+        self.log.info("Starting at %s:%s (asyncio)", self.host, self.port)
+        self.sweeper.start()
+        try:
+            asyncio.run(self._async_serve())
         except Exception as e:
             self.log.error(e)
 
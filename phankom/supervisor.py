@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 13:12:27
+# *************************************************************
+
+"""多进程服务"""
+
+import os
+import time
+import signal
+import logging
+
+
+class Supervisor(object):
+    """多进程服务管理
+
+    父进程创建好监听套接字后 fork 出 workers 个子进程，子进程各自运行服务器。
+    默认所有子进程共享同一个监听套接字，服务器启用了 reuse_port 时，
+    除第一个子进程外都在同一端口上重新监听，由内核在各进程间分配连接。
+
+    父进程监控子进程，退出的子进程会被重新启动，
+    收到的 SIGUSR1(性能分析)和 SIGHUP(重新加载分流规则)转发给所有子进程。
+    父进程收到 SIGTERM 或 SIGINT 后通知所有子进程停止接受新连接，
+    子进程处理完已有的连接后退出，单独收到 SIGTERM 的子进程退出后被重新启动，
+    超过 shutdown_timeout 秒仍未退出的子进程将被强制杀死
+
+    参数:
+        server: 已创建的服务器，Socks5Server 或其子类的实例
+        target: 在子进程中运行服务器的函数，参数为 server
+        workers: 子进程数
+    """
+
+    # 子进程启动后存活时间不足该值即退出时，延迟重启以免频繁 fork
+    MIN_UPTIME = 1
+    # 转发给子进程的信号，由子进程中运行的服务器自行处理
+    FORWARDED_SIGNALS = ("SIGUSR1", "SIGHUP")
+
+    def __init__(self, server, target, workers, shutdown_timeout=10):
+        self.server = server
+        self.target = target
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        self.log = logging.getLogger()
+
+        self._children = {}  # pid -> (序号, 启动时间)
+        self._stopping = False
+        self._spawned = 0
+
+    def _run_worker(self, index, reopen):
+        self.server.worker_id = index
+        # 共享的监听套接字不能被单个子进程 shutdown，见 Socks5Server.stop
+        self.server.shared_listener = not self.server.reuse_port
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.server.stop())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        if hasattr(signal, "SIGHUP"):
+            # 没有需要重新加载的规则时忽略
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        code = 0
+        try:
+            if reopen:
+                self.server.reopen()
+            self.target(self.server)
+            # 等待线程中正在处理的连接结束
+            limiter = self.server.limiter
+            while limiter.active + limiter.queued > 0:
+                time.sleep(0.1)
+        except Exception as e:
+            self.log.error(e)
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _spawn(self, index):
+        reopen = self.server.reuse_port and self._spawned > 0
+        self._spawned += 1
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(index, reopen)
+        self._children[pid] = (index, time.time())
+        self.log.info("Worker %s started, pid %s", index, pid)
+
+    def _signal_children(self, signum):
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _handle_signal(self, signum, frame):
+        if not self._stopping:
+            self.log.info("Shutting down %s workers", len(self._children))
+            self._stopping = True
+            self._signal_children(signal.SIGTERM)
+
+    def _reap(self):
+        """回收已退出的子进程，返回 [(序号, 启动时间)]"""
+        exited = []
+        while self._children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            index, started = self._children.pop(pid)
+            if not self._stopping:
+                self.log.warning("Worker %s (pid %s) exited with status %s",
+                                 index, pid, status)
+            exited.append((index, started))
+        return exited
+
+    def start(self):
+        """启动所有子进程并监控，所有子进程退出后返回"""
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        for name in self.FORWARDED_SIGNALS:
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), lambda signum, frame:
+                              self._signal_children(signum))
+        for index in range(self.workers):
+            self._spawn(index)
+        if self.server.reuse_port:
+            # 第一个子进程继承了监听套接字，其余子进程各自重新监听
+            self.server.sock.close()
+
+        deadline = None
+        while self._children:
+            for index, started in self._reap():
+                if self._stopping:
+                    continue
+                if time.time() - started < self.MIN_UPTIME:
+                    time.sleep(self.MIN_UPTIME)
+                self._spawn(index)
+            if self._stopping:
+                deadline = deadline or time.time() + self.shutdown_timeout
+                if time.time() > deadline:
+                    self.log.warning("Killing %s workers", len(self._children))
+                    self._signal_children(signal.SIGKILL)
+                    deadline = float("inf")
+            time.sleep(0.1)
+        self.log.info("All workers exited")
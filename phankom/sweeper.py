@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 19:12:48
+# *************************************************************
+
+"""会话超时回收
+
+后台线程定期检查所有会话，握手、空闲或存续时间超时的会话被回收。
+回收的方式是对会话的套接字调用 shutdown，阻塞在其上的读写随即返回，
+线程模式、Reactor 和 asyncio 中的数据交换都会因此结束并关闭套接字
+"""
+
+import time
+import socket
+import logging
+from threading import Thread, Lock
+from collections import Counter
+
+
+class Session(object):
+    """一个会话的套接字和活动时间
+
+    socks 中的套接字在回收时被 shutdown，streams 中的多路复用流在回收时被 abort
+    """
+
+    def __init__(self, sock):
+        self.socks = []
+        self.streams = []
+        self.add(sock)
+        self.started = time.monotonic()
+        self.active = self.started  # 最近一次收到数据的时间
+        self.handshaking = True
+        self.reclaimed = None  # 被回收的原因
+
+    def touch(self):
+        self.active = time.monotonic()
+
+    def add(self, sock):
+        """加入目的地址连接，有 abort 方法的对象作为多路复用流，其他对象被忽略"""
+        if isinstance(sock, socket.socket):
+            self.socks.append(sock)
+        elif hasattr(sock, "abort"):
+            self.streams.append(sock)
+
+
+class Sweeper(object):
+    """定期回收超时的会话
+
+    参数:
+        idle_timeout: 握手完成后连续这么多秒没有收到数据的会话被回收
+        handshake_timeout: 这么多秒内没有完成握手的会话被回收
+        lifetime: 存续超过这么多秒的会话被回收
+        interval: 检查的间隔秒数
+
+    超时为 0 时不做对应的检查，全部为 0 时不启动后台线程。
+    stats 中按原因 idle、handshake、lifetime 记录了回收的会话数
+    """
+
+    def __init__(self, idle_timeout=300, handshake_timeout=30, lifetime=0,
+                 interval=1):
+        self.idle_timeout = idle_timeout
+        self.handshake_timeout = handshake_timeout
+        self.lifetime = lifetime
+        self.interval = interval
+        self.stats = Counter()
+        self.sessions = {}  # 客户端套接字 -> 会话
+        self.log = logging.getLogger()
+        self._lock = Lock()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.idle_timeout or self.handshake_timeout or
+                    self.lifetime)
+
+    def register(self, sock):
+        session = Session(sock)
+        with self._lock:
+            self.sessions[sock] = session
+        return session
+
+    def unregister(self, sock):
+        with self._lock:
+            self.sessions.pop(sock, None)
+
+    def _expired(self, session, now):
+        """返回会话超时的原因，未超时时返回 None"""
+        if self.lifetime and now - session.started > self.lifetime:
+            return "lifetime"
+        if session.handshaking:
+            if (self.handshake_timeout and
+                    now - session.started > self.handshake_timeout):
+                return "handshake"
+        elif self.idle_timeout and now - session.active > self.idle_timeout:
+            return "idle"
+        return None
+
+    def reclaim(self, session, reason):
+        session.reclaimed = reason
+        self.stats[reason] += 1
+        for stream in session.streams:
+            stream.abort()
+        for sock in session.socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def sweep(self):
+        """回收所有超时的会话"""
+        now = time.monotonic()
+        with self._lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            if session.reclaimed:
+                continue
+            reason = self._expired(session, now)
+            if reason:
+                self.log.debug("Reclaiming session, %s timeout", reason)
+                self.reclaim(session, reason)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sweep()
+
+    def start(self):
+        """启动后台检查线程，必须在服务器进程中调用"""
+        with self._lock:
+            if self._thread is None and self.enabled:
+                self._thread = Thread(target=self._run, name="sweeper",
+                                      daemon=True)
+                self._thread.start()
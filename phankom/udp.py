@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 20:02:37
+# *************************************************************
+
+"""UDP 转发(SOCKS5 UDP ASSOCIATE)
+
+一个 UDP 关联由两端组成，每端一次读出所有已到达的数据报，整批交给另一端发送:
+    ClientEnd: 客户端一侧，数据报带有 SOCKS5 UDP 请求头
+    DirectEnd: 目的地址一侧，只接收 NAT 表中近期发送过数据的地址的回复
+    TunnelEnd: climb 隧道，每个加密帧承载一批数据报
+
+数据报在两端之间传递时表示为 (目的地址信息, 数据)，目的地址信息与 CONNECT 请求
+中的格式相同(地址类型 + 地址 + 端口)。隧道中每个数据报编码为
+目的地址信息 + 2 字节数据长度 + 数据，一个帧中的数据报总是完整的
+"""
+
+import time
+import struct
+import socket
+from threading import Thread, Lock
+from collections import OrderedDict
+
+from .utils import affirm, wait_sockets
+
+
+# 每端每次最多读取的数据报数
+BATCH_SIZE = 64
+# UDP 数据报的最大长度
+MAX_DATAGRAM_SIZE = 65535
+# 每个目的地址在解析期间最多暂存的数据报数
+MAX_RESOLVING_DATAGRAMS = 64
+
+LENGTH = struct.Struct(">H")
+
+
+def parse_address(data, offset=0):
+    """从 offset 处解析目的地址信息，返回 (地址, 端口, 结束位置)"""
+    addr_type = data[offset]
+    if addr_type == 1:
+        end = offset + 5
+        addr = socket.inet_ntoa(data[offset + 1:end])
+    elif addr_type == 3:
+        end = offset + 2 + data[offset + 1]
+        addr = bytes(data[offset + 2:end]).decode("utf-8")
+    elif addr_type == 4:
+        end = offset + 17
+        addr = socket.inet_ntop(socket.AF_INET6, data[offset + 1:end])
+    else:
+        raise ValueError("Address type not supported: '%#x'" % addr_type)
+    affirm(len(data) >= end + 2, "Truncated address")
+    return addr, LENGTH.unpack_from(data, end)[0], end + 2
+
+
+def pack_address(sockaddr):
+    """将 IPv4 或 IPv6 的套接字地址编码为目的地址信息"""
+    if ":" in sockaddr[0]:
+        return (b"\x04" + socket.inet_pton(socket.AF_INET6, sockaddr[0]) +
+                LENGTH.pack(sockaddr[1]))
+    return (b"\x01" + socket.inet_aton(sockaddr[0]) +
+            LENGTH.pack(sockaddr[1]))
+
+
+def recv_batch(sock, size=BATCH_SIZE):
+    """从非阻塞的套接字中读出已到达的数据报，最多 size 个
+
+    Python 中没有 recvmmsg，一次唤醒中连续读到 EAGAIN，效果与之相近
+    """
+    datagrams = []
+    while len(datagrams) < size:
+        try:
+            datagrams.append(sock.recvfrom(MAX_DATAGRAM_SIZE))
+        except (BlockingIOError, InterruptedError):
+            break
+    return datagrams
+
+
+def encode_datagrams(datagrams):
+    return b"".join(addr_data + LENGTH.pack(len(data)) + data
+                    for addr_data, data in datagrams)
+
+
+def decode_datagrams(data):
+    datagrams = []
+    offset = 0
+    while offset < len(data):
+        _, _, start = parse_address(data, offset)
+        end = start + 2 + LENGTH.unpack_from(data, start)[0]
+        affirm(end <= len(data), "Truncated datagram")
+        datagrams.append((bytes(data[offset:start]),
+                          bytes(data[start + 2:end])))
+        offset = end
+    return datagrams
+
+
+class ClientEnd(object):
+    """客户端一侧，只接受与控制连接同一 IP 的数据报，首个数据报的来源即客户端地址"""
+
+    def __init__(self, sock, client_ip, stats):
+        self.sock = sock
+        self.socks = [sock]
+        self.client_ip = client_ip
+        self.client_addr = None
+        self.stats = stats
+
+    def pending(self):
+        return False
+
+    def recv(self):
+        datagrams = []
+        for data, src in recv_batch(self.sock):
+            if self.client_addr is None and src[0] == self.client_ip:
+                self.client_addr = src
+            # 不支持分片，FRAG 不为 0 的数据报被丢弃
+            if src != self.client_addr or len(data) < 4 or data[2]:
+                self.stats["udp_dropped"] += 1
+                continue
+            try:
+                _, _, end = parse_address(data, 3)
+            except (ValueError, AssertionError):
+                self.stats["udp_dropped"] += 1
+                continue
+            datagrams.append((data[3:end], data[end:]))
+        return datagrams
+
+    def send(self, datagrams):
+        if self.client_addr is None:
+            self.stats["udp_dropped"] += len(datagrams)
+            return
+        for addr_data, data in datagrams:
+            try:
+                self.sock.sendto(b"\x00\x00\x00" + addr_data + data,
+                                 self.client_addr)
+            except (BlockingIOError, InterruptedError):
+                self.stats["udp_dropped"] += 1
+
+    def close(self):
+        self.sock.close()
+
+
+class DirectEnd(object):
+    """目的地址一侧
+
+    NAT 表记录了每个目的地址最近一次发送数据的时间，只有表中的地址发来的数据报
+    才会转发给客户端，超过 timeout 秒未发送过数据的地址从表中移除
+
+    IPv4 和 IPv6 各用一个套接字，按目的地址的地址族选择，系统不支持 IPv6 时
+    sock6 为空。域名命中 resolver 的缓存时直接发送，否则在后台线程中解析，
+    期间发往该域名的数据报暂存起来，解析完成后由该线程发送，不阻塞转发循环
+    """
+
+    def __init__(self, resolver, stats, timeout=60):
+        self.sock = self._open(socket.AF_INET, "0.0.0.0")
+        try:
+            self.sock6 = self._open(socket.AF_INET6, "::")
+        except OSError:
+            self.sock6 = None
+        self.socks = [sock for sock in (self.sock, self.sock6) if sock]
+        self.resolver = resolver
+        self.stats = stats
+        self.timeout = timeout
+        self.nat = OrderedDict()  # 目的地址 -> 最近一次发送的时间
+        self._resolving = {}      # (域名, 端口) -> 暂存的数据
+        self._lock = Lock()
+
+    @staticmethod
+    def _open(family, address):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.setblocking(False)
+            sock.bind((address, 0))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def pending(self):
+        return False
+
+    def _expire(self, now):
+        deadline = now - self.timeout
+        while self.nat and next(iter(self.nat.values())) < deadline:
+            self.nat.popitem(last=False)
+            self.stats["udp_nat_expired"] += 1
+
+    def recv(self):
+        datagrams = []
+        received = [item for sock in self.socks for item in recv_batch(sock)]
+        with self._lock:
+            self._expire(time.monotonic())
+            for data, src in received:
+                if src[:2] not in self.nat:
+                    self.stats["udp_dropped"] += 1
+                    continue
+                datagrams.append((pack_address(src), data))
+        return datagrams
+
+    def _sendto(self, infos, host, data):
+        """发送到 infos 中第一个有对应套接字的地址，需在持有锁时调用"""
+        for info in infos:
+            sock = self.sock if info[0] == socket.AF_INET else self.sock6
+            if sock is not None:
+                break
+        else:
+            raise OSError("No usable address for %s" % host)
+        sockaddr = info[4][:2]
+        sock.sendto(data, info[4])
+        self.nat[sockaddr] = time.monotonic()
+        self.nat.move_to_end(sockaddr)
+
+    def _resolve(self, host, port):
+        """在后台线程中解析域名，之后发送解析期间暂存的数据报"""
+        try:
+            infos = self.resolver.resolve(host, port)
+        except OSError:
+            infos = []
+        with self._lock:
+            waiting = self._resolving.pop((host, port))
+            for data in waiting:
+                try:
+                    self._sendto(infos, host, data)
+                except OSError:
+                    self.stats["udp_dropped"] += 1
+
+    def send(self, datagrams):
+        with self._lock:
+            for addr_data, data in datagrams:
+                try:
+                    host, port, _ = parse_address(addr_data)
+                    if addr_data[0] != 3:
+                        # IP 地址不需要解析
+                        family = (socket.AF_INET if addr_data[0] == 1 else
+                                  socket.AF_INET6)
+                        self._sendto([(family, None, None, None,
+                                       (host, port))], host, data)
+                        continue
+                    waiting = self._resolving.get((host, port))
+                    infos = (None if waiting is not None else
+                             self.resolver.cached(host, port))
+                    if infos is not None:
+                        self._sendto(infos, host, data)
+                    elif waiting is None:
+                        self._resolving[(host, port)] = [data]
+                        Thread(target=self._resolve, args=(host, port),
+                               daemon=True).start()
+                    elif len(waiting) < MAX_RESOLVING_DATAGRAMS:
+                        waiting.append(data)
+                    else:
+                        self.stats["udp_dropped"] += 1
+                except (OSError, ValueError, AssertionError):
+                    self.stats["udp_dropped"] += 1
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+
+
+class TunnelEnd(object):
+    """climb 隧道一侧，server 为隧道所属的服务器，owner 为真时关闭时关闭隧道"""
+
+    def __init__(self, server, sock, owner=False):
+        self.server = server
+        self.sock = sock
+        self.socks = [sock]
+        self.owner = owner
+
+    def pending(self):
+        return self.server._has_buffered_input(self.sock)
+
+    def recv(self):
+        """读取并解码已到达的帧，隧道关闭时返回 None"""
+        data = self.server.recv_encrypted_frames(self.sock)
+        if not data:
+            return None
+        return decode_datagrams(data)
+
+    def send(self, datagrams):
+        """按帧长度上限将数据报分组，每组一个帧"""
+        server = self.server
+        limit = (server.LARGE_FRAME_DATA_SIZE
+                 if server._get_tunnel(self.sock).large_frame else
+                 server.SMALL_FRAME_DATA_SIZE)
+        group, size = [], 0
+        for datagram in datagrams:
+            length = len(datagram[0]) + 2 + len(datagram[1])
+            if length > limit:
+                server.stats["udp_dropped"] += 1
+                continue
+            if size + length > limit:
+                server.send_encrypted_data(encode_datagrams(group), self.sock)
+                group, size = [], 0
+            group.append(datagram)
+            size += length
+        if group:
+            server.send_encrypted_data(encode_datagrams(group), self.sock)
+
+    def close(self):
+        if self.owner:
+            self.sock.close()
+
+
+class UdpAssociation(object):
+    """一个 UDP 关联，在 client 和 upstream 两端之间转发数据报
+
+    control 为 SOCKS 控制连接，其关闭时关联结束，为空时以隧道关闭为结束
+    """
+
+    def __init__(self, client, upstream, stats, control=None):
+        self.client = client
+        self.upstream = upstream
+        self.stats = stats
+        self.control = control
+
+    def run(self, session=None):
+        ends = ((self.client, self.upstream, "up"),
+                (self.upstream, self.client, "down"))
+        fdset = self.client.socks + self.upstream.socks
+        if self.control is not None:
+            fdset.append(self.control)
+        stats = self.stats
+        while True:
+            readset = ([end.sock for end, _, _ in ends if end.pending()] or
+                       wait_sockets(fdset))
+            if self.control is not None and self.control in readset:
+                if not self.control.recv(4096):
+                    return
+            for src, dst, direction in ends:
+                if not any(sock in readset for sock in src.socks):
+                    continue
+                datagrams = src.recv()
+                if datagrams is None:
+                    return
+                if not datagrams:
+                    continue
+                if session is not None:
+                    session.touch()
+                stats["udp_datagrams_" + direction] += len(datagrams)
+                dst.send(datagrams)
+
+    def close(self):
+        self.client.close()
+        self.upstream.close()
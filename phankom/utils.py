@@ -10,6 +10,8 @@
 import re
 import ast
 import types
+import select
+import socket
 import inspect
 from collections import OrderedDict
 
@@ -70,3 +72,32 @@ def affirm(condition, message=None):
 
 def is_even(x):
     return False if x & 1 else True
+
+
+def wait_sockets(socks, write=False, timeout=None):
+    """等待套接字可读(write 为真时可写)，返回就绪的套接字列表
+
+    优先使用 poll，不像 select 那样要求文件描述符小于 FD_SETSIZE(通常为 1024)，
+    出错或已被对端关闭的套接字也视为就绪
+    """
+    if not hasattr(select, "poll"):
+        if write:
+            return select.select([], socks, [], timeout)[1]
+        return select.select(socks, [], [], timeout)[0]
+    poller = select.poll()
+    event = select.POLLOUT if write else select.POLLIN
+    fds = {}
+    for sock in socks:
+        fds[sock.fileno()] = sock
+        poller.register(sock, event)
+    if timeout is not None:
+        timeout *= 1000
+    return [fds[fd] for fd, _ in poller.poll(timeout)]
+
+
+def shutdown_write(sock):
+    """结束套接字的写方向(TCP 半关闭)，对端已关闭时忽略错误"""
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
@@ -95,6 +95,7 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['pytest', 'coverage'],
+        'aead': ['cryptography'],
     },
 
     # If there are data files included in packages that need to be
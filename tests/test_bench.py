@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 17:02:35
+# *************************************************************
+
+import json
+import logging
+from argparse import Namespace
+
+import pytest
+
+from phankom.bench import run, percentile
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 51
+    assert percentile(values, 0.99) == 99
+    assert percentile([], 0.5) == 0.0
+
+
+@pytest.mark.parametrize("target,engine", [("socks", "thread"),
+                                           ("climb", "asyncio")])
+def test_run(tmpdir, target, engine):
+    output = str(tmpdir.join("report.json"))
+    args = Namespace(target=target, engine=engine, clients=4, connections=20,
+                     sizes=[1024, 100 * 1024], data="text", buffer_size=0,
+                     compress="always", stream_compress=False,
+                     large_frame=False, relay_threads=0, ciphers=["mix"],
+                     output=output)
+    try:
+        run(args)
+    finally:
+        logging.disable(logging.NOTSET)
+    with open(output) as f:
+        report = json.load(f)
+    assert report["target"] == target
+    assert [result["payload_size"] for result in report["results"]] == \
+        [1024, 100 * 1024]
+    for result in report["results"]:
+        assert result["connections"] == 20
+        assert result["errors"] == 0
+        assert result["mb_per_second"] > 0
+        assert result["handshake_p99_ms"] >= result["handshake_p50_ms"]
@@ -0,0 +1,308 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 11:36:02
+# *************************************************************
+
+import os
+import time
+import socket
+import random
+import threading
+
+import pytest
+
+from phankom.climb import (FrameReader, Tunnel, BaseClimbServer,
+                           LocalClimbServer, RemoteClimbServer)
+from phankom.mux import INITIAL_WINDOW
+from phankom.crypt import available_ciphers
+
+from .test_socks import (start_echo_server, start_server, assert_echo,
+                         socks5_connect, recv_exactly, wait_until,
+                         start_reply_server, assert_half_close,
+                         pipelined_connect)
+
+
+class TestFrameReader(object):
+
+    def setup_class(self):
+        self.server = RemoteClimbServer("hello", "127.0.0.1", 0)
+
+    def teardown_class(self):
+        self.server.sock.close()
+
+    def _feed(self, reader, data):
+        while data:
+            buffer = reader.get_buffer()
+            size = min(len(buffer), len(data))
+            buffer[:size] = data[:size]
+            reader.buffer_updated(size)
+            data = data[size:]
+
+    def test_split_reads(self):
+        payloads = [os.urandom(random.randint(1, 3000)) for _ in range(50)]
+        stream = b"".join(self.server._pack_frame(data) for data in payloads)
+        reader = FrameReader(BaseClimbServer._parse_frame_head, size=1024)
+        frames = []
+        # 每次只写入很少的数据，帧头和数据都会被切断
+        while stream:
+            size = random.randint(1, 7)
+            self._feed(reader, stream[:size])
+            stream = stream[size:]
+            frame = reader.next_frame()
+            while frame is not None:
+                frames.append(self.server.cipher.decrypt(frame))
+                frame = reader.next_frame()
+        assert frames == payloads
+        assert reader.pending == 0
+
+    def test_many_frames_in_one_read(self):
+        payloads = [os.urandom(100) for _ in range(10)]
+        reader = FrameReader(BaseClimbServer._parse_frame_head)
+        self._feed(reader, b"".join(self.server._pack_frame(data) for data in payloads))
+        frames = []
+        while reader.has_frame():
+            frames.append(self.server.cipher.decrypt(reader.next_frame()))
+        assert frames == payloads
+        assert reader.next_frame() is None
+
+    def test_large_frame(self):
+        reader = FrameReader(BaseClimbServer._parse_frame_head, head_size=8)
+        tunnel = Tunnel(self.server.cipher, reader)
+        tunnel.large_frame = True
+        data = os.urandom(BaseClimbServer.LARGE_FRAME_DATA_SIZE * 2 + 100)
+        self._feed(reader, self.server._pack_frames(data, tunnel))
+        frames = []
+        while reader.has_frame():
+            frames.append(self.server.cipher.decrypt(reader.next_frame()))
+        assert len(frames) == 3
+        assert b"".join(frames) == data
+
+    def test_fin_frame(self):
+        # 合并读取在结束帧处停止，结束帧之前的数据不会丢失
+        a, b = socket.socketpair()
+        with a, b:
+            a.sendall(self.server._pack_frame(b"hello") +
+                      self.server._pack_frame(b"world") +
+                      self.server._pack_frame(b""))
+            assert self.server.recv_encrypted_frames(b) == b"helloworld"
+            assert self.server.recv_encrypted_frames(b) == b""
+
+
+class TestClimbServer(object):
+
+    def setup_class(self):
+        self.echo_port = start_echo_server()
+
+    def _start_chain(self, local_engine="thread", remote_engine="thread",
+                     local_options=None, remote_options=None):
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0,
+                                   **(remote_options or {}))
+        remote_port = start_server(remote, remote_engine)
+        local = LocalClimbServer("hello", "127.0.0.1", 0,
+                                 "127.0.0.1", remote_port,
+                                 **(local_options or {}))
+        return start_server(local, local_engine)
+
+    def test_thread_engine(self):
+        port = self._start_chain("thread", "thread")
+        assert_echo(port, self.echo_port)
+
+    def test_asyncio_engine(self):
+        port = self._start_chain("asyncio", "asyncio")
+        assert_echo(port, self.echo_port)
+
+    def test_mixed_engine(self):
+        port = self._start_chain("asyncio", "thread")
+        assert_echo(port, self.echo_port)
+        port = self._start_chain("thread", "asyncio")
+        assert_echo(port, self.echo_port)
+
+    def test_stream_compress(self):
+        options = {"stream_compress": True}
+        for engine in ("thread", "asyncio"):
+            port = self._start_chain(engine, engine, options, options)
+            assert_echo(port, self.echo_port)
+        # 远程服务器未启用时回退到逐帧压缩
+        port = self._start_chain(local_options=options)
+        assert_echo(port, self.echo_port)
+
+    def test_large_frame(self):
+        options = {"large_frame": True, "stream_compress": True,
+                   "buffer_size": 64 * 1024}
+        for engine in ("thread", "asyncio"):
+            port = self._start_chain(engine, engine, options, options)
+            assert_echo(port, self.echo_port)
+
+    def test_mux(self):
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0, mux=1,
+                                   stream_compress=True)
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 start_server(remote), mux=2,
+                                 stream_compress=True)
+        port = start_server(local)
+        threads = [threading.Thread(target=assert_echo,
+                                    args=(port, self.echo_port))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 超过初始窗口的数据需要等待 WINDOW 帧
+        sock = socks5_connect(port, "localhost", self.echo_port)
+        with sock:
+            data = os.urandom(INITIAL_WINDOW * 4)
+            sock.sendall(data)
+            assert recv_exactly(sock, len(data)) == data
+        assert 1 <= len(local.mux_pool.tunnels) <= 2
+        assert remote.stats["relay_splice"] + remote.stats["relay_copy"] == 0
+
+    def test_mux_idle_timeout(self):
+        # 一直有数据的流及其隧道不会因空闲超时被回收
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0, mux=1,
+                                   idle_timeout=1)
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 start_server(remote), mux=1, idle_timeout=1)
+        port = start_server(local)
+        with socks5_connect(port, "localhost", self.echo_port) as sock:
+            deadline = time.monotonic() + 2.5
+            while time.monotonic() < deadline:
+                sock.sendall(b"ping")
+                assert recv_exactly(sock, 4) == b"ping"
+                time.sleep(0.1)
+        assert not local.sweeper.stats
+        assert not remote.sweeper.stats
+        assert len(local.mux_pool.tunnels) == 1
+
+    @pytest.mark.parametrize("local_timeout,remote_timeout", [(1, 0), (0, 1)])
+    def test_mux_idle_stream(self, local_timeout, remote_timeout):
+        # 隧道上有其他流在交换数据时，空闲的流仍按超时回收，目的地址连接随之关闭
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent.bind(("127.0.0.1", 0))
+        silent.listen(4)
+        silent.settimeout(5)
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0, mux=1,
+                                   idle_timeout=remote_timeout)
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 start_server(remote), mux=1,
+                                 idle_timeout=local_timeout)
+        port = start_server(local)
+        busy = socks5_connect(port, "localhost", self.echo_port)
+        idle = socks5_connect(port, "localhost", silent.getsockname()[1])
+        with silent, busy, idle:
+            target, _ = silent.accept()
+            with target:
+                target.settimeout(5)
+                deadline = time.monotonic() + 2.5
+                while time.monotonic() < deadline:
+                    busy.sendall(b"ping")
+                    assert recv_exactly(busy, 4) == b"ping"
+                    time.sleep(0.1)
+                assert idle.recv(1) == b""
+                assert target.recv(1) == b""
+            tunnel = local.mux_pool.tunnels[0]
+            wait_until(lambda: len(tunnel.streams) == 1)
+            wait_until(lambda: len(remote.sweeper.sessions) == 2)
+            busy.sendall(b"ping")
+            assert recv_exactly(busy, 4) == b"ping"
+        reclaimer = local if local_timeout else remote
+        assert reclaimer.sweeper.stats == {"idle": 1}
+
+    def test_mux_refused(self):
+        # 远程服务器未启用或不支持多路复用时回退到每个连接一个隧道
+        for engine in ("thread", "asyncio"):
+            remote = RemoteClimbServer("hello", "127.0.0.1", 0)
+            local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                     start_server(remote, engine), mux=2)
+            assert_echo(start_server(local), self.echo_port)
+            assert local.mux_pool.refused
+
+    def test_pool(self):
+        for engine in ("thread", "asyncio"):
+            remote = RemoteClimbServer("hello", "127.0.0.1", 0)
+            local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                     start_server(remote, engine), pool_size=2)
+            port = start_server(local, engine)
+            wait_until(lambda: local.pool.idle == 2)
+            assert_echo(port, self.echo_port)
+            assert local.pool.stats["hits"] == 1
+            # 池中的连接经由 Connector 建立
+            assert local.connector.stats["connects"] >= 2
+
+    @pytest.mark.parametrize("local_engine,remote_engine,options", [
+        ("thread", "thread", {}),
+        ("asyncio", "asyncio", {"stream_compress": True}),
+        ("thread", "asyncio", {"large_frame": True}),
+        ("thread", "thread", {"relay_threads": 1, "stream_compress": True}),
+        ("thread", "thread", {"mux": 1}),
+    ])
+    def test_half_close(self, local_engine, remote_engine, options):
+        port = self._start_chain(local_engine, remote_engine, options, options)
+        assert_half_close(port, start_reply_server())
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_pipelined_handshake(self, engine):
+        port = self._start_chain(engine, engine)
+        with pipelined_connect(port, "localhost", self.echo_port,
+                               b"early") as sock:
+            assert recv_exactly(sock, 5) == b"early"
+
+    def test_reactor(self):
+        options = {"relay_threads": 2, "large_frame": True,
+                   "stream_compress": True}
+        port = self._start_chain(local_options=options,
+                                 remote_options=options)
+        threads = [threading.Thread(target=assert_echo,
+                                    args=(port, self.echo_port))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 远程服务器仍按每个连接一个线程交换数据
+        port = self._start_chain(local_options={"relay_threads": 1})
+        assert_echo(port, self.echo_port)
+
+    @pytest.mark.parametrize("cipher", available_ciphers())
+    def test_cipher(self, cipher):
+        for options in ({"cipher": cipher},
+                        {"cipher": cipher, "stream_compress": True,
+                         "large_frame": True, "compress_mode": "adaptive"}):
+            for engine in ("thread", "asyncio"):
+                port = self._start_chain(engine, engine, options, options)
+                assert_echo(port, self.echo_port)
+                with pipelined_connect(port, "localhost", self.echo_port,
+                                       b"early") as sock:
+                    assert recv_exactly(sock, 5) == b"early"
+        # 帧序号要求隧道上的帧按加密的顺序发送
+        options = {"cipher": cipher, "stream_compress": True}
+        for local_options in ({"mux": 1}, {"relay_threads": 1},
+                              {"pool_size": 1}):
+            local_options.update(options)
+            port = self._start_chain(local_options=local_options,
+                                     remote_options=dict(options, mux=1))
+            threads = [threading.Thread(target=assert_echo,
+                                        args=(port, self.echo_port))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    @pytest.mark.skipif("aes-256-gcm" not in available_ciphers(),
+                        reason="cryptography not installed")
+    def test_cipher_mismatch(self):
+        port = self._start_chain(local_options={"cipher": "aes-256-gcm"},
+                                 remote_options={"cipher": "aes-128-gcm"})
+        # 本地服务器先响应客户端，远程服务器无法认证请求帧而关闭隧道
+        with socks5_connect(port, "localhost", self.echo_port) as sock:
+            sock.sendall(b"hello")
+            try:
+                data = sock.recv(1)
+            except ConnectionResetError:
+                data = b""
+            assert data == b""
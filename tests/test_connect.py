@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 15:36:50
+# *************************************************************
+
+import time
+import socket
+import asyncio
+import threading
+
+import pytest
+
+from phankom.connect import Connector
+
+
+def stalled_server():
+    """连接队列已满的监听套接字，新的连接无法完成"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(0)
+    clients = []
+    for _ in range(3):
+        client = socket.socket()
+        client.setblocking(False)
+        client.connect_ex(server.getsockname())
+        clients.append(client)
+    time.sleep(0.1)
+    return server, clients
+
+
+def addrinfo(address):
+    return (socket.AF_INET, socket.SOCK_STREAM, 6, "", address)
+
+
+class TestConnector(object):
+
+    def setup_class(self):
+        self.stalled, self.clients = stalled_server()
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+
+    def teardown_class(self):
+        for sock in [self.stalled, self.server] + self.clients:
+            sock.close()
+
+    def test_order(self):
+        infos = [(family, socket.SOCK_STREAM, 6, "", (name, 80))
+                 for family, name in [(socket.AF_INET6, "a"),
+                                      (socket.AF_INET6, "b"),
+                                      (socket.AF_INET, "c")]]
+        connector = Connector()
+        assert [info[4][0] for info in connector._order("x", infos)] == \
+            ["a", "c", "b"]
+
+    def test_concurrent_history(self):
+        # 多个会话线程同时记录和清除连接历史
+        connector = Connector(max_destinations=4)
+        infos = [addrinfo(("127.0.0.%d" % i, 80)) for i in range(1, 4)]
+        errors = []
+
+        def run(offset):
+            try:
+                for i in range(5000):
+                    key = ("host%d" % ((i + offset) % 8), 80)
+                    connector._order(key, infos)
+                    if i % 3:
+                        connector._record(key, infos[i % 3], 0.01, infos[0])
+                    else:
+                        connector._fail(key, OSError())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(connector._history) <= 4
+
+    def _connect(self, connector, infos, engine):
+        if engine == "asyncio":
+            return asyncio.run(connector.async_connect("host", 80, infos))
+        return connector.connect("host", 80, infos)
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_race(self, engine):
+        connector = Connector(delay=0.1, timeout=2)
+        infos = [addrinfo(self.stalled.getsockname()),
+                 addrinfo(self.server.getsockname())]
+        start = time.monotonic()
+        self._connect(connector, infos, engine).close()
+        assert 0.1 <= time.monotonic() - start < 1
+        assert connector.stats["races"] == 1
+        assert connector.stats["fallbacks"] == 1
+        # 胜出的地址下次优先尝试
+        assert connector.latency("host", 80)[0] == self.server.getsockname()
+        start = time.monotonic()
+        self._connect(connector, infos, engine).close()
+        assert time.monotonic() - start < 0.1
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_timeout(self, engine):
+        connector = Connector(timeout=0.3)
+        with pytest.raises(socket.timeout):
+            self._connect(connector, [addrinfo(self.stalled.getsockname())],
+                          engine)
+        assert connector.stats["timeouts"] == 1
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_refused(self, engine):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            closed = sock.getsockname()
+        connector = Connector()
+        sock = self._connect(connector, [addrinfo(closed),
+                                         addrinfo(self.server.getsockname())],
+                             engine)
+        sock.close()
+        with pytest.raises(ConnectionRefusedError):
+            self._connect(connector, [addrinfo(closed)], engine)
+        assert connector.stats["failures"] == 1
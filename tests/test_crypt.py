@@ -10,8 +10,12 @@
 
 import os
 import random
+import itertools
 
-from phankom.crypt import MixCipher
+import pytest
+
+from phankom.crypt import (MixCipher, AeadCipher, CIPHERS, create_cipher,
+                           available_ciphers)
 
 
 class TestMixCipher(object):
@@ -26,6 +30,13 @@ class TestMixCipher(object):
         assert self.cipher.salt == b'5d41402abc4b2a76b9719d911017c592'
         self.cipher._xor_data(b'\x00\x01\x06\x09') == b'5e28'
 
+    def test_xor_data_compatible(self):
+        for size in (0, 1, 31, 32, 33, 4095, 4096, 70000):
+            data = os.urandom(size)
+            salt = itertools.cycle(self.cipher.salt)
+            expected = bytes(x ^ y for x, y in zip(data, salt))
+            assert self.cipher._xor_data(data) == expected
+
     def test_encrypt(self):
         data = os.urandom(random.randint(1, 256))
         encrypted_data = self.cipher.encrypt(data)
@@ -34,3 +45,134 @@ class TestMixCipher(object):
     def test_decrypt(self):
         data = b'x\x9c\xbb\x1e\xc3Q\xa8\xf4u\xf6\xdb\xa3f\x7fX\xc2\xd8Y\x19\xd9\x00IY\x06\xb0'
         assert self.cipher.decrypt(data) == b'123456'
+
+    def test_compress_mode(self):
+        data = b"hello world " * 100
+        for mode in ("always", "never", "adaptive"):
+            cipher = MixCipher("hello", compress_mode=mode, compress_level=1)
+            encrypted = cipher.encrypt(data)
+            assert self.cipher.decrypt(encrypted) == data
+            assert cipher.stats["bytes_in"] == len(data)
+            assert cipher.stats["bytes_out"] == len(encrypted)
+        assert cipher.compress_ratio < 0.5
+
+    def test_adaptive_compress(self):
+        cipher = MixCipher("hello", compress_mode="adaptive")
+        for _ in range(cipher.policy.window * 2):
+            data = os.urandom(1024)
+            assert cipher.decrypt(cipher.encrypt(data)) == data
+        assert cipher.stats["frames_stored"] >= cipher.policy.window
+        assert cipher.encrypt(data)[0] == MixCipher.STORED_FLAG
+
+    def test_tunnel_policy(self):
+        # 各隧道的自适应压缩状态互不影响，统计数据共用
+        cipher = MixCipher("hello", compress_mode="adaptive")
+        binary = cipher.create_tunnel(True)
+        text = cipher.create_tunnel(True)
+        frame = b"hello world " * 100
+        for _ in range(cipher.policy.window * 2):
+            for _ in range(3):
+                binary.encrypt(os.urandom(8192))
+            text.encrypt(frame)
+        assert binary.encrypt(os.urandom(8192))[0] == MixCipher.STORED_FLAG
+        assert text.encrypt(frame)[0] != MixCipher.STORED_FLAG
+        assert cipher.stats["frames_compressed"] > cipher.policy.window * 2
+        assert cipher.encrypt(frame)[0] != MixCipher.STORED_FLAG
+
+    def test_stream_cipher(self):
+        sender = MixCipher("hello").create_stream()
+        receiver = MixCipher("hello").create_stream()
+        frame = b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n" * 4
+        sizes = []
+        for data in (frame, frame, os.urandom(100), frame):
+            encrypted = sender.encrypt(data)
+            assert receiver.decrypt(encrypted) == data
+            sizes.append(len(encrypted))
+        # 后续帧可以引用前面帧的内容
+        assert sizes[1] < sizes[0] / 4
+
+
+AEAD_CIPHERS = [name for name in available_ciphers() if name != "mix"]
+
+
+class TestCipherRegistry(object):
+
+    def test_create(self):
+        assert isinstance(create_cipher("mix", "hello"), MixCipher)
+        assert "mix" in available_ciphers()
+        with pytest.raises(AssertionError):
+            create_cipher("rot13", "hello")
+
+    @pytest.mark.skipif(len(AEAD_CIPHERS) == len(CIPHERS) - 1,
+                        reason="cryptography is installed")
+    def test_unavailable(self):
+        with pytest.raises(AssertionError):
+            create_cipher("aes-256-gcm", "hello")
+
+
+@pytest.mark.skipif(not AEAD_CIPHERS, reason="cryptography not installed")
+@pytest.mark.parametrize("name", AEAD_CIPHERS)
+class TestAeadCipher(object):
+
+    def test_encrypt(self, name):
+        cipher = create_cipher(name, "hello")
+        for size in (0, 1, 1024, 60 * 1024):
+            data = os.urandom(size)
+            encrypted = cipher.encrypt(data)
+            assert create_cipher(name, "hello").decrypt(encrypted) == data
+        # 每帧使用不同的 nonce
+        assert cipher.encrypt(b"same") != cipher.encrypt(b"same")
+
+    def test_authentication(self, name):
+        cipher = create_cipher(name, "hello")
+        encrypted = bytearray(cipher.encrypt(b"hello world"))
+        encrypted[-1] ^= 1
+        with pytest.raises(Exception, match="authentication"):
+            cipher.decrypt(bytes(encrypted))
+        with pytest.raises(Exception, match="authentication"):
+            create_cipher(name, "other").decrypt(cipher.encrypt(b"hello"))
+
+    def test_compress_mode(self, name):
+        data = b"hello world " * 100
+        for mode in ("always", "never", "adaptive"):
+            cipher = create_cipher(name, "hello", compress_mode=mode)
+            encrypted = cipher.encrypt(data)
+            assert cipher.decrypt(encrypted) == data
+            assert cipher.stats["bytes_in"] == len(data)
+            overhead = AeadCipher.NONCE_SIZE + 16
+            assert cipher.stats["bytes_out"] == len(encrypted) - overhead
+
+    def test_stream_cipher(self, name):
+        sender = create_cipher(name, "hello").create_stream()
+        receiver = create_cipher(name, "hello").create_stream()
+        frame = b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n" * 4
+        sizes = []
+        for data in (frame, frame, os.urandom(100), frame):
+            encrypted = sender.encrypt(data)
+            assert receiver.decrypt(encrypted) == data
+            sizes.append(len(encrypted))
+        assert sizes[1] < sizes[0] / 2
+
+    def test_frame_sequence(self, name):
+        cipher = create_cipher(name, "hello")
+        sender = cipher.create_tunnel(True)
+        receiver = cipher.create_tunnel(False)
+        assert receiver.decrypt(sender.encrypt(b"hello")) == b"hello"
+        # 启用流式压缩后沿用原有的序号
+        sender = sender.create_stream()
+        receiver = receiver.create_stream()
+        frames = [sender.encrypt(b"frame %d" % i) for i in range(4)]
+        assert receiver.decrypt(frames[0]) == b"frame 0"
+        # 重放、丢弃和调换顺序的帧都无法通过认证
+        for frame in (frames[0], frames[2], frames[3]):
+            with pytest.raises(Exception, match="authentication"):
+                receiver.decrypt(frame)
+        assert receiver.decrypt(frames[1]) == b"frame 1"
+        # 反射回发送方的帧无法通过认证
+        reply = receiver.encrypt(b"reply")
+        with pytest.raises(Exception, match="authentication"):
+            receiver.decrypt(reply)
+        assert sender.decrypt(reply) == b"reply"
+        # 不带序号的实例不能解密隧道上的帧
+        with pytest.raises(Exception, match="authentication"):
+            cipher.decrypt(frames[2])
@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 15:04:27
+# *************************************************************
+
+import time
+import socket
+import asyncio
+import threading
+
+import pytest
+
+from phankom.dns import Resolver
+
+
+class TestResolver(object):
+
+    def setup_method(self):
+        self.calls = []
+        self.delay = 0
+
+    def _getaddrinfo(self, host, port, **kwargs):
+        self.calls.append(host)
+        time.sleep(self.delay)
+        if host.endswith(".invalid"):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                 ("127.0.0.1", port))]
+
+    @pytest.fixture(autouse=True)
+    def patch_getaddrinfo(self, monkeypatch):
+        monkeypatch.setattr(socket, "getaddrinfo", self._getaddrinfo)
+
+    def test_cache(self):
+        resolver = Resolver(ttl=0.1)
+        for _ in range(3):
+            assert resolver.resolve("example.com", 80)[0][4] == ("127.0.0.1", 80)
+        assert self.calls == ["example.com"]
+        assert resolver.stats["hits"] == 2
+        time.sleep(0.15)
+        resolver.resolve("example.com", 80)
+        assert len(self.calls) == 2
+
+    def test_negative_cache(self):
+        resolver = Resolver()
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                resolver.resolve("nothing.invalid", 80)
+        assert len(self.calls) == 1
+        assert resolver.stats["negative_hits"] == 1
+
+    def test_lru(self):
+        resolver = Resolver(max_size=2)
+        for host in ("a.com", "b.com", "a.com", "c.com", "a.com", "b.com"):
+            resolver.resolve(host, 80)
+        assert self.calls == ["a.com", "b.com", "c.com", "b.com"]
+        assert resolver.stats["evicted"] == 2
+        assert len(resolver) == 2
+
+    def test_merge(self):
+        resolver = Resolver(max_size=0)
+        self.delay = 0.2
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(resolver.resolve("example.com", 80)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 5
+        assert self.calls == ["example.com"]
+        assert resolver.stats["merged"] == 4
+
+    def test_async_resolve(self):
+        resolver = Resolver()
+
+        async def resolve():
+            return await asyncio.gather(
+                *[resolver.async_resolve("example.com", 80) for _ in range(3)])
+
+        self.delay = 0.1
+        assert len(asyncio.run(resolve())) == 3
+        assert self.calls == ["example.com"]
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 21:58:12
+# *************************************************************
+
+import io
+import json
+import logging
+
+from phankom import log
+from phankom.log import (ColoredStreamHandler, JsonFormatter, QueueLogHandler,
+                         RateLimitFilter)
+
+
+def make_logger(handler):
+    logger = logging.getLogger("phankom.test.%s" % id(handler))
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.handlers = [handler]
+    return logger
+
+
+def stream_handler(formatter=None):
+    stream = io.StringIO()
+    handler = ColoredStreamHandler(stream)
+    handler.setFormatter(formatter or logging.Formatter("%(message)s"))
+    return handler, stream
+
+
+class TestLog(object):
+
+    def test_queue(self):
+        handler, stream = stream_handler()
+        queue_handler = QueueLogHandler(handler, size=1000, batch=16)
+        logger = make_logger(queue_handler)
+        for i in range(100):
+            logger.info("message %s", i)
+        queue_handler.close()
+        assert stream.getvalue().splitlines() == \
+            ["message %s" % i for i in range(100)]
+
+    def test_queue_full(self):
+        handler, stream = stream_handler()
+        queue_handler = QueueLogHandler(handler, size=1)
+        logger = make_logger(queue_handler)
+        # 后台线程忙于写入时，放不进队列的记录被丢弃
+        with handler.lock:
+            dropped = log.stats["queue_full"]
+            for i in range(10):
+                logger.info("message %s", i)
+            assert log.stats["queue_full"] > dropped
+        queue_handler.close()
+        assert 0 < len(stream.getvalue().splitlines()) < 10
+
+    def test_rate_limit(self):
+        handler, stream = stream_handler()
+        handler.addFilter(RateLimitFilter(rate=0.001, burst=3))
+        logger = make_logger(handler)
+        dropped = log.stats["rate_limited"]
+        for i in range(10):
+            logger.info("Connecting %s", i)
+            logger.warning("Failed %s", i)
+        lines = stream.getvalue().splitlines()
+        assert lines.count("Connecting 0") == 1
+        assert len([line for line in lines if "Connecting" in line]) == 3
+        assert len([line for line in lines if "Failed" in line]) == 10
+        assert log.stats["rate_limited"] - dropped == 7
+
+    def test_rate_limit_summary(self):
+        handler, stream = stream_handler()
+        limiter = RateLimitFilter(rate=1, burst=1)
+        handler.addFilter(limiter)
+        logger = make_logger(handler)
+        logger.info("Connecting %s", 1)
+        logger.info("Connecting %s", 2)
+        # 令牌恢复后注明期间丢弃的条数
+        limiter._buckets["Connecting %s"][0] = 1
+        logger.info("Connecting %s", 3)
+        assert stream.getvalue().splitlines() == \
+            ["Connecting 1", "Connecting 3 (1 similar messages dropped)"]
+
+    def test_json(self):
+        handler, stream = stream_handler(JsonFormatter())
+        handler.colored = False
+        logger = make_logger(handler)
+        logger.info("Connecting %s:%s", "example.com", 80)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("failed")
+        lines = stream.getvalue().splitlines()
+        record = json.loads(lines[0])
+        assert record["message"] == "Connecting example.com:80"
+        assert record["level"] == "INFO"
+        assert "ValueError: boom" in json.loads(lines[1])["exception"]
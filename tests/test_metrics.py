@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 16:21:40
+# *************************************************************
+
+import socket
+import threading
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+import pytest
+
+from phankom.socks import Socks5Server
+from phankom.climb import LocalClimbServer, RemoteClimbServer
+from phankom.metrics import Histogram, MetricsServer, render
+
+from .test_socks import start_echo_server, start_server, assert_echo
+
+
+def parse(text):
+    """解析文本格式的指标，返回 {名称和标签: 值}"""
+    return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in text.splitlines() if not line.startswith("#")}
+
+
+class TestMetrics(object):
+
+    def setup_class(self):
+        self.echo_port = start_echo_server()
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value)
+        assert histogram.counts == [1, 2, 1]
+        server = Socks5Server("127.0.0.1", 0)
+        server.handshake_latency = histogram
+        metrics = parse(render(server))
+        assert metrics['phankom_handshake_seconds_bucket{le="0.1"}'] == 1
+        assert metrics['phankom_handshake_seconds_bucket{le="1"}'] == 3
+        assert metrics['phankom_handshake_seconds_bucket{le="+Inf"}'] == 4
+        assert metrics["phankom_handshake_seconds_sum"] == 4.25
+        server.sock.close()
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_socks(self, engine):
+        server = Socks5Server("127.0.0.1", 0)
+        assert_echo(start_server(server, engine), self.echo_port)
+        metrics = parse(render(server))
+        assert metrics["phankom_sessions_total"] == 1
+        size = 1 + 1024 + 100 * 1024
+        assert metrics['phankom_relay_bytes_total{direction="up"}'] == size
+        assert metrics['phankom_relay_bytes_total{direction="down"}'] == size
+        assert metrics["phankom_connect_seconds_count"] == 1
+        assert metrics["phankom_handshake_seconds_count"] == 1
+
+    def test_climb(self):
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0)
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 start_server(remote))
+        assert_echo(start_server(local), self.echo_port)
+        metrics = parse(render(local))
+        assert metrics['phankom_cipher_seconds_total{op="encrypt"}'] > 0
+        assert metrics['phankom_cipher_frames_total{kind="compressed"}'] > 0
+        assert parse(render(remote))[
+            'phankom_relay_bytes_total{direction="up"}'] > 0
+
+    def test_reactor(self):
+        server = Socks5Server("127.0.0.1", 0, relay_threads=1)
+        assert_echo(start_server(server), self.echo_port)
+        metrics = parse(render(server))
+        assert metrics["phankom_reactor_relays"] <= 1
+        assert "phankom_reactor_buffered_peak_bytes" in metrics
+        assert 'phankom_reactor_pauses_total{reason="budget"}' in metrics
+
+    def test_errors(self):
+        server = Socks5Server("127.0.0.1", 0)
+        server._check_auth = lambda sock: 1 / 0
+        with socket.create_connection(("127.0.0.1",
+                                       start_server(server))) as sock:
+            assert sock.recv(1) == b""
+        assert server.errors["ZeroDivisionError"] == 1
+        assert 'phankom_errors_total{cause="ZeroDivisionError"} 1' in \
+            render(server)
+
+    def test_concurrent_keys(self):
+        # 其他线程不断加入新的键时输出不出错
+        server = Socks5Server("127.0.0.1", 0)
+        stopped = threading.Event()
+
+        def add_errors():
+            i = 0
+            while not stopped.is_set():
+                server.errors["Error%d" % i] += 1
+                server.errors.pop("Error%d" % (i - 100), None)
+                i += 1
+
+        thread = threading.Thread(target=add_errors)
+        thread.start()
+        try:
+            for _ in range(200):
+                render(server)
+        finally:
+            stopped.set()
+            thread.join()
+        server.sock.close()
+
+    def test_http(self):
+        server = Socks5Server("127.0.0.1", 0)
+        metrics = MetricsServer(server, "127.0.0.1", 0)
+        metrics.start()
+        url = "http://127.0.0.1:%s" % metrics.address[1]
+        try:
+            with urlopen(url + "/metrics") as response:
+                assert response.headers["Content-Type"].startswith("text/plain")
+                assert b"phankom_sessions_active 0" in response.read()
+            with pytest.raises(HTTPError):
+                urlopen(url + "/")
+        finally:
+            metrics.close()
+            server.sock.close()
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 14:38:12
+# *************************************************************
+
+import socket
+
+from phankom.pool import ConnectionPool
+
+from .test_socks import wait_until
+
+
+class TestConnectionPool(object):
+
+    def setup_method(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.pool = ConnectionPool(self.server.getsockname(), 2, ttl=30)
+
+    def teardown_method(self):
+        self.pool.close()
+        self.server.close()
+
+    def test_get(self):
+        self.pool.start()
+        wait_until(lambda: self.pool.idle == 2)
+        sock = self.pool.get()
+        assert sock is not None
+        sock.close()
+        # 取走后在后台补充
+        wait_until(lambda: self.pool.idle == 2)
+        assert self.pool.stats["hits"] == 1
+        assert self.pool.hit_rate == 1.0
+
+    def test_broken(self):
+        self.pool.start()
+        wait_until(lambda: self.pool.idle == 2)
+        for _ in range(2):
+            self.server.accept()[0].close()
+        wait_until(lambda: self.pool.get() is not None)
+        assert self.pool.stats["broken"] >= 1
+
+    def test_expire(self):
+        self.pool.ttl = 0.2
+        self.pool.start()
+        wait_until(lambda: self.pool.idle == 2)
+        # 后台线程替换超时的连接
+        wait_until(lambda: self.pool.stats["expired"] >= 2)
+        wait_until(lambda: self.pool.idle == 2)
+
+    def test_connect(self):
+        addresses = []
+
+        def connect(host, port):
+            addresses.append((host, port))
+            return socket.create_connection((host, port))
+
+        self.pool.close()
+        self.pool = ConnectionPool(self.server.getsockname(), 1,
+                                   connect=connect)
+        self.pool.start()
+        wait_until(lambda: self.pool.idle == 1)
+        assert addresses == [self.server.getsockname()]
+        sock = self.pool.get()
+        assert sock.gettimeout() is None
+        sock.close()
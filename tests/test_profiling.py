@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 17:44:16
+# *************************************************************
+
+import os
+import json
+import time
+import signal
+import threading
+
+import pytest
+
+from phankom.climb import LocalClimbServer, RemoteClimbServer
+from phankom.profiling import (StageProfiler, StackSampler, dump_profile,
+                               install_signal_handler)
+
+from .test_socks import start_echo_server, start_server, assert_echo, wait_until
+
+
+def load_report(directory):
+    """读取 directory 中的 JSON 报告，尚未写完时返回 None"""
+    for path in directory.listdir():
+        if path.ext == ".json":
+            try:
+                with open(str(path)) as f:
+                    return json.load(f)
+            except ValueError:
+                return None
+    return None
+
+
+class TestStageProfiler(object):
+
+    def test_wrap(self):
+        profiler = StageProfiler()
+        assert not profiler.sample()
+        sleep = profiler.wrap("sleep", time.sleep)
+        sleep(0.01)
+        sleep(0.02)
+        report = profiler.report()["sleep"]
+        assert report["count"] == 2
+        assert report["total"] >= 0.03
+        assert report["max"] >= 0.02
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_climb(self, engine):
+        echo_port = start_echo_server()
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0)
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 start_server(remote, engine),
+                                 profile_sample=1.0)
+        assert_echo(start_server(local, engine), echo_port)
+        stages = local.profiler.report()
+        assert local.profiler.sampled == 1
+        for stage in ("recv_plain", "send_tunnel", "recv_tunnel",
+                      "send_plain", "encrypt", "decrypt"):
+            assert stages[stage]["count"] > 0
+        assert ("select" in stages) == (engine == "thread")
+        assert remote.profiler.report() == {}
+
+
+class TestStackSampler(object):
+
+    def test_folded(self):
+        event = threading.Event()
+        thread = threading.Thread(target=event.wait)
+        thread.start()
+        sampler = StackSampler()
+        sampler.run(0.05)
+        event.set()
+        thread.join()
+        assert sampler.samples > 0
+        lines = sampler.folded().splitlines()
+        assert any("wait (threading.py" in line for line in lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        assert int(count) > 0
+
+    def test_signal(self, tmpdir):
+        if not hasattr(signal, "SIGUSR1"):
+            return
+        local = LocalClimbServer("hello", "127.0.0.1", 0, profile_sample=1.0)
+        original = signal.getsignal(signal.SIGUSR1)
+        try:
+            install_signal_handler(local, str(tmpdir), duration=0.05)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            wait_until(lambda: load_report(tmpdir) is not None)
+        finally:
+            signal.signal(signal.SIGUSR1, original)
+            local.sock.close()
+        report = load_report(tmpdir)
+        assert report["stages"] == {}
+        assert report["cipher"] == "mix"
+        assert set(report["cipher_cpu_seconds"]) == {"zlib", "cipher"}
+
+    def test_dump(self, tmpdir):
+        local = LocalClimbServer("hello", "127.0.0.1", 0)
+        prefix = dump_profile(local, str(tmpdir), 0.02)
+        local.sock.close()
+        assert os.path.exists(prefix + ".folded")
+        assert os.path.exists(prefix + ".json")
@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 18:32:16
+# *************************************************************
+
+import os
+import socket
+import threading
+
+from phankom.reactor import Reactor, Relay
+
+from .test_socks import recv_exactly, wait_until
+
+
+def read(sock):
+    data = sock.recv(65536)
+    return data, not data
+
+
+def send_in_background(sock, data):
+    thread = threading.Thread(target=sock.sendall, args=(data,))
+    thread.start()
+    return thread
+
+
+def create_relay(reactor, initial=(b'', b'')):
+    """返回 (a 的对端, b 的对端, 关闭事件)"""
+    a, client = socket.socketpair()
+    b, server = socket.socketpair()
+    closed = threading.Event()
+    relay = Relay(a, b, read, read, initial,
+                  on_close=lambda relay: (a.close(), b.close(), closed.set()))
+    reactor.add(relay)
+    return client, server, closed
+
+
+class TestReactor(object):
+
+    def setup_class(self):
+        self.reactor = Reactor(2)
+        self.reactor.start()
+
+    def test_relay(self):
+        client, server, closed = create_relay(self.reactor, (b"hi", b"hello"))
+        with client, server:
+            assert recv_exactly(client, 2) == b"hi"
+            assert recv_exactly(server, 5) == b"hello"
+            client.sendall(b"ping")
+            assert recv_exactly(server, 4) == b"ping"
+            server.sendall(b"pong")
+            assert recv_exactly(client, 4) == b"pong"
+            # 半关闭后另一个方向仍可传输数据
+            client.shutdown(socket.SHUT_WR)
+            assert server.recv(1) == b""
+            server.sendall(b"bye")
+            assert recv_exactly(client, 3) == b"bye"
+            assert not closed.is_set()
+            server.close()
+            assert closed.wait(5)
+            assert client.recv(1) == b""
+
+    def test_slow_reader(self):
+        # 对端暂不读取时数据留在缓冲区中，不影响同一线程中的其他连接
+        slow_client, slow_server, _ = create_relay(self.reactor)
+        data = os.urandom(8 * 1024 * 1024)
+        writer = threading.Thread(target=slow_client.sendall, args=(data,))
+        writer.start()
+        for _ in range(8):
+            client, server, _ = create_relay(self.reactor)
+            with client, server:
+                client.sendall(b"ping")
+                assert recv_exactly(server, 4) == b"ping"
+        with slow_client, slow_server:
+            assert recv_exactly(slow_server, len(data)) == data
+            writer.join()
+
+    def test_flush_before_shutdown(self):
+        # 一端关闭后，已缓冲的数据发送完毕才结束另一端的写方向
+        client, server, closed = create_relay(self.reactor)
+        data = os.urandom(4 * 1024 * 1024)
+
+        def send():
+            with client:
+                client.sendall(data)
+
+        writer = threading.Thread(target=send)
+        writer.start()
+        with server:
+            assert recv_exactly(server, len(data)) == data
+            assert server.recv(1) == b""
+            writer.join()
+        assert closed.wait(5)
+        wait_until(lambda: self.reactor.relays == 0)
+
+
+class TestBackpressure(object):
+
+    def test_watermark(self):
+        reactor = Reactor(1, buffer_size=128 * 1024)
+        reactor.start()
+        client, server, _ = create_relay(reactor)
+        data = os.urandom(8 * 1024 * 1024)
+        with client, server:
+            writer = send_in_background(client, data)
+            # 对端不读取时缓冲量停在上水位加一次读取的数据量以内
+            wait_until(lambda: reactor.stats["pauses_watermark"] >= 1)
+            assert reactor.buffered <= 128 * 1024 + 65536
+            assert recv_exactly(server, len(data)) == data
+            writer.join()
+        assert reactor.peak <= 128 * 1024 + 65536
+        wait_until(lambda: reactor.buffered == 0)
+
+    def test_memory_limit(self):
+        reactor = Reactor(2, buffer_size=1024 * 1024, memory_limit=256 * 1024)
+        reactor.start()
+        pairs = [create_relay(reactor)[:2] for _ in range(4)]
+        data = os.urandom(4 * 1024 * 1024)
+        writers = [send_in_background(client, data) for client, _ in pairs]
+        wait_until(lambda: reactor.stats["pauses_budget"] >= 1)
+        # 超出预算的部分不超过每个连接一次读取的数据量
+        assert reactor.buffered <= 256 * 1024 + 4 * 65536
+        for (client, server), writer in zip(pairs, writers):
+            with client, server:
+                assert recv_exactly(server, len(data)) == data
+                writer.join()
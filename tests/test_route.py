@@ -0,0 +1,208 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 23:41:27
+# *************************************************************
+
+import socket
+import random
+import logging
+import ipaddress
+
+import pytest
+
+from phankom.climb import LocalClimbServer, RemoteClimbServer
+from phankom.route import DomainTrie, CidrTable, Router, parse_ip
+
+from .test_socks import (start_echo_server, start_server, assert_echo,
+                         pipelined_connect, recv_exactly, wait_until)
+
+
+def unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    with sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestRouteTables(object):
+
+    def test_domain_trie(self):
+        trie = DomainTrie()
+        trie.add("example.com", "direct")
+        trie.add("*.ads.example.com", "block")
+        trie.add("cn.", "direct")
+        trie.add("Example.com", "tunnel")
+        assert len(trie) == 3
+        assert trie.lookup("example.com") == "tunnel"
+        assert trie.lookup("www.example.com") == "tunnel"
+        assert trie.lookup("x.ads.example.com") == "block"
+        assert trie.lookup("ads.example.com") == "block"
+        assert trie.lookup("baidu.com.cn") == "direct"
+        assert trie.lookup("notexample.com") is None
+        assert trie.lookup("com") is None
+
+    def test_cidr_table(self):
+        table = CidrTable()
+        table.add("10.0.0.0/8", "direct")
+        table.add("10.1.0.0/16", "tunnel")
+        table.add("10.1.2.0/24", "block")
+        table.add("10.2.0.0/16", "tunnel")
+        table.add("192.168.1.1", "block")
+        table.add("10.2.0.0/16", "direct")
+        table.add("2001:db8::/32", "direct")
+        table.compile()
+
+        def lookup(ip):
+            return table.lookup(parse_ip(ip))
+
+        assert lookup("10.0.0.1") == "direct"
+        assert lookup("10.1.0.1") == "tunnel"
+        assert lookup("10.1.2.255") == "block"
+        assert lookup("10.1.3.0") == "tunnel"
+        assert lookup("10.2.255.255") == "direct"
+        assert lookup("10.255.255.255") == "direct"
+        assert lookup("11.0.0.0") is None
+        assert lookup("9.255.255.255") is None
+        assert lookup("192.168.1.1") == "block"
+        assert lookup("192.168.1.2") is None
+        assert lookup("2001:db8::1") == "direct"
+        assert lookup("::1") is None
+
+    def test_cidr_longest_prefix(self):
+        # 与逐个网段比较的最长前缀匹配结果一致
+        rand = random.Random(1)
+        rules = []
+        for _ in range(300):
+            prefix = rand.randint(8, 28)
+            address = rand.getrandbits(32) & (0xFFFFFFFF << (32 - prefix))
+            rules.append((ipaddress.ip_network((address, prefix)),
+                          rand.choice(["direct", "tunnel", "block"])))
+        table = CidrTable()
+        for network, action in rules:
+            table.add(str(network), action)
+        table.compile()
+        for _ in range(2000):
+            address = ipaddress.ip_address(rand.getrandbits(32))
+            if rand.random() < 0.5:
+                address = rand.choice(rules)[0].network_address
+            matches = [(network.prefixlen, index, action)
+                       for index, (network, action) in enumerate(rules)
+                       if address in network]
+            expected = max(matches)[2] if matches else None
+            assert table.lookup(address.packed) == expected
+
+
+class TestRouter(object):
+
+    def test_route(self):
+        router = Router([("direct", "example.com"), ("block", "10.0.0.0/8")],
+                        direct_private=True)
+        assert router.route("www.example.com") == "direct"
+        assert router.route("www.example.com") == "direct"
+        assert router.route("example.org") == "tunnel"
+        assert router.route("10.1.1.1") == "block"
+        assert router.route("192.168.0.1") == "direct"
+        assert router.route("localhost") == "direct"
+        assert router.route("::1") == "direct"
+        assert router.stats["cache_hits"] == 1
+        assert router.stats["direct"] == 5
+        assert router.stats["tunnel"] == 1
+        with pytest.raises(AssertionError):
+            Router([("proxy", "example.com")])
+
+    def test_resolve(self):
+        router = Router([("direct", "127.0.0.0/8")], resolve=True,
+                        default="block")
+        assert router.route("example.com") is None
+        assert router.route_resolved("example.com", "127.0.0.1") == "direct"
+        assert router.route("example.com") == "direct"
+        assert router.route_resolved("example.org", "8.8.8.8") == "block"
+        assert router.route_resolved("example.net", None) == "block"
+        assert router.route("example.net") is None
+
+    def test_cache_size(self):
+        router = Router(cache_size=2)
+        for host in ("a.com", "b.com", "c.com", "a.com"):
+            router.route(host)
+        assert router.stats["cache_hits"] == 0
+        assert list(router._cache) == ["c.com", "a.com"]
+
+    def test_reload(self, tmp_path):
+        path = tmp_path / "direct.txt"
+        path.write_text("# comment\nexample.com  # inline\n\n10.0.0.0/8\n")
+        router = Router(files=[("direct", str(path))])
+        assert len(router) == 2
+        assert router.route("example.com") == "direct"
+        path.write_text("example.org\n")
+        router.reload()
+        assert router.route("example.com") == "tunnel"
+        assert router.route("example.org") == "direct"
+        # 规则有误时保留原有规则
+        path.write_text("example.net\n")
+        router.files.append(("proxy", str(path)))
+        with pytest.raises(AssertionError):
+            router.reload()
+        assert router.route("example.org") == "direct"
+
+
+class TestClimbRoute(object):
+
+    def setup_class(self):
+        self.echo_port = start_echo_server()
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_direct(self, engine):
+        # 远程服务器不可用，直接连接的目的地址不受影响
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 unused_port(),
+                                 router=Router([("direct", "localhost")]))
+        port = start_server(local, engine)
+        assert_echo(port, self.echo_port)
+        sock = pipelined_connect(port, "localhost", self.echo_port, b"early")
+        with sock:
+            assert recv_exactly(sock, 5) == b"early"
+        assert local.router.stats["direct"] == 2
+        assert local.stats["bytes_up"] == local.stats["bytes_down"]
+
+    def test_direct_reactor(self):
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 unused_port(), relay_threads=1,
+                                 router=Router(direct_private=True,
+                                               resolve=True))
+        assert_echo(start_server(local), self.echo_port)
+        wait_until(lambda: local.stats["relay_reactor"] == 1)
+        assert local.router.stats["direct"] == 1
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_tunnel_and_block(self, engine, caplog):
+        caplog.set_level(logging.INFO)
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0)
+        router = Router([("block", "blocked.localhost"),
+                         ("direct", "127.0.0.2")])
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 start_server(remote, engine), router=router)
+        port = start_server(local, engine)
+        assert_echo(port, self.echo_port)
+        assert remote.stats["bytes_up"] > 0
+        # 在成功响应之前拒绝，不计为故障
+        sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+        with sock:
+            sock.sendall(b"\x05\x01\x00")
+            assert recv_exactly(sock, 2) == b"\x05\x00"
+            host = b"blocked.localhost"
+            sock.sendall(b"\x05\x01\x00\x03" + bytes([len(host)]) + host +
+                         self.echo_port.to_bytes(2, "big"))
+            assert recv_exactly(sock, 10)[1] == 0x02
+            assert sock.recv(64) == b""
+        assert router.stats["tunnel"] == 1
+        assert router.stats["block"] == 1
+        assert not local.errors
+        # 固定的消息模板，日志限流按模板计数
+        wait_until(lambda: any(
+            record.msg == "Connection to %s:%s refused by route rule"
+            for record in caplog.records))
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 21:26:19
+# *************************************************************
+
+import socket
+
+import pytest
+
+from phankom.socks import Socks5Server
+from phankom.sockopt import SocketOptions
+
+from .test_socks import (start_echo_server, start_server, assert_echo,
+                         socks5_connect, wait_until)
+
+
+def connected_pair():
+    """返回一对已建立的 TCP 连接 (客户端, 服务端)"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    with server:
+        client = socket.create_connection(server.getsockname())
+        return client, server.accept()[0]
+
+
+class TestSocketOptions(object):
+
+    def test_apply(self):
+        options = SocketOptions(keepalive=30, keepalive_interval=5,
+                                keepalive_count=4, notsent_lowat=16384)
+        client, accepted = connected_pair()
+        with client, accepted:
+            options.apply(client)
+            get = client.getsockopt
+            assert get(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+            assert get(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                assert get(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 30
+                assert get(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL) == 5
+                assert get(socket.IPPROTO_TCP, socket.TCP_KEEPCNT) == 4
+            if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+                assert get(socket.IPPROTO_TCP,
+                           socket.TCP_NOTSENT_LOWAT) == 16384
+            # 默认不改变 Nagle 算法之外的选项
+            SocketOptions(nodelay=False).apply(accepted)
+            assert not accepted.getsockopt(socket.IPPROTO_TCP,
+                                           socket.TCP_NODELAY)
+        assert not options.stats
+
+    def test_listener(self):
+        options = SocketOptions(rcvbuf=256 * 1024, fastopen=16)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        with sock:
+            options.apply_listener(sock)
+            # Linux 返回的缓冲区大小为设置值的两倍
+            assert sock.getsockopt(socket.SOL_SOCKET,
+                                   socket.SO_RCVBUF) >= 256 * 1024
+        assert options.stats["rcvbuf"] == 0
+
+    def test_autotune(self):
+        options = SocketOptions(autotune_rate=100 * 1024 * 1024,
+                                autotune_max=4 * 1024 * 1024)
+        assert options.buffer_size(0.00001) == options.AUTOTUNE_MIN
+        assert options.buffer_size(0.02) == 2 * 1024 * 1024
+        assert options.buffer_size(1) == 4 * 1024 * 1024
+        client, accepted = connected_pair()
+        with client, accepted:
+            # 缓冲区已经足够时不调整
+            options.autotune(client, 0.00001)
+            assert options.stats["autotuned"] == 0
+            options.autotune(client, 0.02)
+            assert client.getsockopt(socket.SOL_SOCKET,
+                                     socket.SO_SNDBUF) >= 2 * 1024 * 1024
+            assert options.stats["autotuned"] == 1
+            # RTT 未知时不调整
+            options.autotune(accepted, None)
+            assert options.stats["autotuned"] == 1
+
+    @pytest.mark.skipif(not hasattr(socket, "TCP_INFO"),
+                        reason="TCP_INFO not supported")
+    def test_measure_rtt(self):
+        client, accepted = connected_pair()
+        with client, accepted:
+            rtt = SocketOptions.measure_rtt(client)
+            assert rtt is None or 0 < rtt < 1
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_server(self, engine):
+        options = SocketOptions(keepalive=60, fastopen=16,
+                                rcvbuf=128 * 1024,
+                                autotune_rate=10 * 1024 * 1024)
+        server = Socks5Server("127.0.0.1", 0, socket_options=options)
+        assert_echo(start_server(server, engine), start_echo_server())
+        assert server.connector.options is options
+
+    def test_reactor_keeps_options(self):
+        # Reactor 不覆盖 SocketOptions 中的设置
+        server = Socks5Server("127.0.0.1", 0, relay_threads=1,
+                              socket_options=SocketOptions(nodelay=False))
+        port = start_server(server)
+        with socks5_connect(port, "localhost", start_echo_server()):
+            loop = server.reactor.loops[0]
+            wait_until(lambda: loop.relays)
+            for sock in next(iter(loop.relays)).socks:
+                assert not sock.getsockopt(socket.IPPROTO_TCP,
+                                           socket.TCP_NODELAY)
@@ -0,0 +1,322 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 10:21:35
+# *************************************************************
+
+import os
+import time
+import socket
+import struct
+import threading
+
+import pytest
+
+from phankom.socks import Socks5Server, SessionLimiter, HandshakeBuffer
+
+
+def start_echo_server():
+    """启动一个回显服务器，返回监听端口"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(128)
+
+    def echo(sock):
+        with sock:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                sock.sendall(data)
+
+    def serve():
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=echo, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def start_reply_server():
+    """启动一个在客户端结束写方向后才回复全部数据的服务器，返回监听端口"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(128)
+
+    def reply(sock):
+        with sock:
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            sock.sendall(b"".join(chunks))
+
+    def serve():
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=reply, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def assert_half_close(proxy_port, reply_port):
+    sock = socks5_connect(proxy_port, "localhost", reply_port)
+    with sock:
+        data = os.urandom(300 * 1024)
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        assert recv_exactly(sock, len(data)) == data
+        assert sock.recv(1) == b""
+
+
+def pipelined_connect(proxy_port, addr, port, data=b""):
+    """在一次发送中完成认证协商和请求，并紧跟着发送 data"""
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+    request = (b"\x05\x01\x00" + b"\x05\x01\x00\x03" + bytes([len(addr)]) +
+               addr.encode() + struct.pack(">H", port))
+    sock.sendall(request + data)
+    assert recv_exactly(sock, 12)[:4] == b"\x05\x00\x05\x00"
+    return sock
+
+
+def start_server(server, engine="thread"):
+    target = server.start_async if engine == "asyncio" else server.start
+    threading.Thread(target=target, daemon=True).start()
+    return server.sock.getsockname()[1]
+
+
+def socks5_connect(proxy_port, addr, port):
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+    sock.sendall(b"\x05\x01\x00")
+    assert sock.recv(2) == b"\x05\x00"
+    request = b"\x05\x01\x00\x03" + bytes([len(addr)]) + addr.encode()
+    sock.sendall(request + struct.pack(">H", port))
+    reply = b""
+    while len(reply) < 10:
+        reply += sock.recv(10 - len(reply))
+    assert reply[1] == 0x00
+    return sock
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timeout"
+        time.sleep(0.01)
+
+
+def assert_echo(proxy_port, echo_port):
+    sock = socks5_connect(proxy_port, "localhost", echo_port)
+    with sock:
+        for size in (1, 1024, 100 * 1024):
+            data = os.urandom(size)
+            sock.sendall(data)
+            assert recv_exactly(sock, size) == data
+
+
+class TestSocks5Server(object):
+
+    def setup_class(self):
+        self.echo_port = start_echo_server()
+
+    def test_thread_engine(self):
+        port = start_server(Socks5Server("127.0.0.1", 0))
+        assert_echo(port, self.echo_port)
+
+    def test_asyncio_engine(self):
+        port = start_server(Socks5Server("127.0.0.1", 0), "asyncio")
+        assert_echo(port, self.echo_port)
+
+    def test_relay_path(self):
+        server = Socks5Server("127.0.0.1", 0)
+        assert_echo(start_server(server), self.echo_port)
+        expected = "relay_splice" if hasattr(os, "splice") else "relay_copy"
+        wait_until(lambda: server.stats[expected] == 1)
+
+        # splice 不可用时自动退回到缓冲区复制
+        server = Socks5Server("127.0.0.1", 0)
+        server._splice_stream = lambda sock, remote: False
+        assert_echo(start_server(server), self.echo_port)
+        wait_until(lambda: server.stats["relay_copy"] == 1)
+
+    def test_reactor(self):
+        server = Socks5Server("127.0.0.1", 0, relay_threads=2, max_sessions=4)
+        port = start_server(server)
+        threads = [threading.Thread(target=assert_echo,
+                                    args=(port, self.echo_port))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wait_until(lambda: server.stats["relay_reactor"] == 8)
+        wait_until(lambda: server.limiter.active == 0)
+        assert server.reactor.relays == 0
+
+    @pytest.mark.parametrize("options", [{}, {"relay_threads": 1}])
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_half_close(self, engine, options):
+        server = Socks5Server("127.0.0.1", 0, **options)
+        assert_half_close(start_server(server, engine), start_reply_server())
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_timeouts(self, engine):
+        server = Socks5Server("127.0.0.1", 0, idle_timeout=0.3,
+                              handshake_timeout=0.3, session_lifetime=1)
+        port = start_server(server, engine)
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            assert sock.recv(1) == b""
+        with socks5_connect(port, "localhost", self.echo_port) as sock:
+            sock.sendall(b"ping")
+            assert recv_exactly(sock, 4) == b"ping"
+            assert sock.recv(1) == b""
+        # 一直有数据的会话在存续时间超时后回收
+        with socks5_connect(port, "localhost", self.echo_port) as sock:
+            with pytest.raises((AssertionError, OSError)):
+                for _ in range(100):
+                    sock.sendall(b"ping")
+                    recv_exactly(sock, 4)
+                    time.sleep(0.05)
+        wait_until(lambda: len(server.sweeper.sessions) == 0)
+        assert server.sweeper.stats == {"handshake": 1, "idle": 1,
+                                        "lifetime": 1}
+        assert not server.errors
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_pipelined_handshake(self, engine):
+        port = start_server(Socks5Server("127.0.0.1", 0), engine)
+        with pipelined_connect(port, "localhost", self.echo_port,
+                               b"early") as sock:
+            assert recv_exactly(sock, 5) == b"early"
+        # 每次只发送一个字节
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            request = (b"\x05\x01\x00\x05\x01\x00\x01" +
+                       socket.inet_aton("127.0.0.1") +
+                       struct.pack(">H", self.echo_port))
+            for i in range(len(request)):
+                sock.sendall(request[i:i + 1])
+                time.sleep(0.001)
+            assert recv_exactly(sock, 12)[:4] == b"\x05\x00\x05\x00"
+            sock.sendall(b"ping")
+            assert recv_exactly(sock, 4) == b"ping"
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_unsupported_addr_type(self, engine):
+        server = Socks5Server("127.0.0.1", 0)
+        port = start_server(server, engine)
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            sock.sendall(b"\x05\x01\x00\x05\x01\x00\x05")
+            assert recv_exactly(sock, 12)[:4] == b"\x05\x00\x05\x08"
+        wait_until(lambda: server.errors["Exception"] == 1)
+
+    def _hold_session(self, port):
+        sock = socks5_connect(port, "localhost", self.echo_port)
+        sock.sendall(b"ping")
+        assert recv_exactly(sock, 4) == b"ping"
+        return sock
+
+    def test_max_sessions_reject(self):
+        for engine in ("thread", "asyncio"):
+            server = Socks5Server("127.0.0.1", 0, max_sessions=1,
+                                  overflow="reject")
+            port = start_server(server, engine)
+            with self._hold_session(port):
+                sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+                with sock:
+                    sock.sendall(b"\x05\x01\x00")
+                    try:
+                        assert sock.recv(2) == b""
+                    except ConnectionResetError:
+                        pass
+                assert server.limiter.rejected == 1
+                assert server.limiter.active == 1
+            wait_until(lambda: server.limiter.active == 0)
+            assert server.limiter.peak == 1
+
+    def test_max_sessions_queue(self):
+        for engine in ("thread", "asyncio"):
+            server = Socks5Server("127.0.0.1", 0, max_sessions=1)
+            port = start_server(server, engine)
+            first = self._hold_session(port)
+            second = socket.create_connection(("127.0.0.1", port), timeout=5)
+            with second:
+                second.sendall(b"\x05\x01\x00")
+                wait_until(lambda: server.limiter.queued == 1)
+                first.close()
+                assert second.recv(2) == b"\x05\x00"
+            assert server.limiter.rejected == 0
+
+
+class TestHandshakeBuffer(object):
+
+    def test_incremental(self):
+        data = (b"\x05\x02\x00\x02" + b"\x05\x01\x00\x03\x09localhost" +
+                b"\x00\x50" + b"GET /")
+        handshake = HandshakeBuffer()
+        results = []
+        parsers = [handshake.parse_greeting, handshake.parse_request]
+        for i in range(len(data)):
+            handshake.feed(data[i:i + 1])
+            if len(results) == len(parsers):
+                continue
+            result = parsers[len(results)]()
+            if result is not None:
+                results.append(result)
+        assert results == [
+            (5, [0, 2]),
+            (5, 1, 3, b"\x09localhost", b"\x00\x50"),
+        ]
+        assert handshake.take_rest() == b"GET /"
+
+    def test_pipelined(self):
+        handshake = HandshakeBuffer()
+        handshake.feed(b"\x05\x01\x00\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x50")
+        assert handshake.parse_greeting() == (5, [0])
+        assert handshake.parse_request() == (5, 1, 1, b"\x7f\x00\x00\x01",
+                                             b"\x00\x50")
+        assert handshake.parse_request() is None
+
+    def test_unsupported_addr_type(self):
+        handshake = HandshakeBuffer()
+        handshake.feed(b"\x05\x01\x00\x07")
+        assert handshake.parse_request() == (5, 1, 7, None, None)
+
+
+class TestSessionLimiter(object):
+
+    def test_admit(self):
+        limiter = SessionLimiter(max_sessions=2, queue_size=1)
+        assert all(limiter.admit() for _ in range(3))
+        assert not limiter.admit()
+        limiter.enter()
+        limiter.enter()
+        assert (limiter.active, limiter.queued, limiter.peak) == (2, 1, 2)
+        limiter.leave()
+        assert limiter.admit()
+        assert limiter.rejected == 1
+
+    def test_block(self):
+        limiter = SessionLimiter(max_sessions=1, overflow="block")
+        assert limiter.admit()
+        assert not limiter.has_slot()
+        limiter.enter()
+        threading.Timer(0.05, limiter.leave).start()
+        limiter.wait_slot()
+        assert limiter.has_slot()
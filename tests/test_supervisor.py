@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 13:20:46
+# *************************************************************
+
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+
+from .test_socks import (start_echo_server, assert_echo, wait_until,
+                         socks5_connect, recv_exactly)
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def is_listening(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def is_direct(proxy_port, echo_port):
+    """经由代理连接回显服务器，数据被原样返回时为真"""
+    try:
+        with socks5_connect(proxy_port, "localhost", echo_port) as sock:
+            sock.sendall(b"ping")
+            return recv_exactly(sock, 4) == b"ping"
+    except (OSError, AssertionError):
+        return False
+
+
+def get_children(pid):
+    output = subprocess.run(["ps", "-o", "pid=", "--ppid", str(pid)],
+                            stdout=subprocess.PIPE).stdout
+    return [int(child) for child in output.split()]
+
+
+class TestSupervisor(object):
+
+    def setup_class(self):
+        self.echo_port = start_echo_server()
+
+    def _run(self, *options):
+        port = get_free_port()
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        process = subprocess.Popen(
+            [sys.executable, "-m", "phankom", "socks", "--loglevel", "error",
+             "-H", "127.0.0.1", "-p", str(port), "--workers", "2"] +
+            list(options), cwd=root)
+        try:
+            wait_until(lambda: len(get_children(process.pid)) == 2)
+            wait_until(lambda: is_listening(port))
+            assert_echo(port, self.echo_port)
+
+            # 异常退出的子进程会被重新启动
+            children = get_children(process.pid)
+            os.kill(children[0], signal.SIGKILL)
+            wait_until(lambda: children[0] not in get_children(process.pid) and
+                       len(get_children(process.pid)) == 2)
+            for _ in range(4):
+                assert_echo(port, self.echo_port)
+
+            # 单独停止的子进程不影响其他子进程，退出后被重新启动一次
+            children = get_children(process.pid)
+            os.kill(children[0], signal.SIGTERM)
+            wait_until(lambda: children[0] not in get_children(process.pid) and
+                       len(get_children(process.pid)) == 2)
+            for _ in range(4):
+                assert_echo(port, self.echo_port)
+            children = get_children(process.pid)
+            time.sleep(1.5)
+            assert get_children(process.pid) == children
+
+            process.send_signal(signal.SIGTERM)
+            assert process.wait(timeout=10) == 0
+        finally:
+            if process.poll() is None:
+                process.kill()
+
+    def test_shared_socket(self):
+        self._run()
+
+    def test_shared_socket_asyncio(self):
+        self._run("--engine", "asyncio")
+
+    def test_reuse_port(self):
+        if hasattr(socket, "SO_REUSEPORT"):
+            self._run("--reuse-port")
+
+    def test_reload_rules(self, tmp_path):
+        # 父进程将 SIGHUP 转发给子进程，子进程重新加载分流规则
+        rules = tmp_path / "direct.txt"
+        rules.write_text("localhost\n")
+        port = get_free_port()
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        process = subprocess.Popen(
+            [sys.executable, "-m", "phankom", "climb", "-c",
+             "--loglevel", "error", "-H", "127.0.0.1", "-p", str(port),
+             "--server-port", str(get_free_port()), "--workers", "2",
+             "--direct-rules", str(rules)], cwd=root)
+        try:
+            wait_until(lambda: len(get_children(process.pid)) == 2)
+            wait_until(lambda: is_listening(port))
+            assert_echo(port, self.echo_port)
+            children = get_children(process.pid)
+
+            # 远程服务器不可用，规则清空后连接被拒绝
+            rules.write_text("")
+            process.send_signal(signal.SIGHUP)
+            wait_until(lambda: not is_direct(port, self.echo_port))
+            assert process.poll() is None
+            assert get_children(process.pid) == children
+
+            process.send_signal(signal.SIGTERM)
+            assert process.wait(timeout=10) == 0
+        finally:
+            if process.poll() is None:
+                process.kill()
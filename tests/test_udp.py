@@ -0,0 +1,228 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#  Copyright (c) Huoty - All rights reserved
+#
+#      Author: Huoty <sudohuoty@gmail.com>
+#  CreateTime: 2026-10-18 20:31:06
+# *************************************************************
+
+import time
+import socket
+import struct
+import threading
+from collections import Counter
+
+import pytest
+
+from phankom.dns import Resolver
+from phankom.socks import Socks5Server
+from phankom.climb import LocalClimbServer, RemoteClimbServer
+from phankom.utils import wait_sockets
+from phankom.udp import (DirectEnd, pack_address, parse_address,
+                         encode_datagrams, decode_datagrams, recv_batch)
+
+from .test_socks import start_server, recv_exactly, wait_until
+
+
+def start_udp_echo_server(family=socket.AF_INET, host="127.0.0.1"):
+    """启动一个 UDP 回显服务器，返回端口"""
+    server = socket.socket(family, socket.SOCK_DGRAM)
+    server.bind((host, 0))
+
+    def serve():
+        while True:
+            data, addr = server.recvfrom(65535)
+            server.sendto(data, addr)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def udp_associate(proxy_port):
+    """发送 UDP ASSOCIATE 请求，返回 (控制连接, 中继地址)"""
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+    sock.sendall(b"\x05\x01\x00")
+    assert recv_exactly(sock, 2) == b"\x05\x00"
+    sock.sendall(b"\x05\x03\x00\x01" + b"\x00" * 6)
+    reply = recv_exactly(sock, 10)
+    assert reply[1] == 0x00
+    return sock, (socket.inet_ntoa(reply[4:8]),
+                  struct.unpack(">H", reply[8:10])[0])
+
+
+def assert_udp_echo(proxy_port, echo_port, count=20):
+    control, relay = udp_associate(proxy_port)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(5)
+    with control, client:
+        header = b"\x00\x00\x00\x03\x09localhost" + struct.pack(">H", echo_port)
+        for i in range(count):
+            client.sendto(header + b"ping %d" % i, relay)
+        received = set()
+        while len(received) < count:
+            data, addr = client.recvfrom(65535)
+            assert addr == relay
+            assert data[:4] == b"\x00\x00\x00\x01"
+            host, port, end = parse_address(data, 3)
+            assert (host, port) == ("127.0.0.1", echo_port)
+            received.add(data[end:])
+    assert received == {b"ping %d" % i for i in range(count)}
+
+
+def test_datagrams_codec():
+    datagrams = [(pack_address(("10.0.0.1", 53)), b"query"),
+                 (b"\x03\x07example" + struct.pack(">H", 80), b""),
+                 (b"\x04" + socket.inet_pton(socket.AF_INET6, "::1") +
+                  struct.pack(">H", 443), b"x" * 1000)]
+    assert decode_datagrams(encode_datagrams(datagrams)) == datagrams
+    assert parse_address(datagrams[1][0]) == ("example", 80, 11)
+    with pytest.raises(AssertionError):
+        decode_datagrams(encode_datagrams(datagrams)[:-1])
+
+
+class TestDirectEnd(object):
+
+    def setup_class(self):
+        self.echo_port = start_udp_echo_server()
+
+    def _recv(self, end, count):
+        datagrams = []
+        deadline = time.time() + 5
+        while len(datagrams) < count and time.time() < deadline:
+            datagrams.extend(end.recv())
+            time.sleep(0.01)
+        return datagrams
+
+    def test_batch(self):
+        end = DirectEnd(Resolver(), Counter())
+        with end.sock:
+            addr_data = pack_address(("127.0.0.1", self.echo_port))
+            end.send([(addr_data, b"%d" % i) for i in range(10)])
+            assert wait_sockets([end.sock], timeout=5)
+            time.sleep(0.1)
+            datagrams = recv_batch(end.sock)
+            assert [data for data, _ in datagrams] == \
+                [b"%d" % i for i in range(10)]
+            assert recv_batch(end.sock) == []
+
+    def test_nat(self):
+        stats = Counter()
+        end = DirectEnd(Resolver(), stats, timeout=0.2)
+        stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        with end.sock, stranger:
+            # 未发送过数据的地址发来的数据报被丢弃
+            stranger.sendto(b"unsolicited", end.sock.getsockname())
+            addr_data = pack_address(("127.0.0.1", self.echo_port))
+            end.send([(addr_data, b"hello")])
+            assert self._recv(end, 1) == [(addr_data, b"hello")]
+            assert stats["udp_dropped"] == 1
+            # 超时后回复不再转发
+            time.sleep(0.3)
+            assert end.recv() == []
+            assert stats["udp_nat_expired"] == 1
+            assert not end.nat
+
+
+    @pytest.mark.skipif(not socket.has_ipv6, reason="IPv6 not supported")
+    def test_ipv6(self):
+        try:
+            port = start_udp_echo_server(socket.AF_INET6, "::1")
+        except OSError:
+            pytest.skip("IPv6 loopback not available")
+        end = DirectEnd(Resolver(), Counter())
+        try:
+            addr_data = pack_address(("::1", port))
+            assert addr_data[0] == 4
+            end.send([(addr_data, b"hello")])
+            assert self._recv(end, 1) == [(addr_data, b"hello")]
+        finally:
+            end.close()
+
+    def test_resolve_in_background(self):
+        # 未缓存的域名在后台解析，不阻塞发送，暂存的数据报按顺序发出
+        class SlowResolver(Resolver):
+            def resolve(self, host, port):
+                time.sleep(0.3)
+                return [info for info in super().resolve(host, port)
+                        if info[0] == socket.AF_INET]
+
+        stats = Counter()
+        end = DirectEnd(SlowResolver(), stats)
+        try:
+            addr_data = (b"\x03\x09localhost" +
+                         struct.pack(">H", self.echo_port))
+            start = time.monotonic()
+            for i in range(3):
+                end.send([(addr_data, b"%d" % i)])
+            assert time.monotonic() - start < 0.2
+            reply = pack_address(("127.0.0.1", self.echo_port))
+            datagrams = self._recv(end, 3)
+            assert datagrams == [(reply, b"%d" % i) for i in range(3)]
+            # 解析结果已缓存，之后直接发送
+            end.send([(addr_data, b"cached")])
+            assert self._recv(end, 1) == [(reply, b"cached")]
+            assert not stats["udp_dropped"]
+        finally:
+            end.close()
+
+
+class TestUdpAssociate(object):
+
+    def setup_class(self):
+        self.echo_port = start_udp_echo_server()
+
+    def test_socks(self):
+        server = Socks5Server("127.0.0.1", 0, udp=True)
+        assert_udp_echo(start_server(server), self.echo_port)
+        wait_until(lambda: server.stats["udp_datagrams_down"] == 20)
+        assert server.stats["udp_associations"] == 1
+        assert server.stats["udp_datagrams_up"] == 20
+
+    @pytest.mark.parametrize("engine,udp", [("thread", False),
+                                            ("asyncio", True)])
+    def test_not_supported(self, engine, udp):
+        port = start_server(Socks5Server("127.0.0.1", 0, udp=udp), engine)
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            sock.sendall(b"\x05\x01\x00\x05\x03\x00\x01" + b"\x00" * 6)
+            reply = b""
+            while True:
+                data = sock.recv(64)
+                if not data:
+                    break
+                reply += data
+            assert reply[:2] == b"\x05\x00"
+            assert reply[2:4] == b"\x05\x07"
+
+    def test_association_ends_with_control(self):
+        server = Socks5Server("127.0.0.1", 0, udp=True)
+        control, relay = udp_associate(start_server(server))
+        control.close()
+        wait_until(lambda: not server.sweeper.sessions)
+
+    @pytest.mark.parametrize("options", [{}, {"large_frame": True,
+                                               "stream_compress": True}])
+    def test_climb(self, options):
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0, udp=True,
+                                   **options)
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 start_server(remote), udp=True, **options)
+        assert_udp_echo(start_server(local), self.echo_port)
+        # 关联结束后关闭隧道，远程服务器随之结束
+        wait_until(lambda: not remote.sweeper.sessions)
+        assert remote.stats["udp_associations"] == 1
+        assert remote.stats["udp_datagrams_up"] == 20
+
+    @pytest.mark.parametrize("engine", ["thread", "asyncio"])
+    def test_climb_refused(self, engine):
+        # 远程服务器未启用 UDP 时本地服务器回复失败
+        remote = RemoteClimbServer("hello", "127.0.0.1", 0)
+        local = LocalClimbServer("hello", "127.0.0.1", 0, "127.0.0.1",
+                                 start_server(remote, engine), udp=True)
+        port = start_server(local)
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            sock.sendall(b"\x05\x01\x00")
+            assert recv_exactly(sock, 2) == b"\x05\x00"
+            sock.sendall(b"\x05\x03\x00\x01" + b"\x00" * 6)
+            assert recv_exactly(sock, 10)[1] == 0x01